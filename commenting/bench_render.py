@@ -0,0 +1,136 @@
+"""
+Micro-benchmark of Markdown rendering on the contents of `main/sample_data/post_data.json`.
+
+    python -m commenting.bench_render [--rounds 200] [--adversarial]
+
+Compares building a renderer for every text (the former `render_html`), reusing the renderer of
+the engine without its cache, and the engine with its cache. With `--adversarial`, measures the
+render time and the regex calls per KB of the `ADVERSARIAL_INPUTS` instead, which must not grow
+with their size.
+"""
+import argparse
+import json
+import os
+import re
+import time
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure()
+
+from commenting import quoted_post  # noqa: E402
+from commenting.engine import MarkdownEngine  # noqa: E402
+
+SAMPLE_DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           'main', 'sample_data', 'post_data.json')
+
+
+def load_texts(path=SAMPLE_DATA):
+    with open(path) as f:
+        topics = json.load(f)
+    texts = []
+    for topic in topics:
+        texts.append(topic['content'])
+        texts += [post['content'] for post in topic['posts']]
+    return texts
+
+
+# Generators of texts of about `size` bytes that made the former regex quote rules backtrack
+ADVERSARIAL_INPUTS = {
+    'unclosed quotes': lambda size: '<<<[[user|abc123]] text ' * (size // 24),
+    'unclosed headers': lambda size: '<<<[[user|' * (size // 10),
+    'deep nesting': lambda size: '<<<[[user|abc]]' * (size // 18) + 'text' + '<<<' * (size // 18),
+    'stray closers': lambda size: 'text <<< ' * (size // 9),
+    'long header': lambda size: '<<<[[' + 'a' * size,
+}
+
+
+def seconds_per_kb(render, text, rounds=3):
+    """ Returns the best render time of `text` over `rounds`, in seconds per KB. """
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        render(text)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / (len(text.encode()) / 1024)
+
+
+class CountingPattern:
+    """ Wraps a compiled pattern to count the calls to its methods. """
+
+    def __init__(self, pattern):
+        self.pattern, self.calls = pattern, 0
+
+    def __getattr__(self, name):
+        attr = getattr(self.pattern, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            self.calls += 1
+            return attr(*args, **kwargs)
+        return call
+
+
+def regex_calls(markdown, text):
+    """ Returns the calls to the patterns of `quoted_post` and of the grammars of `markdown` made rendering `text`. """
+    targets = [(markdown.block.rules, name) for name in dir(markdown.block.rules)]
+    targets += [(markdown.inline.rules, name) for name in dir(markdown.inline.rules)]
+    targets += [(quoted_post, name) for name in dir(quoted_post)]
+    patched = []
+    for target, name in targets:
+        pattern = getattr(target, name)
+        if isinstance(pattern, type(re.compile(''))):
+            patched.append((target, name, pattern, CountingPattern(pattern)))
+            setattr(target, name, patched[-1][3])
+    try:
+        markdown(text)
+    finally:
+        for target, name, pattern, _ in patched:
+            setattr(target, name, pattern)
+    return sum(counting.calls for *_, counting in patched)
+
+
+def renders_per_second(render, texts, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for text in texts:
+            render(text)
+    return rounds * len(texts) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=200)
+    parser.add_argument('--adversarial', action='store_true')
+    args = parser.parse_args()
+
+    if args.adversarial:
+        render = MarkdownEngine(cache_size=0).render
+        markdown = MarkdownEngine.build_markdown()
+        for name, generate in ADVERSARIAL_INPUTS.items():
+            timings = '  '.join(f'{size // 1024:>4} KB {seconds_per_kb(render, generate(size)) * 1000:>7.3f} ms/KB '
+                                f'{regex_calls(markdown, generate(size)) * 1024 // size:>5} calls/KB'
+                                for size in (16 * 1024, 64 * 1024, 256 * 1024))
+            print(f'{name:<18} {timings}')
+        return
+
+    texts = load_texts()
+    uncached, cached = MarkdownEngine(cache_size=0), MarkdownEngine(cache_size=1024)
+    results = [
+        ('new renderer per render', lambda text: MarkdownEngine.build_markdown()(text)),
+        ('engine, no cache', uncached.render),
+        ('engine, cached', cached.render),
+    ]
+    print(f'{len(texts)} texts x {args.rounds} rounds')
+    baseline = None
+    for name, render in results:
+        rate = renders_per_second(render, texts, args.rounds)
+        baseline = baseline or rate
+        print(f'{name:<24} {rate:>12,.0f} renders/s  x{rate / baseline:.1f}')
+
+
+if __name__ == '__main__':
+    main()
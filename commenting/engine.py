@@ -0,0 +1,94 @@
+"""
+A Markdown rendering engine that is shared by the whole process.
+
+Building a `MarkdownWithQuotedPost` compiles its lexers and grammars, so every thread builds one
+on first use and reuses it (mistune renderers keep parsing state and are not safe to share
+between threads). Rendered HTML is kept in a bounded LRU cache keyed by the hash of the text and
+`RENDERER_VERSION`, so rendering the same text again (quotes, previews, re-saves) is a lookup.
+Texts can also be rendered by a pool of `MARKDOWN_RENDER_WORKERS` background threads.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from commenting.quoted_post import MarkdownWithQuotedPost, HighlighterRenderer
+
+# Bump when a change of the grammars or of the renderer changes the HTML of a given text
+RENDERER_VERSION = 3
+
+
+class MarkdownEngine:
+
+    def __init__(self, cache_size=1024, workers=2):
+        self.cache_size = cache_size
+        self.workers = workers
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._executor = None
+
+    @staticmethod
+    def build_markdown():
+        return MarkdownWithQuotedPost(renderer=HighlighterRenderer())
+
+    @property
+    def markdown(self):
+        markdown = getattr(self._local, 'markdown', None)
+        if markdown is None:
+            markdown = self._local.markdown = self.build_markdown()
+        return markdown
+
+    @staticmethod
+    def cache_key(text):
+        return RENDERER_VERSION, hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+    def render(self, text):
+        if not self.cache_size:
+            return self.markdown(text)
+        key = self.cache_key(text)
+        with self._lock:
+            html = self._cache.get(key)
+            if html is not None:
+                self._cache.move_to_end(key)
+                return html
+        html = self.markdown(text)
+        with self._lock:
+            self._cache[key] = html
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return html
+
+    @property
+    def executor(self):
+        """ The background worker pool, started on first use. """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='markdown')
+            return self._executor
+
+    def submit(self, text):
+        """ Renders `text` in the background worker pool and returns a `Future` of the HTML. """
+        return self.executor.submit(self.render, text)
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+
+
+@lru_cache(maxsize=None)
+def get_engine():
+    """ Returns the engine of this process, configured by the `MARKDOWN_RENDER_*` settings. """
+    return MarkdownEngine(cache_size=getattr(settings, 'MARKDOWN_RENDER_CACHE_SIZE', 1024),
+                          workers=getattr(settings, 'MARKDOWN_RENDER_WORKERS', 2))
+
+
+@receiver(setting_changed)
+def reset_engine(setting, **kwargs):
+    if setting.startswith('MARKDOWN_RENDER_'):
+        get_engine.cache_clear()
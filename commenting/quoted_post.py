@@ -1,68 +1,222 @@
 import re
-
-from mistune import Renderer, Markdown, InlineLexer, BlockLexer, BlockGrammar, InlineGrammar
-
-QUOTED_POST_RE = re.compile(
-    r'^<<<\s*\[\['  # <<<[[
-    r'([\s\S]+?)\|([\s\S]+?)'  # Author|PostID
-    r'\]\](.*)<<<',  # ]] some stuf the author said <<<
-    flags=re.DOTALL)
+from bisect import bisect_right
+from collections import defaultdict, deque, namedtuple
+
+from mistune import BlockGrammar, BlockLexer, InlineGrammar, InlineLexer, Renderer, Markdown, escape
+
+QUOTE_MARKER = '<<<'
+# The `[[Author|PostID]]` header that makes a `<<<` open a quote. Its parts are bounded, so trying it
+# at every `<<<` costs a constant number of steps
+QUOTE_HEADER_RE = re.compile(r'\s*\[\[([^|\]\n]{1,150})\|([A-Za-z0-9]{1,32})\]\]')
+# Quotes nested deeper than this are left in their parent quote as plain text
+MAX_QUOTE_DEPTH = 4
+# The link to the quoted votable emitted by `HighlighterRenderer.quoted_post`
+QUOTE_LINK_RE = re.compile(r'data-quote-id="([^"]*)" href="[^"]*"')
+# Runs of backticks, which delimit the code spans, and blank lines, which code spans do not cross
+BACKTICKS_RE = re.compile(r'`+')
+BLANK_LINE_RE = re.compile(r'\n[ \t\r]*\n')
+
+QuotedPost = namedtuple('QuotedPost', ['author', 'post_id', 'segments'])
+
+
+def _split(text, start, end, quotes):
+    """ Returns the segments of `text[start:end]`: the `(start, end, QuotedPost)` of `quotes` and the text between. """
+    segments = []
+    for quote_start, quote_end, quote in quotes:
+        if quote_start > start:
+            segments.append(text[start:quote_start])
+        segments.append(quote)
+        start = quote_end
+    if end > start:
+        segments.append(text[start:end])
+    return segments
+
+
+def _fence_ranges(text):
+    """
+    Returns the `(start, end)` of the fenced code blocks of `text`: from a line opening a fence, like
+    mistune's ```` ```lang ````, to the next line ending with the same fence. Each line is looked at once.
+    """
+    lines, closing = [], defaultdict(list)
+    start = 0
+    for line in text.split('\n'):
+        stripped = line.strip(' \t\r')
+        opening = None
+        for char in '`~':
+            fence = stripped[:len(stripped) - len(stripped.lstrip(char))]
+            if len(fence) >= 3 and not any(c in '` \t' for c in stripped[len(fence):].strip(' \t')):
+                opening = fence
+            fence = stripped[len(stripped.rstrip(char)):]
+            if len(fence) >= 3:
+                closing[fence].append(len(lines))
+        lines.append((start, start + len(line), opening))
+        start += len(line) + 1
+
+    ranges, i = [], 0
+    while i < len(lines):
+        line_start, _, fence = lines[i]
+        closers = closing[fence] if fence else ()
+        j = bisect_right(closers, i)
+        if j < len(closers):
+            ranges.append((line_start, lines[closers[j]][1]))
+            i = closers[j]
+        i += 1
+    return ranges
+
+
+def _code_span_ranges(text, start, end):
+    """
+    Returns the `(start, end)` of the code spans of `text[start:end]`: from a run of backticks to the
+    next run of the same length in its paragraph. Each run is looked at a constant number of times.
+    """
+    ranges = []
+    paragraph_ends = [m.start() for m in BLANK_LINE_RE.finditer(text, start, end)] + [end]
+    for paragraph_end in paragraph_ends:
+        runs = [(m.start(), m.end()) for m in BACKTICKS_RE.finditer(text, start, paragraph_end)]
+        by_length = defaultdict(deque)
+        for run in runs:
+            by_length[run[1] - run[0]].append(run)
+        pos = start
+        for run_start, run_end in runs:
+            same = by_length[run_end - run_start]
+            same.popleft()
+            if run_start < pos or not same:
+                continue
+            ranges.append((run_start, same[0][1]))
+            pos = same[0][1]
+        start = paragraph_end
+    return ranges
+
+
+def code_ranges(text):
+    """ Returns the sorted `(start, end)` of the fenced code blocks and code spans of `text`. """
+    ranges, start = [], 0
+    for fence_start, fence_end in _fence_ranges(text) + [(len(text), len(text))]:
+        ranges += _code_span_ranges(text, start, fence_start)
+        ranges.append((fence_start, fence_end))
+        start = fence_end
+    return ranges[:-1]
+
+
+def scan_quotes(text, max_depth=MAX_QUOTE_DEPTH):
+    """
+    Splits `text` into plain text and `QuotedPost` segments, in a single pass over its `<<<` markers.
+    A `<<<` followed by a `[[Author|PostID]]` header opens a quote and any other `<<<` closes the
+    innermost open one. Quotes that are never closed and `<<<` that close nothing stay plain text,
+    so no input makes the scanner go back over the text. The `<<<` in code are text too.
+    """
+    code = code_ranges(text)
+    # Every open quote is `[start, header, quotes closed inside it]`
+    stack, quotes, i = [], [], 0
+    pos = text.find(QUOTE_MARKER)
+    while pos != -1:
+        while i < len(code) and code[i][1] <= pos:
+            i += 1
+        if i < len(code) and code[i][0] <= pos:
+            pos = text.find(QUOTE_MARKER, code[i][1])
+            continue
+        end = pos + len(QUOTE_MARKER)
+        header = QUOTE_HEADER_RE.match(text, end)
+        if header:
+            stack.append([pos, header, []])
+            end = header.end()
+        elif stack:
+            start, header, inner = stack.pop()
+            parent = stack[-1][2] if stack else quotes
+            if len(stack) < max_depth:
+                quote = QuotedPost(header.group(1), header.group(2), _split(text, header.end(), pos, inner))
+                parent.append((start, end, quote))
+        pos = text.find(QUOTE_MARKER, end)
+
+    # The quotes closed inside a quote that is never closed belong to its parent
+    while stack:
+        inner = stack.pop()[2]
+        (stack[-1][2] if stack else quotes).extend(inner)
+    return _split(text, 0, len(text), quotes)
+
+
+def quoted_ids(text):
+    """ Returns the ids of the votables quoted in the Markdown `text`, in order and without duplicates. """
+    return list(dict.fromkeys(segment.post_id for segment in scan_quotes(text) if isinstance(segment, QuotedPost)))
+
+
+def resolve_quote_links(html, urls):
+    """ Points the quote links of rendered `html` to `urls`, a dict of the permalinks by quoted id. """
+    def replace(m):
+        url = urls.get(m.group(1))
+        return f'data-quote-id="{m.group(1)}" href="{escape(url, quote=True)}"' if url else m.group(0)
+    return QUOTE_LINK_RE.sub(replace, html)
+
+
+# Link text with bracket pairs that do not span past the next bracket, so that texts full of `[[`
+# without closing brackets (like unclosed quote headers) are not scanned to their end at every `[`
+LINK_TEXT = r'(?:\[[^\[\]]*\]|[^\[\]]|\](?=[^\[\]]*\]))*'
 
 
 class QuotedPostBlockGrammar(BlockGrammar):
-    quoted_post = QUOTED_POST_RE
-
-
-class QuotedPostBlockLexer(BlockLexer):
-    default_rules = ['quoted_post'] + BlockLexer.default_rules
-
-    def __init__(self, rules=None, **kwargs):
-        if rules is None:
-            rules = QuotedPostBlockGrammar()
-        super().__init__(rules=rules, **kwargs)
-
-    def parse_quoted_post(self, m):
-        post = m.group(1)
-        # author, post_id = post.split('|')
-        self.tokens.append({
-            'type': 'quoted_post',
-            'author': m.group(1),
-            'post_id': m.group(2),
-            'text': m.group(3),
-        })
+    # `(\S.*\|.*)` backtracks quadratically on long lines with many `|`, such as runs of quote headers
+    nptable = re.compile(
+        r'^ *(\S[^\n|]*\|[^\n]*)\n *([-:]+ *\|[-| :]*)\n((?:[^\n|]*\|[^\n]*(?:\n|$))*)\n*'
+    )
 
 
 class QuotedPostInlineGrammar(InlineGrammar):
-    quoted_post = QUOTED_POST_RE
-    text = re.compile(r'^[\s\S]+?(?=[\\<!\[_*`~]|https?://| {2,}\n|$)')
-
-
-class QuotedPostInlineLexer(InlineLexer):
-    default_rules = ['quoted_post'] + InlineLexer.default_rules
-
-    def __init__(self, renderer, rules=None, **kwargs):
-        if rules is None:
-            rules = QuotedPostInlineGrammar()
-        super().__init__(renderer=renderer, rules=rules, **kwargs)
-
-    def output_quoted_post(self, m):
-        # post = m.group(1)
-        # author, post_id = post.split('|')
-        return self.renderer.quoted_post(m.group(1), m.group(2), m.group(3))
+    # The mistune rules, except that they stop at the next bracket or `<`, which every `<<<[[` brings
+    autolink = re.compile(r'^<([^ <>@:]+(@|:)[^ <>]+)>')
+    link = re.compile(
+        r'^!?\[(' + LINK_TEXT + r')\]\('
+        r'''\s*(<)?([\s\S]*?)(?(2)>)(?:\s+['"]([\s\S]*?)['"])?\s*'''
+        r'\)'
+    )
+    reflink = re.compile(r'^!?\[(' + LINK_TEXT + r')\]\s*\[([^^\[\]]*)\]')
+    nolink = re.compile(r'^!?\[((?:\[[^\[\]]*\]|[^\[\]])*)\]')
 
 
 class MarkdownWithQuotedPost(Markdown):
+    """
+    Markdown with `<<<[[Author|PostID]] ... <<<` quotes. The quotes are found by `scan_quotes` before
+    the text between them is parsed as Markdown, and their content is rendered as inline Markdown.
+    Every segment is lexed before any is rendered, so that link definitions apply to the whole text.
+    The grammars keep the rendering time linear on texts made of quote markers.
+    """
+
     def __init__(self, renderer, **kwargs):
         if 'inline' not in kwargs:
-            kwargs['inline'] = QuotedPostInlineLexer
+            kwargs['inline'] = InlineLexer(renderer, rules=QuotedPostInlineGrammar())
         if 'block' not in kwargs:
-            kwargs['block'] = QuotedPostBlockLexer
+            kwargs['block'] = BlockLexer(QuotedPostBlockGrammar())
         super().__init__(renderer=renderer, **kwargs)
 
-    def output_quoted_post(self):
-        return self.renderer.quoted_post(self.token['author'], self.token['post_id'], self.token['text'])
+    def output(self, text, rules=None):
+        segments = []
+        for segment in scan_quotes(text):
+            if isinstance(segment, str):
+                # The block lexer appends to its tokens, which `Markdown.output` pops
+                self.block.tokens = []
+                segment = self.block(segment, rules)
+            segments.append(segment)
+        self.inline.setup(self.block.def_links, self.block.def_footnotes)
+
+        out = self.renderer.placeholder()
+        for segment in segments:
+            if isinstance(segment, QuotedPost):
+                out += self.render_quoted_post(segment)
+                continue
+            self.tokens = segment
+            self.tokens.reverse()
+            while self.pop():
+                out += self.tok()
+        return out
+
+    def render_quoted_post(self, quote):
+        content = ''.join(self.inline(segment) if isinstance(segment, str) else self.render_quoted_post(segment)
+                          for segment in quote.segments)
+        return self.renderer.quoted_post(escape(quote.author), quote.post_id, content)
 
 
 class HighlighterRenderer(Renderer):
-    def quoted_post(self, author_name, post_href, post_content):
-        return '<blockquote><a href="%s">%s</a><br>%s</blockquote>' % (post_href, author_name, post_content)
+    def quoted_post(self, author_name, post_id, post_content):
+        # The link is pointed to the permalink of the quoted votable when the page is shown (see `resolve_quote_links`)
+        post_id = escape(post_id, quote=True)
+        return '<blockquote><a class="quote-link" data-quote-id="%s" href="#%s">%s</a><br>%s</blockquote>' % (
+            post_id, post_id, author_name, post_content)
@@ -0,0 +1,49 @@
+import threading
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from commenting.engine import MarkdownEngine, get_engine
+from commenting.utils import render_html
+
+
+class TestMarkdownEngine(SimpleTestCase):
+
+    def setUp(self) -> None:
+        self.engine = MarkdownEngine(cache_size=2)
+
+    def test_renders_quoted_post(self):
+        md = "<<<[[puskin|23]]There's hope bro. Stay put.<<<"
+        html = ("<blockquote><a class=\"quote-link\" data-quote-id=\"23\" href=\"#23\">puskin</a><br>"
+                "There's hope bro. Stay put.</blockquote>")
+        self.assertEquals(self.engine.render(md), html)
+        self.assertEquals(self.engine.render(md), html)
+
+    def test_identical_text_is_rendered_once(self):
+        with mock.patch.object(MarkdownEngine, 'build_markdown') as build_markdown:
+            build_markdown.return_value.side_effect = lambda text: f'<p>{text}</p>'
+            self.assertEquals(self.engine.render('a'), '<p>a</p>')
+            self.assertEquals(self.engine.render('a'), '<p>a</p>')
+            build_markdown.assert_called_once()
+            build_markdown.return_value.assert_called_once_with('a')
+
+    def test_cache_is_bounded_lru(self):
+        for text in ('a', 'b', 'a', 'c'):
+            self.engine.render(text)
+        self.assertEquals(len(self.engine._cache), 2)
+        self.assertIn(MarkdownEngine.cache_key('a'), self.engine._cache)
+        self.assertNotIn(MarkdownEngine.cache_key('b'), self.engine._cache)
+
+    def test_each_thread_has_its_own_renderer(self):
+        renderers = [self.engine.markdown]
+        thread = threading.Thread(target=lambda: renderers.append(self.engine.markdown))
+        thread.start()
+        thread.join()
+        self.assertIs(self.engine.markdown, renderers[0])
+        self.assertIsNot(renderers[0], renderers[1])
+
+    @override_settings(MARKDOWN_RENDER_CACHE_SIZE=0)
+    def test_render_html_without_cache(self):
+        self.assertEquals(get_engine().cache_size, 0)
+        self.assertEquals(render_html('**a**'), render_html('**a**'))
+        self.assertFalse(get_engine()._cache)
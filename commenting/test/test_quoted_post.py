@@ -1,6 +1,8 @@
 from django.test import TestCase
 
-from commenting.quoted_post import MarkdownWithQuotedPost, HighlighterRenderer
+from commenting.bench_render import ADVERSARIAL_INPUTS, regex_calls
+from commenting.quoted_post import (MAX_QUOTE_DEPTH, HighlighterRenderer, MarkdownWithQuotedPost, QuotedPost,
+                                    quoted_ids, resolve_quote_links, scan_quotes)
 
 
 class TestQuotedPostRendering(TestCase):
@@ -10,5 +12,66 @@ class TestQuotedPostRendering(TestCase):
 
     def test_quoted_post(self):
         md = "<<<[[puskin|23]]There's hope bro. Stay put.<<<"
-        html = "<blockquote><a href=\"23\">puskin</a><br>There's hope bro. Stay put.</blockquote>"
+        html = ("<blockquote><a class=\"quote-link\" data-quote-id=\"23\" href=\"#23\">puskin</a><br>"
+                "There's hope bro. Stay put.</blockquote>")
         self.assertEquals(self.renderer(md), html)
+
+    def test_quoted_ids(self):
+        md = "<<<[[puskin|a23]]Hope<<<\n\n<<< [[ada|B7x]]Hmm<<<\n<<<[[puskin|a23]]Again<<<"
+        self.assertEquals(quoted_ids(md), ['a23', 'B7x'])
+
+    def test_resolve_quote_links(self):
+        html = self.renderer("<<<[[puskin|a23]]Hope<<<")
+        resolved = resolve_quote_links(html, {'a23': '/~b/t1/slug/?page=1#a23'})
+        self.assertIn('data-quote-id="a23" href="/~b/t1/slug/?page=1#a23"', resolved)
+        self.assertEquals(resolve_quote_links(html, {}), html)
+
+    def test_nested_quotes(self):
+        md = "<<<[[ada|1]]Outer <<<[[bob|2]]inner<<< end<<<"
+        self.assertEquals(scan_quotes(md),
+                          [QuotedPost('ada', '1', ['Outer ', QuotedPost('bob', '2', ['inner']), ' end'])])
+        self.assertEquals(self.renderer(md).count('<blockquote>'), 2)
+
+    def test_quotes_deeper_than_limit_are_text(self):
+        depth = MAX_QUOTE_DEPTH + 2
+        html = self.renderer("<<<[[ada|1]]" * depth + "deep" + "<<<" * depth)
+        self.assertEquals(html.count('<blockquote>'), MAX_QUOTE_DEPTH)
+        self.assertIn('&lt;&lt;&lt;[[ada|1]]deep', html)
+
+    def test_unclosed_quotes_are_text(self):
+        self.assertEquals(scan_quotes("<<<[[ada|1]] a <<<[[bob|2]] b <<< c"),
+                          ["<<<[[ada|1]] a ", QuotedPost('bob', '2', [' b ']), ' c'])
+        self.assertEquals(scan_quotes("a <<< b"), ["a <<< b"])
+
+    def test_quoted_content_is_inline_markdown(self):
+        html = self.renderer("<<<[[ada|1]]*Really* [now](http://example.com)<<<")
+        self.assertIn('<br><em>Really</em> <a href="http://example.com">now</a></blockquote>', html)
+
+    def test_tables_and_links(self):
+        self.assertIn('<td>2</td>', self.renderer("a|b\n-|-\n1|2\n"))
+        html = self.renderer("[x] [a [b]](http://e.com) <http://e.com> [r][x]\n\n[x]: http://x.com")
+        self.assertIn('<a href="http://e.com">a [b]</a>', html)
+        self.assertIn('<a href="http://e.com">http://e.com</a>', html)
+        self.assertIn('<a href="http://x.com">r</a>', html)
+
+    def test_link_definitions_apply_across_quotes(self):
+        html = self.renderer("<<<[[ada|1]][r][x]<<<\n\n[x]: http://x.com\n\n[s][x]")
+        self.assertIn('<br><a href="http://x.com">r</a></blockquote>', html)
+        self.assertIn('<p><a href="http://x.com">s</a></p>', html)
+
+    def test_markers_in_code_are_text(self):
+        self.assertEquals(scan_quotes("a `<<<[[ada|1]] b` c <<<"), ["a `<<<[[ada|1]] b` c <<<"])
+        self.assertEquals(scan_quotes("```\n<<<[[ada|1]] a\n```\n<<<[[bob|2]]b<<<"),
+                          ["```\n<<<[[ada|1]] a\n```\n", QuotedPost('bob', '2', ['b'])])
+        self.assertEquals(scan_quotes("<<<[[ada|1]] `<<<` a<<<"), [QuotedPost('ada', '1', [' `<<<` a'])])
+        # Backticks that close nothing and unclosed fences do not start code
+        self.assertEquals(scan_quotes("` ```\n<<<[[ada|1]]a<<<"), ["` ```\n", QuotedPost('ada', '1', ['a'])])
+        self.assertIn('<pre><code>&lt;&lt;&lt;[[ada|1]] a\n</code></pre>', self.renderer("```\n<<<[[ada|1]] a\n```"))
+
+    def test_adversarial_inputs_render_in_linear_time(self):
+        for name, generate in ADVERSARIAL_INPUTS.items():
+            with self.subTest(name):
+                small = regex_calls(self.renderer, generate(4 * 1024))
+                large = regex_calls(self.renderer, generate(32 * 1024))
+                # Linear rendering makes about the same regex calls per KB at every size, quadratic 8 times more
+                self.assertLess(large, 9 * small)
@@ -1,13 +1,12 @@
 import re
 
-from commenting.quoted_post import MarkdownWithQuotedPost, HighlighterRenderer
+from commenting.engine import get_engine
 
 IMG_REGEX = re.compile('!\[.*?\]\([A-Za-z0-9_\-.]+\)')
 
 
 def render_html(text):
-    markdown_renderer = MarkdownWithQuotedPost(renderer=HighlighterRenderer())
-    return markdown_renderer(text)
+    return get_engine().render(text)
 
 
 def clean_quoted_content(content: str):
@@ -16,4 +15,4 @@ def clean_quoted_content(content: str):
 
 # TODO.... remove image and videos from content
 def quote_votable(votable):
-    return f'<<<[[{votable.author}|{votable.id}]]\n{clean_quoted_content(votable.content)}<<<\n'
+    return f'<<<[[{votable.author}|{votable.public_id}]]\n{clean_quoted_content(votable.content)}<<<\n'
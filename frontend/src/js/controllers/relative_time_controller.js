@@ -0,0 +1,34 @@
+import {Controller} from "stimulus";
+
+const Utils = require('../utils');
+
+const DATETIME = 'datetime';
+
+/**
+ * Shows the ISO time of a <time> element as "5 minutes ago", so that the rendered page does not change with
+ * the clock and can be cached (see main/page_cache.py). The server renders the absolute time for readers
+ * without JavaScript.
+ */
+export default class extends Controller {
+
+    connect() {
+        // Pages restored from the Turbolinks cache already have the relative time
+        if (!this.element.hasAttribute('title')) {
+            this.element.setAttribute('title', this.element.textContent.trim());
+        }
+        this.update();
+    }
+
+    disconnect() {
+        clearTimeout(this.timeout);
+    }
+
+    update() {
+        const date = new Date(this.element.getAttribute(DATETIME));
+        this.element.textContent = Utils.timeAgo(date);
+        // Seconds are shown for the first minute only
+        const delay = Date.now() - date < 60 * 1000 ? 1000 : 60 * 1000;
+        this.timeout = setTimeout(() => this.update(), delay);
+    }
+
+}
@@ -26,6 +26,11 @@ export default class extends Controller {
         this.followTarget.innerHTML = is_following_topic? 'Unfollow': 'Follow';
     }
 
+    hydrate(isFollowed) {
+        // Follow state of the user on a page shared by every user, see the viewer-state controller
+        this.isFollowing = isFollowed;
+    }
+
     follow() {
         const toFollow = !this.isFollowing;
 
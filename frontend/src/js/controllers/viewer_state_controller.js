@@ -0,0 +1,42 @@
+import {Controller} from "stimulus";
+
+const DATA_VIEWER_STATE_URL = 'data-viewer-state-url';
+const DATA_ITEM_CLASS = 'data-item-class';
+const DATA_ITEM_ID = 'data-item-id';
+const VOTABLE_SELECTOR = '[data-controller~="votable"]';
+const TOPIC_SELECTOR = '[data-controller~="topic"]';
+
+/**
+ * Fetches the votes and follows of the user on a page shared by every user (see main/page_cache.py),
+ * and hands them to the votable and topic controllers of the page.
+ */
+export default class extends Controller {
+
+    connect() {
+        const votables = Array.from(document.querySelectorAll(VOTABLE_SELECTOR));
+        const ids = {topic: [], post: []};
+        votables.forEach(element => ids[element.getAttribute(DATA_ITEM_CLASS)].push(element.getAttribute(DATA_ITEM_ID)));
+        const params = new URLSearchParams({topics: ids.topic.join(','), posts: ids.post.join(',')});
+
+        fetch(`${this.element.getAttribute(DATA_VIEWER_STATE_URL)}?${params}`, {credentials: 'same-origin'})
+            .then(response => response.ok ? response.json() : null)
+            .then(state => {
+                if (!state) {
+                    return;
+                }
+                votables.forEach(element => {
+                    const votable = this.application.getControllerForElementAndIdentifier(element, 'votable');
+                    if (votable) {
+                        votable.hydrate(state.votes[votable.item], state.username);
+                    }
+                });
+                document.querySelectorAll(TOPIC_SELECTOR).forEach(element => {
+                    const topic = this.application.getControllerForElementAndIdentifier(element, 'topic');
+                    if (topic) {
+                        topic.hydrate(state.followed_topics.includes(topic.topicId));
+                    }
+                });
+            });
+    }
+
+}
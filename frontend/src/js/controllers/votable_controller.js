@@ -21,13 +21,14 @@ const DATA_ITEM_LIKE_COUNT = 'data-item-like-count';
 const DATA_ITEM_DISLIKE_COUNT = 'data-item-dislike-count';
 const DATA_ITEM_SHARE_COUNT = 'data-item-share-count';
 const DATA_ITEM_SHARED = 'data-item-shared';
+const DATA_ITEM_AUTHOR = 'data-item-author';
 
 const CHECKED_STATE_CLASS = 'btn-toggled';
 
 export default class extends Controller {
 
     static get targets() {
-        return ["like", "dislike", "share", "likeCount", "dislikeCount", "shareCount", "topic"];
+        return ["like", "dislike", "share", "likeCount", "dislikeCount", "shareCount", "topic", "modify"];
     }
 
     get vote_type() {
@@ -102,6 +103,20 @@ export default class extends Controller {
         }
     }
 
+    hydrate(vote, username) {
+        // State of the user on a page shared by every user, see the viewer-state controller
+        if (vote) {
+            this.vote_type = vote.vote_type;
+            this.updateDisplay(vote.vote_type);
+            // Not through the is_shared setter, which also counts the share
+            this.element.setAttribute(DATA_ITEM_SHARED, vote.is_shared ? '1' : '0');
+            this.shareTarget.classList.toggle(CHECKED_STATE_CLASS, vote.is_shared);
+        }
+        if (this.hasModifyTarget && this.element.getAttribute(DATA_ITEM_AUTHOR) === username) {
+            this.modifyTarget.hidden = false;
+        }
+    }
+
     vote(vote_type) {
         const headers = new Headers();
         headers.set('Content-type', 'application/json');
@@ -117,7 +132,15 @@ export default class extends Controller {
             method: 'POST',
             body: JSON.stringify(payload),
             headers: headers
-        });
+        }).then(response => response.ok ? response.json() : null)
+            .then(counters => {
+                // Reconcile optimistic counts with the totals returned by the server
+                if (counters) {
+                    this.likeCount = counters.likes;
+                    this.dislikeCount = counters.dislikes;
+                    this.shareCount = counters.shares;
+                }
+            });
     }
 
     like() {
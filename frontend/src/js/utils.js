@@ -22,4 +22,21 @@ export function getFileSize(number) {
     } else if (number >= 1048576) {
         return (number / 1048576).toFixed(1) + 'MB';
     }
-}
\ No newline at end of file
+}
+
+function pluralize(count, unit) {
+    return `${count} ${unit}${count === 1 ? '' : 's'} ago`;
+}
+
+// Same wording as Votable.how_long_ago
+export function timeAgo(date, now = new Date()) {
+    const seconds = Math.max(Math.floor((now - date) / 1000), 0);
+    if (seconds < 60) {
+        return pluralize(seconds, 'second');
+    } else if (seconds < 3600) {
+        return pluralize(Math.floor(seconds / 60), 'minute');
+    } else if (seconds < 86400) {
+        return pluralize(Math.floor(seconds / 3600), 'hour');
+    }
+    return pluralize(Math.floor(seconds / 86400), 'day');
+}
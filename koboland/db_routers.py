@@ -0,0 +1,90 @@
+from operator import attrgetter
+
+from django.conf import settings
+
+from .helpers import get_id_generator
+
+
+def shard_database(shard):
+    """
+    Returns the alias of the database holding the logical shard `shard`. The logical shards are split in
+    contiguous ranges over settings.SHARD_DATABASES, so that adding databases only moves whole shards.
+    """
+    databases = getattr(settings, 'SHARD_DATABASES', None) or ['default']
+    return databases[shard * len(databases) // get_id_generator().shard_count]
+
+
+def shard_databases():
+    """ Returns the aliases of the databases holding the logical shards, without duplicates. """
+    return list(dict.fromkeys(getattr(settings, 'SHARD_DATABASES', None) or ['default']))
+
+
+def id_database(id_):
+    """ Returns the alias of the database holding the row with the `make_id` id `id_`. """
+    return shard_database(get_id_generator().shard_of(int(id_)))
+
+
+class ShardedResults:
+    """
+    The rows of an ordered queryset of a sharded model on every shard database, for the listings across
+    boards, sliced by Django's `Paginator` or a `KeysetPaginator`. A slice reads the rows up to its end
+    from every database and merges them, so deep numbered pages read more rows than they show.
+    """
+    ordered = True
+
+    def __init__(self, queryset):
+        self.queryset = queryset
+
+    def count(self):
+        return sum(self.queryset.using(database).count() for database in shard_databases())
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+        rows = [row for database in shard_databases() for row in self.queryset.using(database)[:key.stop]]
+        # Sorted on each field of the ordering from the last one, as sorts are stable
+        for name in reversed(self.queryset.query.order_by):
+            rows.sort(key=attrgetter(name.lstrip('-')), reverse=name.startswith('-'))
+        return rows[key]
+
+
+def across_shards(queryset):
+    """
+    Returns `queryset`, or its `ShardedResults` if its rows are spread over several databases: the query
+    of a sharded model that neither picked a database nor follows the relation of a row.
+    """
+    if (not getattr(queryset.model, 'SHARDED', False) or queryset._db or 'instance' in queryset._hints
+            or len(shard_databases()) == 1):
+        return queryset
+    return ShardedResults(queryset)
+
+
+class ShardRouter:
+    """
+    Sends the rows of models with `SHARDED = True` to the database of their logical shard, given by the
+    `get_shard` method of the instance Django passes as a hint: the row being saved or deleted, or the row
+    whose relation is followed, e.g. the board of `board.topics`. Other queries use the default database,
+    unless they pick one like `ShardedQuerySet.on_shard_of` does from the shard bits of an id, or read
+    every shard database like `across_shards`.
+
+    The rows of the other models, like users and boards, are read from the default database, and every shard
+    database needs a copy of them, kept up to date by replication, for its foreign keys. The follows of a
+    topic, in the table of `User.topics_following`, are stored with the topic.
+    """
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        if not getattr(model, 'SHARDED', False) or not hasattr(instance, 'get_shard'):
+            return None
+        shard = instance.get_shard()
+        return None if shard is None else shard_database(shard)
+
+    db_for_write = db_for_read
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if not getattr(obj1, 'SHARDED', False) or not getattr(obj2, 'SHARDED', False):
+            return True
+        return None
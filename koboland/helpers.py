@@ -1,11 +1,17 @@
 import datetime
 import os
 import random
+import string
+import threading
 import time
+import zlib
 from binascii import hexlify
 
 START_TIME = int(datetime.datetime(year=2019, month=6, day=22, hour=2, minute=35, second=49).timestamp())
 
+# In ASCII order, so that fixed-width encodings sort like the numbers they encode
+BASE62_ALPHABET = string.digits + string.ascii_uppercase + string.ascii_lowercase
+
 
 def create_hash():
     return str(hexlify(os.urandom(16)), 'ascii')
@@ -15,17 +21,274 @@ def time_stamp():
     return int(round(time.time()))
 
 
-def make_id():
+# An id is the milliseconds since START_TIME followed by ID_LOW_BITS bits. `make_id` splits these between the
+# logical shard (settings.ID_SHARD_BITS), the worker id (settings.ID_WORKER_BITS) and a per-process sequence.
+ID_LOW_BITS = 23
+
+
+class IdGenerator:
+    """
+    Makes ids unique across processes and nodes without checking the database, in the manner of
+    Twitter's Snowflake: the low bits of an id are the logical shard of its row, the worker id of the
+    process, then a sequence counting the ids it made in the same millisecond. A process never goes back
+    in time, so the ids it makes increase even if the clock is set back, and the time of an id is moved to
+    the next millisecond once the sequence runs out.
+
+    Each process making ids needs its own worker id, below 2 ** `worker_bits`: `worker_id`, or the one
+    returned by `claim_worker(worker_bits, worker_id)` when the process makes its first id, which must
+    not be held by another process (see `claim_worker_id`). A process forked after making ids claims
+    its own, or fails without `claim_worker`. The shard bits play no part in this, so `with_shard` can
+    change them.
+    """
+
+    def __init__(self, worker_bits=10, worker_id=None, shard_bits=0, claim_worker=None):
+        if worker_bits < 0 or shard_bits < 0 or worker_bits + shard_bits > ID_LOW_BITS:
+            raise ValueError(f'worker_bits and shard_bits must not be negative and add up to at most {ID_LOW_BITS}')
+        if worker_id is None and claim_worker is None:
+            raise ValueError('worker_id or claim_worker is required')
+        if worker_id is not None and not 0 <= worker_id < 1 << worker_bits:
+            raise ValueError(f'worker_id must be below {1 << worker_bits}')
+        self.shard_bits = shard_bits
+        self.worker_bits = worker_bits
+        self.sequence_bits = ID_LOW_BITS - shard_bits - worker_bits
+        self.worker_id = worker_id
+        self.claim_worker = claim_worker
+        self._lock = threading.Lock()
+        self._pid = None
+        self._worker = self._last = self._sequence = 0
+
+    def __call__(self, shard=0):
+        now = max(int(time.time() * 1000) - START_TIME * 1000, 0)
+        with self._lock:
+            if self._pid != os.getpid():
+                # First id of the process, or of a child forked after the parent made ids
+                if self.claim_worker is not None:
+                    self._worker = self.claim_worker(self.worker_bits, self.worker_id)
+                elif self._pid is None:
+                    self._worker = self.worker_id
+                else:
+                    raise RuntimeError(f'Worker id {self.worker_id} is already used by the parent process')
+                self._pid = os.getpid()
+                self._last, self._sequence = now, -1
+            if now > self._last:
+                self._last, self._sequence = now, 0
+            else:
+                self._sequence += 1
+                if self._sequence >> self.sequence_bits:
+                    self._last, self._sequence = self._last + 1, 0
+            id_ = (self._last << ID_LOW_BITS) | (self._worker << self.sequence_bits) | self._sequence
+        return self.with_shard(id_, shard)
+
+    @property
+    def shard_count(self):
+        return 1 << self.shard_bits
+
+    def shard_of(self, id_):
+        """ Returns the logical shard of the id `id_`. """
+        return (id_ >> (ID_LOW_BITS - self.shard_bits)) & (self.shard_count - 1)
+
+    def with_shard(self, id_, shard):
+        """ Returns the id `id_` moved to the logical shard `shard`. """
+        if not 0 <= shard < self.shard_count:
+            raise ValueError(f'shard must be below {self.shard_count}')
+        shift = ID_LOW_BITS - self.shard_bits
+        return (id_ & ~((self.shard_count - 1) << shift)) | (shard << shift)
+
+
+# Key space of the advisory locks by which processes hold their worker id, and the connections holding them, with
+# the pid of the process that opened each
+WORKER_LOCK_SPACE = zlib.crc32(b'koboland.helpers.IdGenerator') >> 1
+_worker_locks = []
+
+
+def abandon_connection(connection):
+    """
+    Drops a psycopg2 `connection` inherited from the parent process without ending its session, which
+    closing it normally would tell the server to do, along with the locks the parent holds in it.
+    """
+    if connection.closed:
+        return
+    # The socket is swapped for /dev/null, which gets the goodbye of the connection instead of the server
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, connection.fileno())
+    os.close(devnull)
+    connection.close()
+
+
+def release_inherited_worker_locks():
+    """ Drops, in a forked child, the connections holding the worker ids of the parent. """
+    pid = os.getpid()
+    for owner, connection in _worker_locks:
+        if owner != pid:
+            abandon_connection(connection)
+    _worker_locks[:] = [(owner, connection) for owner, connection in _worker_locks if owner == pid]
+
+
+# Connections of the thread for `side_connection`, keyed by database alias, with the pid that opened them
+_side_connections = threading.local()
+
+
+def side_connection(alias, lock_timeout):
+    """
+    Returns a PostgreSQL connection of the calling thread to the database `alias`, in autocommit mode and
+    apart from the one of Django, for the statements that must not last as long as the transaction of the
+    thread. Waiting for a lock fails after `lock_timeout` milliseconds. A forked child opens its own.
+    """
+    from django.db import connections
+    if getattr(_side_connections, 'pid', None) != os.getpid():
+        release_side_connections()
+    connection = _side_connections.by_alias.get(alias)
+    if connection is None or connection.closed:
+        database = connections[alias]
+        connection = database.get_new_connection(database.get_connection_params())
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute('SET lock_timeout = %s', [lock_timeout])
+        _side_connections.by_alias[alias] = connection
+    return connection
+
+
+def release_side_connections():
+    """ Drops, in a forked child, the side connections the forking thread of the parent opened. """
+    for connection in getattr(_side_connections, 'by_alias', {}).values():
+        abandon_connection(connection)
+    _side_connections.pid, _side_connections.by_alias = os.getpid(), {}
+
+
+def close_side_connections():
+    """ Closes the side connections of the calling thread. """
+    for connection in getattr(_side_connections, 'by_alias', {}).values():
+        connection.close()
+    _side_connections.by_alias = {}
+
+
+def _after_fork_in_child():
+    release_inherited_worker_locks()
+    if getattr(_side_connections, 'pid', None) is not None:
+        release_side_connections()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def claim_worker_id(worker_bits, worker_id=None):
+    """
+    Returns the worker id of the process: `worker_id`, or the lowest one below 2 ** `worker_bits` that
+    no running process holds. The process holds it with a PostgreSQL advisory lock, on a connection of
+    its own to the `postgres` database of the default database server, kept open until the process
+    exits. A forked child claims its own, and leaves the connection of its parent alone. Raises
+    ImproperlyConfigured if `worker_id` is held by another process, or every worker id is. With other
+    databases, every process needs its own `worker_id`.
+    """
+    release_inherited_worker_locks()
+    from django.core.exceptions import ImproperlyConfigured
+    from django.db import connections
+    database = connections['default']
+    if database.vendor != 'postgresql':
+        if worker_id is None:
+            raise ImproperlyConfigured(f'ID_WORKER_ID is required with a {database.vendor} default database')
+        return worker_id
+
+    # Not the database itself, whose name changes in tests and which can not be dropped while locks are held
+    connection = database.get_new_connection(dict(database.get_connection_params(), database='postgres'))
+    connection.autocommit = True
+    first, last = (0, (1 << worker_bits) - 1) if worker_id is None else (worker_id, worker_id)
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT worker FROM generate_series(%s, %s) AS worker '
+                       'WHERE pg_try_advisory_lock(%s, worker) LIMIT 1', [first, last, WORKER_LOCK_SPACE])
+        row = cursor.fetchone()
+    if row is None:
+        connection.close()
+        if worker_id is None:
+            raise ImproperlyConfigured(f'All the {1 << worker_bits} worker ids are held, raise ID_WORKER_BITS')
+        raise ImproperlyConfigured(f'ID_WORKER_ID {worker_id} is held by another process')
+    _worker_locks.append((os.getpid(), connection))
+    return row[0]
+
+
+_generator = None
+
+
+def get_id_generator():
+    """ Returns the IdGenerator of the process, set up by settings.ID_SHARD_BITS, ID_WORKER_BITS and ID_WORKER_ID. """
+    global _generator
+    if _generator is None:
+        from django.conf import settings
+        _generator = IdGenerator(getattr(settings, 'ID_WORKER_BITS', 10), getattr(settings, 'ID_WORKER_ID', None),
+                                 getattr(settings, 'ID_SHARD_BITS', 0), claim_worker=claim_worker_id)
+    return _generator
+
+
+def make_id(shard=0):
     """
     Inspired by http://instagram-engineering.tumblr.com/post/10853187575/sharding-ids-at-instagram
     https://stackoverflow.com/questions/37558821/how-to-replace-djangos-primary-key-with-a-different-integer-that-is-unique-for
+
+    Returns a new id of the logical shard `shard`, see IdGenerator.
     """
-    t = int(time.time() * 1000) - START_TIME
-    u = random.SystemRandom().getrandbits(23)
-    id_ = (t << 23) | u
-    return id_
+    return get_id_generator()(shard)
+
+
+def shard_of(id_):
+    """ Returns the logical shard of a `make_id` id. """
+    return get_id_generator().shard_of(id_)
+
+
+def with_shard(id_, shard):
+    """ Returns the `make_id` id `id_` moved to the logical shard `shard`. """
+    return get_id_generator().with_shard(id_, shard)
+
+
+def key_shard(key):
+    """ Returns the logical shard of the rows grouped under the string `key`, e.g. the name of their board. """
+    return zlib.crc32(key.encode()) % get_id_generator().shard_count
+
+
+def make_id_at(timestamp):
+    """
+    Returns an id made of the milliseconds from START_TIME to `timestamp` (in seconds) followed by
+    random bits, so that ids sort by creation time. Times before START_TIME get the first millisecond.
+    Meant for rows created at a past time, as ids from the same millisecond may collide.
+    """
+    t = max(int(timestamp * 1000) - START_TIME * 1000, 0)
+    u = random.SystemRandom().getrandbits(ID_LOW_BITS)
+    return (t << ID_LOW_BITS) | u
 
 
 def reverse_id(id_):
-    t = id_ >> 23
-    return t + START_TIME
+    """ Returns the creation time of the `make_id` id `id_`, in seconds. """
+    t = id_ >> ID_LOW_BITS
+    return t / 1000 + START_TIME
+
+
+def id_range(start=None, end=None):
+    """
+    Returns the bounds (`low`, `high`) of the ids created from `start` included to `end` excluded,
+    aware datetimes or None for no bound: `low <= id < high`. `reverse_id` gives these times back.
+    """
+    def first_id(moment):
+        return max(int(moment.timestamp() * 1000) - START_TIME * 1000, 0) << ID_LOW_BITS
+    return (None if start is None else first_id(start)), (None if end is None else first_id(end))
+
+
+def to_base62(number, length=0):
+    """ Encodes a non-negative integer in base 62, left-padded with '0' to `length` characters. """
+    digits = []
+    while number:
+        number, digit = divmod(number, 62)
+        digits.append(BASE62_ALPHABET[digit])
+    return ''.join(reversed(digits)).rjust(length, BASE62_ALPHABET[0])
+
+
+def from_base62(text):
+    """ Decodes a `to_base62` string, raising ValueError if it is not one. """
+    if not text:
+        raise ValueError('Empty base62 string')
+    number = 0
+    for char in text:
+        digit = BASE62_ALPHABET.find(char)
+        if digit < 0:
+            raise ValueError(f'Invalid base62 string `{text}`')
+        number = number * 62 + digit
+    return number
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/2.2/ref/settings/
 """
 
 import os
+import sys
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -89,6 +90,8 @@ DATABASES = {
     }
 }
 
+DATABASE_ROUTERS = ['koboland.db_routers.ShardRouter']
+
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
 
@@ -140,6 +143,60 @@ LOGOUT_REDIRECT_URL = '/'
 
 VOTABLE_PAGE_SIZE = 30
 
+# Number of rendered Markdown texts cached by each process (see commenting/engine.py), 0 to disable
+MARKDOWN_RENDER_CACHE_SIZE = 1024
+
+# 'sync' renders content_html in Votable.save. 'async' waits at most MARKDOWN_RENDER_BUDGET seconds for one of the
+# MARKDOWN_RENDER_WORKERS background threads, and otherwise saves it as stale, to be stored by the worker or by
+# the first reader
+CONTENT_HTML_RENDERING = 'sync'
+MARKDOWN_RENDER_BUDGET = 0.05
+MARKDOWN_RENDER_WORKERS = 2
+
+# Seconds the topic and board pages of logged out readers are cached (see main/page_cache.py), 0 to disable. Pages
+# whose vote or post counters changed are served for at most PAGE_CACHE_COUNTER_STALENESS seconds after rendering,
+# which is also how long the ETags of pages whose counters do not bump their version last (see main/conditional.py).
+PAGE_CACHE_TIMEOUT = 0
+PAGE_CACHE_COUNTER_STALENESS = 10
+# Must be a cache shared by every process serving the pages (see main/checks.py), unlike the default local memory
+# cache. E.g. with the django-redis package, on the Redis of CHANNEL_LAYERS, and PAGE_CACHE_ALIAS = 'pages':
+# CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+#           'pages': {'BACKEND': 'django_redis.cache.RedisCache', 'LOCATION': 'redis://127.0.0.1:6379/2'}}
+PAGE_CACHE_ALIAS = 'default'
+
+# Ids of topics and posts (see koboland/helpers.py): each process making them needs its own worker id, below
+# 2 ** ID_WORKER_BITS, for ids to be unique across processes and nodes. None takes the lowest one no running process
+# holds, and a process given an ID_WORKER_ID held by another fails. Both need a PostgreSQL default database.
+ID_WORKER_BITS = 10
+ID_WORKER_ID = None
+# Ids also carry the logical shard of their board, one of 2 ** ID_SHARD_BITS. The shards are split in contiguous
+# ranges over SHARD_DATABASES, each with the whole schema and a replica of the unsharded tables (see
+# koboland/db_routers.py).
+ID_SHARD_BITS = 6
+SHARD_DATABASES = ['default']
+# The shard databases missing from DATABASES are on the server of the default one, named after their alias
+for alias in SHARD_DATABASES:
+    DATABASES.setdefault(alias, dict(DATABASES['default'], NAME=f'koboland_{alias}'))
+# The tests of the shard databases (see main/test/test_models.py) also use a second test database
+if sys.argv[1:2] == ['test']:
+    DATABASES.setdefault('shard1', dict(DATABASES['default'], TEST={
+        'NAME': f"{DATABASES['default'].get('TEST', {}).get('NAME') or 'test_' + DATABASES['default']['NAME']}_shard1",
+    }))
+
+# Maximum number of votes accepted by a single request to the batch vote API
+VOTE_BATCH_LIMIT = 100
+
+# Write-behind buffer for vote counters (see main/counters.py): None, 'local' or 'redis'
+VOTE_COUNTER_BUFFER = None
+VOTE_COUNTER_BUFFER_REDIS_URL = 'redis://127.0.0.1:6379/1'
+VOTE_COUNTER_FLUSH_INTERVAL = 5
+
+# Number of counter rows per topic for post_count and last_post_at (see Topic.count_posts), 0 to write the topic row
+TOPIC_COUNTER_SHARDS = 0
+# Milliseconds a reply waits for the topic row outside of its transaction before updating it in the transaction
+# (see Topic.next_post_seq)
+POST_SEQ_LOCK_TIMEOUT = 100
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES':
         ('rest_framework.authentication.SessionAuthentication',
@@ -1,7 +1,9 @@
 import json
 
 from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
 from django.core.validators import ValidationError
+from django.db import IntegrityError
 from django.db.models import Manager
 from django.http import Http404, HttpResponseRedirect
 from django.utils.translation import gettext_lazy as _
@@ -12,7 +14,7 @@ from django.utils import timezone
 from rest_framework.views import APIView
 
 from main.validators import FileValidator, VoteRequestValidator
-from .models import Post, Topic, Vote, User, Board
+from .models import Post, Topic, Vote, User, Board, Votable
 from .serializers import TopicSerializer, PostSerializer
 
 
@@ -30,44 +32,126 @@ class VotableVoteAPI(APIView):
     UNSHARE = -2
 
     @classmethod
-    def get_object(cls, user, votable_type, votable_id):
-        try:
-            return Vote.objects.get_object(user, votable_type, votable_id)
-        except (Topic.DoesNotExist, Post.DoesNotExist, Vote.DoesNotExist) as e:
-            raise e
-
-    @classmethod
-    def create_object(cls, user, votable_type, votable_id, vote_type=None, is_shared=None):
-        try:
-            return Vote.objects.create_object(user, votable_type=votable_type, votable_id=votable_id,
-                                              vote_type=vote_type, is_shared=is_shared)
-        except Exception:
-            raise Http404
+    def to_model_vote(cls, vote_type):
+        """ Maps an API vote_type to a `Model-compatible` `(vote_type, is_shared)` pair """
+        if vote_type == cls.SHARE or vote_type == cls.UNSHARE:
+            return None, vote_type == cls.SHARE
+        return vote_type, None
 
     def post(self, request, format=None):
         request.data['voter'] = request.user.username
 
         # Map vote_type to `Model-compatible` representation
-        vote_type = request.data.get('vote_type')
-        is_shared = None
-        if vote_type == self.SHARE or vote_type == self.UNSHARE:
-            is_shared = vote_type == self.SHARE
-            vote_type = None
+        vote_type, is_shared = self.to_model_vote(request.data.get('vote_type'))
 
         # Process request
         try:
             self.validate_request(request.data)
-            vote = self.get_object(request.user, request.data['votable_type'], request.data['votable_id'])
-            vote.change_vote(vote_type, is_shared)
-        except Vote.DoesNotExist:
-            self.create_object(request.user, request.data['votable_type'], request.data['votable_id'],
-                               vote_type, is_shared)
+            votable_id = Votable.pk_from_public_id(request.data['votable_id'])
+            if votable_id is None:
+                raise ObjectDoesNotExist(request.data['votable_id'])
+            counters = Vote.objects.cast(request.user, request.data['votable_type'], votable_id, vote_type, is_shared)
+        except ObjectDoesNotExist:
+            raise Http404
         except ValidationError as e:
             return Response(status=status.HTTP_400_BAD_REQUEST, data={'error': str(e)})
         except Exception as e:
             return Response(status=status.HTTP_400_BAD_REQUEST, data={'error': str(e)})
 
-        return Response(status=status.HTTP_200_OK)
+        return Response(status=status.HTTP_200_OK, data=counters)
+
+
+class VotableVoteBatchAPI(VotableVoteAPI):
+    """
+    API
+    -----
+    * votes: a list of `{votable_type, votable_id, vote_type}` objects, applied in order
+      in a single transaction.
+
+    Responds with the vote state after each item (or its `error`) and the final counters
+    of every votable in the batch, keyed by votable_type and votable_id.
+    """
+    errors = {
+        'votes': _('`votes` must be a non-empty list'),
+        'not_found': _('votable not found'),
+        'many_votes': _(f'Not more than "{settings.VOTE_BATCH_LIMIT}" votes allowed'),
+        'conflict': _('The votes changed meanwhile, try again'),
+    }
+
+    def post(self, request, format=None):
+        items = request.data.get('votes')
+        if not isinstance(items, list) or len(items) == 0:
+            return Response(status=status.HTTP_400_BAD_REQUEST, data={'error': self.errors['votes']})
+        if len(items) > settings.VOTE_BATCH_LIMIT:
+            return Response(status=status.HTTP_400_BAD_REQUEST, data={'error': self.errors['many_votes']})
+
+        operations, errors = [], {}
+        for idx, item in enumerate(items):
+            try:
+                if not isinstance(item, dict):
+                    raise ValidationError('vote must be an object')
+                self.validate_request(dict(item, voter=request.user.username))
+            except ValidationError as e:
+                errors[idx] = {'error': e.messages[0]}
+                continue
+            votable_id = Votable.pk_from_public_id(item['votable_id'])
+            if votable_id is None:
+                errors[idx] = {'votable_type': item['votable_type'], 'votable_id': item['votable_id'],
+                               'error': self.errors['not_found']}
+                continue
+            vote_type, is_shared = self.to_model_vote(item['vote_type'])
+            operations.append({'votable_type': item['votable_type'], 'votable_id': votable_id,
+                               'vote_type': vote_type, 'is_shared': is_shared})
+
+        try:
+            applied, counters = Vote.objects.apply_batch(request.user, operations)
+        except IntegrityError:
+            # e.g. a votable deleted while the batch was applied
+            return Response(status=status.HTTP_409_CONFLICT, data={'error': self.errors['conflict']})
+        # Outside of the server, votables are known by their public ids
+        applied = iter([dict(result, votable_id=Votable.to_public_id(result['votable_id'])) for result in applied])
+        results = [errors[idx] if idx in errors else next(applied) for idx in range(len(items))]
+        counters = {votable_type: {Votable.to_public_id(pk): values for pk, values in votable_counters.items()}
+                    for votable_type, votable_counters in counters.items()}
+        return Response(status=status.HTTP_200_OK, data={'results': results, 'counters': counters})
+
+
+class ViewerStateAPI(APIView):
+    """
+    API
+    -----
+    GET with `topics` and `posts`, comma separated public ids of the votables of a page.
+
+    Responds with the state of the user on them, for the pages shared by every user in the page cache
+    (see `main.page_cache`):
+    * username
+    * votes: `{vote_type, is_shared}` by public id, for the votables the user voted on or shared
+    * followed_topics: the public ids of the topics the user follows
+    """
+    permission_classes = (IsAuthenticated,)
+    errors = {
+        'many_ids': _(f'Not more than "{settings.VOTE_BATCH_LIMIT}" ids allowed'),
+    }
+
+    def get(self, request, format=None):
+        public_ids = {model: [public_id for public_id in request.query_params.get(key, '').split(',') if public_id]
+                      for key, model in (('topics', Topic), ('posts', Post))}
+        if sum(map(len, public_ids.values())) > settings.VOTE_BATCH_LIMIT:
+            return Response(status=status.HTTP_400_BAD_REQUEST, data={'error': self.errors['many_ids']})
+        pks = {model: [pk for pk in map(Votable.pk_from_public_id, ids) if pk is not None]
+               for model, ids in public_ids.items()}
+
+        states = Vote.objects.get_viewer_states(request.user, pks)
+        votes = {Votable.to_public_id(pk): {'vote_type': vote_type, 'is_shared': is_shared}
+                 for (model, pk), (vote_type, is_shared) in states.items()}
+        # Follows are stored with their topic, see `User.topics_following`
+        followed = [pk for topics, topic_pks in Topic.objects.by_database(pks[Topic])
+                    for pk in topics.filter(pk__in=topic_pks, followers=request.user).values_list('pk', flat=True)]
+        return Response(status=status.HTTP_200_OK, data={
+            'username': request.user.username,
+            'votes': votes,
+            'followed_topics': [Votable.to_public_id(pk) for pk in followed],
+        })
 
 
 class PostCreateAPI(APIView):
@@ -141,7 +225,7 @@ class TopicCreateAPI(PostCreateAPI):
     def handle_extra_non_serialized_fields(self, submission, kwargs):
         follow = str(kwargs.get('follow_topic', False)).lower() == 'true'
         if follow:
-            self.request.user.topics_following.add(submission)
+            submission.followers.add(self.request.user)
             self.request.user.save()
 
 
@@ -194,23 +278,20 @@ class AbstractFollowAPI(APIView):
 
         if data[self.followable_key]:
             try:
-                kwargs = {self.primary_key: data[self.followable_key]}
+                kwargs = self.get_lookup(data[self.followable_key])
                 followable = manager.get(**kwargs)
-                follow_set = getattr(request.user, self.follow_set_key, None)
-
-                if follow_set is None:
-                    raise Exception(f'Illegal key `{self.follow_set_key}` on User object')
 
                 # Prevent User from following himself/herself
                 if isinstance(followable, User) and followable == request.user:
                     return Response({'errors': self.ERRORS['user']}, status=status.HTTP_400_BAD_REQUEST)
 
-                existing = follow_set.filter(**kwargs)
+                follow_set, member, lookup = self.get_follow_set(followable, kwargs)
+                existing = follow_set.filter(**lookup)
                 if len(existing) == 0 and data['follow']:
-                    follow_set.add(followable)
+                    follow_set.add(member)
                     return Response(status=status.HTTP_200_OK)
                 elif len(existing) == 1 and not data['follow']:
-                    follow_set.remove(followable)
+                    follow_set.remove(member)
                     return Response(status=status.HTTP_200_OK)
 
                 errors = self.ERRORS['following'] % self.followable_key
@@ -226,6 +307,20 @@ class AbstractFollowAPI(APIView):
             'You gotta implement this'
         )
 
+    def get_lookup(self, value):
+        """ Returns the lookup of the followable identified by `value` in the request """
+        return {self.primary_key: value}
+
+    def get_follow_set(self, followable, lookup):
+        """
+        Returns the Many-To-Many manager the follow is added to or removed from, the object added to it,
+        and the lookup of that object in it: by default `follow_set_key` of the user, and the followable.
+        """
+        follow_set = getattr(self.request.user, self.follow_set_key, None)
+        if follow_set is None:
+            raise Exception(f'Illegal key `{self.follow_set_key}` on User object')
+        return follow_set, followable, lookup
+
 
 class FollowTopicAPI(AbstractFollowAPI):
     queryset = Topic.objects.all()
@@ -237,6 +332,14 @@ class FollowTopicAPI(AbstractFollowAPI):
     def get_object_manager(cls) -> Manager:
         return Topic.objects
 
+    def get_lookup(self, value):
+        # Topics are identified by their public id
+        return {self.primary_key: Topic.pk_from_public_id(value)}
+
+    def get_follow_set(self, followable, lookup):
+        # Follows are stored with their topic, see `User.topics_following`
+        return followable.followers, self.request.user, {'pk': self.request.user.pk}
+
 
 class FollowUserAPI(AbstractFollowAPI):
     queryset = User.objects.all()
@@ -282,7 +385,7 @@ class PostUpdateAPI(APIView):
 
         # ID
         try:
-            votable = self.queryset.get(id=data['votable_id'])
+            votable = self.queryset.public(data['votable_id']).get()
         except (Post.DoesNotExist, KeyError) as e:
             return Response(status=status.HTTP_400_BAD_REQUEST, data=e.messages)
 
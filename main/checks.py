@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.cache import InvalidCacheBackendError, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.checks import Error, register
+
+
+@register()
+def check_page_cache(app_configs, **kwargs):
+    """
+    The page cache (see `main.page_cache`) drops stale pages by touching their tags in its cache, which
+    every process serving the pages must see: it needs a cache shared by them.
+    """
+    if getattr(settings, 'PAGE_CACHE_TIMEOUT', 0) <= 0:
+        return []
+    alias = getattr(settings, 'PAGE_CACHE_ALIAS', 'default')
+    try:
+        cache = caches[alias]
+    except InvalidCacheBackendError as e:
+        return [Error(f'PAGE_CACHE_ALIAS `{alias}` is not a usable cache: {e}', id='main.E001')]
+    if isinstance(cache, (LocMemCache, DummyCache)):
+        return [Error(f'PAGE_CACHE_TIMEOUT is set, but the `{alias}` cache of PAGE_CACHE_ALIAS is not shared by '
+                      f'the processes serving the pages',
+                      hint='Use a cache like Redis or Memcached, or set PAGE_CACHE_TIMEOUT = 0.', id='main.E002')]
+    return []
@@ -0,0 +1,69 @@
+"""
+Conditional GETs of the topic and board pages.
+
+`Topic.version` and `Board.version` are bumped when the content of their page changes: a post
+added, edited or removed bumps its topic (in the statement counting it, or in its counter shard
+with `TOPIC_COUNTER_SHARDS`), and a topic added or edited bumps its board once committed (see
+`Votable.get_changed_versions`).
+
+Counters change much more often, and do not write the versions on every vote or reply. Like the
+page cache, pages show counters that are at most `PAGE_CACHE_COUNTER_STALENESS` seconds old: the
+ETag of a page carries the period of that many seconds it was rendered in, unless its counters
+bump its version. Only the topic pages do, when the counter buffer (see `main.counters`) is
+flushed, so that a flush writes each topic once.
+
+Views using `ConditionalPageMixin` send the ETag on the pages that are the same for every reader,
+and answer a request whose If-None-Match has it with 304 Not Modified, after reading the version
+by primary key and before running the view. The version is read before the page, so a page is
+never tagged with a version older than what it shows.
+"""
+import time
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.utils.cache import get_conditional_response, patch_cache_control
+
+from . import page_cache
+from .counters import get_counter_buffer
+
+
+class ConditionalPageMixin:
+    """ Answers conditional GETs of the page versioned by `get_page_version`. """
+    # Whether the flushes of the counter buffer bump the version of the page
+    counters_bump_version = False
+
+    def get_page_version(self):
+        """ Returns the version of the page, or None if there is nothing to version it by. """
+        raise NotImplementedError
+
+    def get_counters_period(self):
+        """ Returns the staleness period of the counters of the page, or None if they bump its version. """
+        if self.counters_bump_version and get_counter_buffer() is not None:
+            return None
+        return int(time.time() // max(getattr(settings, 'PAGE_CACHE_COUNTER_STALENESS', 0), 1))
+
+    def is_shared_page(self, request):
+        """ Returns whether the page is the same for every reader, see `page_cache.PageCacheMixin`. """
+        if request.user.is_authenticated:
+            return getattr(self, 'cache_member_pages', False) and page_cache.is_cacheable(request, members=True)
+        return request.method == 'GET' and not len(get_messages(request))
+
+    def dispatch(self, request, *args, **kwargs):
+        if not self.is_shared_page(request):
+            return super().dispatch(request, *args, **kwargs)
+        version = self.get_page_version()
+        if version is None:
+            return super().dispatch(request, *args, **kwargs)
+        period = self.get_counters_period()
+        if period is not None:
+            version = f'{version}.{period}'
+        # Members get their own nav in the page
+        etag = f'"{version}-{request.user.pk or 0}"'
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = super().dispatch(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            # Browsers check the version before using the page they have
+            patch_cache_control(response, no_cache=True, private=request.user.is_authenticated)
+        return response
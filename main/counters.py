@@ -0,0 +1,233 @@
+"""
+Write-behind buffers for the `likes`, `dislikes` and `shares` counters of votables.
+
+When `VOTE_COUNTER_BUFFER` is set, the counter deltas of a vote are accumulated in a buffer
+instead of being written to the `Topic`/`Post` row right away (the `Vote` row itself is still
+saved synchronously). The deltas are periodically written in bulk by `flush_counter_buffer`,
+and reads merge the pending deltas so that a voter immediately sees their own vote counted.
+
+* 'local': a process-local buffer, flushed by a daemon thread of the process every
+  `VOTE_COUNTER_FLUSH_INTERVAL` seconds.
+* 'redis': a Redis hash per votable, shared by all processes and flushed by the
+  `flush_vote_counters` management command. Requires the `redis` package.
+
+With `TOPIC_COUNTER_SHARDS`, the `post_count` and `last_post_at` of topics are similarly kept in
+`TopicCounterShard` rows, merged on read and folded into `Topic` by the `fold_post_counters` command.
+"""
+import logging
+import threading
+import time
+from collections import defaultdict
+from functools import lru_cache
+
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db import close_old_connections, transaction
+from django.dispatch import receiver
+
+from koboland.db_routers import id_database
+
+logger = logging.getLogger(__name__)
+
+COUNTER_FIELDS = ('likes', 'dislikes', 'shares')
+
+
+class LocalCounterBuffer:
+    """ Accumulates counter deltas in the memory of the current process. """
+
+    def __init__(self, flush_interval=None):
+        self._lock = threading.Lock()
+        self._deltas = defaultdict(lambda: dict.fromkeys(COUNTER_FIELDS, 0))
+        self._flush_interval = flush_interval
+        self._flusher = None
+
+    def add(self, label, pk, deltas):
+        with self._lock:
+            pending = self._deltas[(label, str(pk))]
+            for field, delta in deltas.items():
+                pending[field] += delta
+        self._ensure_flusher()
+
+    def pending(self, label, pks):
+        with self._lock:
+            return {pk: dict(self._deltas[(label, str(pk))]) for pk in pks if (label, str(pk)) in self._deltas}
+
+    def drain(self):
+        """ Removes and returns every pending delta as a dict keyed by `(label, pk)`. """
+        with self._lock:
+            deltas, self._deltas = self._deltas, defaultdict(lambda: dict.fromkeys(COUNTER_FIELDS, 0))
+        return dict(deltas)
+
+    def _ensure_flusher(self):
+        if self._flush_interval is None or self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run_flusher, name='vote-counter-flusher', daemon=True)
+                self._flusher.start()
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(self._flush_interval)
+            try:
+                flush_counter_buffer(self)
+            except Exception:
+                logger.exception('Flushing vote counters failed')
+            finally:
+                close_old_connections()
+
+
+class RedisCounterBuffer:
+    """
+    Accumulates counter deltas in one Redis hash per votable (`HINCRBY`), and keeps the keys
+    with pending deltas in a set so that they can be drained by any process.
+    """
+
+    def __init__(self, url, prefix='votes:counters'):
+        try:
+            import redis
+        except ImportError:
+            raise ImproperlyConfigured('VOTE_COUNTER_BUFFER = "redis" requires the `redis` package')
+        self._redis = redis.Redis.from_url(url)
+        self._prefix = prefix
+        self._dirty_key = f'{prefix}:dirty'
+
+    def _key(self, label, pk):
+        return f'{self._prefix}:{label}:{pk}'
+
+    def add(self, label, pk, deltas):
+        key = self._key(label, pk)
+        pipe = self._redis.pipeline()
+        for field, delta in deltas.items():
+            if delta:
+                pipe.hincrby(key, field, delta)
+        pipe.sadd(self._dirty_key, key)
+        pipe.execute()
+
+    def pending(self, label, pks):
+        pipe = self._redis.pipeline(transaction=False)
+        for pk in pks:
+            pipe.hgetall(self._key(label, pk))
+        return {pk: self._decode(values) for pk, values in zip(pks, pipe.execute()) if values}
+
+    def drain(self, count=1000):
+        deltas = {}
+        keys = self._redis.spop(self._dirty_key, count)
+        while keys:
+            for key in keys:
+                # Read and delete atomically so that concurrent increments land in the next drain
+                pipe = self._redis.pipeline()
+                pipe.hgetall(key)
+                pipe.delete(key)
+                values, _ = pipe.execute()
+                if values:
+                    label, pk = key.decode()[len(self._prefix) + 1:].split(':', 1)
+                    deltas[(label, pk)] = self._decode(values)
+            keys = self._redis.spop(self._dirty_key, count)
+        return deltas
+
+    @staticmethod
+    def _decode(values):
+        deltas = dict.fromkeys(COUNTER_FIELDS, 0)
+        deltas.update({field.decode(): int(value) for field, value in values.items()})
+        return deltas
+
+
+@lru_cache(maxsize=None)
+def get_counter_buffer():
+    """ Returns the configured counter buffer, or None if counters are written through. """
+    backend = getattr(settings, 'VOTE_COUNTER_BUFFER', None)
+    if backend is None:
+        return None
+    if backend == 'local':
+        return LocalCounterBuffer(flush_interval=settings.VOTE_COUNTER_FLUSH_INTERVAL)
+    if backend == 'redis':
+        return RedisCounterBuffer(settings.VOTE_COUNTER_BUFFER_REDIS_URL)
+    raise ImproperlyConfigured(f'Unknown VOTE_COUNTER_BUFFER `{backend}`')
+
+
+@receiver(setting_changed)
+def reset_counter_buffer(setting, **kwargs):
+    if setting.startswith('VOTE_COUNTER_'):
+        get_counter_buffer.cache_clear()
+
+
+def merge_pending_counters(votables):
+    """ Adds the pending buffered deltas to the counters of already fetched votables. """
+    buffer = get_counter_buffer()
+    if buffer is None:
+        return votables
+    by_label = defaultdict(list)
+    for votable in votables:
+        by_label[votable._meta.label_lower].append(votable)
+    for label, items in by_label.items():
+        pending = buffer.pending(label, [item.pk for item in items])
+        for item in items:
+            if item.pk in pending:
+                for field, delta in pending[item.pk].items():
+                    setattr(item, field, getattr(item, field) + delta)
+                # Keep the merged counters out of the dirty fields so that a later save never writes them
+                item._store_loaded_values(COUNTER_FIELDS)
+    return votables
+
+
+def flush_counter_buffer(buffer=None):
+    """
+    Writes every pending delta of `buffer` to the database of its votable, in one transaction per
+    database, ordered by primary key to avoid deadlocks between concurrent flushers, and bumps the
+    versions of the topic pages showing them (see `main.conditional`). Returns the number of votables
+    updated. On failure, the drained deltas not written yet are put back into the buffer.
+    """
+    buffer = buffer or get_counter_buffer()
+    if buffer is None:
+        return 0
+    deltas = buffer.drain()
+    by_database = defaultdict(dict)
+    for (label, pk), votable_deltas in deltas.items():
+        by_database[id_database(pk)][(label, pk)] = votable_deltas
+    try:
+        for database in list(by_database):
+            with transaction.atomic(using=database):
+                pks = defaultdict(list)
+                for (label, pk), votable_deltas in sorted(by_database[database].items()):
+                    apps.get_model(label).objects.using(database).write_counter_deltas(pk, **votable_deltas)
+                    pks[label].append(pk)
+                for label, label_pks in pks.items():
+                    apps.get_model(label).bump_counter_versions(label_pks, database)
+            del by_database[database]
+    except Exception:
+        for database_deltas in by_database.values():
+            for (label, pk), votable_deltas in database_deltas.items():
+                buffer.add(label, pk, votable_deltas)
+        raise
+    return len(deltas)
+
+
+def merge_pending_post_counts(topics):
+    """ Adds the counts of the `TopicCounterShard` rows not folded yet to already fetched topics. """
+    if not getattr(settings, 'TOPIC_COUNTER_SHARDS', 0) or not topics:
+        return topics
+    pending = apps.get_model('main', 'TopicCounterShard').objects.pending([topic.pk for topic in topics])
+    for topic in topics:
+        if topic.pk in pending:
+            topic.post_count += pending[topic.pk]['post_count']
+            last_post_at = pending[topic.pk]['last_post_at']
+            if last_post_at and (topic.last_post_at is None or last_post_at > topic.last_post_at):
+                topic.last_post_at = last_post_at
+            topic._store_loaded_values(['post_count', 'last_post_at'])
+    return topics
+
+
+def fold_post_counter_shards():
+    """ Folds the `TopicCounterShard` rows of every topic into `Topic`, and returns the number of topics updated. """
+    TopicCounterShard = apps.get_model('main', 'TopicCounterShard')
+    folded = 0
+    for counter_shards in TopicCounterShard.objects.on_every_database():
+        topic_ids = (counter_shards.exclude(post_count=0, last_post_at=None)
+                     .order_by('topic').values_list('topic', flat=True).distinct())
+        for topic_id in topic_ids.iterator():
+            counter_shards.fold(topic_id)
+            folded += 1
+    return folded
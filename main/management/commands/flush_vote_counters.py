@@ -0,0 +1,28 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from main.counters import flush_counter_buffer, get_counter_buffer
+
+
+class Command(BaseCommand):
+    help = 'Periodically write the buffered vote counter deltas (VOTE_COUNTER_BUFFER) to the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=settings.VOTE_COUNTER_FLUSH_INTERVAL,
+                            help='Seconds between two flushes')
+        parser.add_argument('--once', action='store_true', help='Flush once and exit')
+
+    def handle(self, *args, **options):
+        buffer = get_counter_buffer()
+        if buffer is None:
+            self.stdout.write('VOTE_COUNTER_BUFFER is not set, vote counters are written through')
+            return
+
+        while True:
+            flushed = flush_counter_buffer(buffer)
+            self.stdout.write(f'Flushed counters of {flushed} votables')
+            if options['once']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,26 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from main.counters import fold_post_counter_shards
+
+
+class Command(BaseCommand):
+    help = 'Periodically fold the sharded topic post counters (TOPIC_COUNTER_SHARDS) into Topic.post_count'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=60, help='Seconds between two folds')
+        parser.add_argument('--once', action='store_true', help='Fold once and exit')
+
+    def handle(self, *args, **options):
+        if not settings.TOPIC_COUNTER_SHARDS:
+            # Shards left over from when it was set are still folded
+            self.stdout.write('TOPIC_COUNTER_SHARDS is not set, post counters are written to the topics')
+
+        while True:
+            folded = fold_post_counter_shards()
+            self.stdout.write(f'Folded post counters of {folded} topics')
+            if options['once']:
+                break
+            time.sleep(options['interval'])
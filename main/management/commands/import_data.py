@@ -62,12 +62,10 @@ class Command(BaseCommand):
                 topic = author.topics.create(
                     title=item['title'], board=board, content=item['content']
                 )
-                for post_item in item['posts']:
-                    author = models.User.objects.get(username=post_item['author'].strip())
-                    author.posts.create(
-                        content=post_item['content'],
-                        topic_id=topic.id
-                    )
-                    c['posts_processed'] += 1
+                posts = [models.Post(author=models.User.objects.get(username=post_item['author'].strip()),
+                                     content=post_item['content'])
+                         for post_item in item['posts']]
+                topic.create_posts(posts)
+                c['posts_processed'] += len(posts)
                 c['topics_processed'] += 1
         self.stdout.write(f'Topics processed={c["topics_processed"]} (posts processed={c["posts_processed"]})')
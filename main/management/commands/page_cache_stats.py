@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from main.page_cache import get_stats, is_enabled
+
+
+class Command(BaseCommand):
+    help = 'Print the hits and misses of the page cache (PAGE_CACHE_TIMEOUT)'
+
+    def handle(self, *args, **options):
+        if not is_enabled():
+            self.stdout.write('PAGE_CACHE_TIMEOUT is not set, pages are not cached')
+            return
+        stats = get_stats()
+        total = stats['hits'] + stats['misses']
+        ratio = f' ({stats["hits"] / total:.0%} hits)' if total else ''
+        self.stdout.write(f'{stats["hits"]} hits, {stats["misses"]} misses{ratio}')
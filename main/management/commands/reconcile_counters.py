@@ -0,0 +1,166 @@
+import multiprocessing
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.db.models import Count, Q
+
+from koboland.db_routers import shard_database
+from main import models
+from main.counters import get_counter_buffer
+from main.utils import hot, score
+
+
+def is_close(value, expected):
+    # `hot_score` is maintained by float increments, which may round differently than a recomputation
+    if isinstance(expected, float):
+        return abs(value - expected) < 1e-6
+    return value == expected
+
+
+def chunked_ids(queryset, chunk_size):
+    """ Yields the primary keys of `queryset` in ascending chunks, using keyset pagination. """
+    last_pk = None
+    while True:
+        chunk_qs = queryset.order_by('pk')
+        if last_pk is not None:
+            chunk_qs = chunk_qs.filter(pk__gt=last_pk)
+        chunk = list(chunk_qs.values_list('pk', flat=True)[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1]
+
+
+def expected_vote_counters(model, ids, using):
+    """
+    Recomputes `likes`, `dislikes` and `shares` of the votables in `ids` with one aggregate query on the
+    database `using`, which holds their votes.
+    """
+    rows = (models.Vote.objects.using(using)
+            .filter(content_type_id=models.VoteQuerySet.content_type_id(model._meta.model_name), object_id__in=ids)
+            .values('object_id')
+            .annotate(likes=Count('id', filter=Q(vote_type=models.Vote.LIKE)),
+                      dislikes=Count('id', filter=Q(vote_type=models.Vote.DIS_LIKE)),
+                      shares=Count('id', filter=Q(is_shared=True))))
+    expected = {pk: dict.fromkeys(models.VotableQuerySet.COUNTER_FIELDS, 0) for pk in ids}
+    for row in rows:
+        expected[row.pop('object_id')] = row
+
+    # Buffered deltas are not in the database yet, and will be added on top of it when flushed
+    buffer = get_counter_buffer()
+    if buffer is not None:
+        for pk, deltas in buffer.pending(model._meta.label_lower, ids).items():
+            for field, delta in deltas.items():
+                expected[pk][field] -= delta
+    for counters in expected.values():
+        counters['score'] = score(counters['likes'], counters['dislikes'])
+    return expected
+
+
+def expected_post_counts(ids, using):
+    expected = dict.fromkeys(ids, 0)
+    for row in models.Post.objects.using(using).filter(topic_id__in=ids).values('topic_id').annotate(count=Count('id')):
+        expected[row['topic_id']] = row['count']
+    # Counts that are still in `TopicCounterShard` rows are not part of `Topic.post_count` yet
+    counter_shards = models.TopicCounterShard.objects.using(using)
+    list(counter_shards.select_for_update().filter(topic__in=ids).values_list('pk'))
+    for pk, pending in counter_shards.pending(ids).items():
+        expected[pk] -= pending['post_count']
+    return {pk: {'post_count': count} for pk, count in expected.items()}
+
+
+def reconcile_chunk(model, ids, using, dry_run=False):
+    """
+    Recomputes the denormalized counters and scores of the votables in `ids`, on the database `using`, and
+    writes the ones that drifted. The rows are locked first, so concurrent votes wait and are then applied
+    on top of the corrected values. Returns a Counter of corrected rows per field.
+    """
+    corrected = Counter()
+    votables = model.objects.using(using)
+    with transaction.atomic(using=using):
+        fields = [*models.VotableQuerySet.COUNTER_FIELDS, 'score']
+        if model is models.Topic:
+            fields += ['post_count', 'hot_score']
+        current = {row.pop('pk'): row for row in
+                   votables.select_for_update().filter(pk__in=ids).order_by('pk').values('pk', 'date_created', *fields)}
+
+        ids = list(current)
+        expected = expected_vote_counters(model, ids, using)
+        if model is models.Topic:
+            for pk, counts in expected_post_counts(ids, using).items():
+                expected[pk].update(counts)
+                expected[pk]['hot_score'] = hot(expected[pk]['likes'], expected[pk]['dislikes'],
+                                                current[pk]['date_created'])
+
+        to_update = []
+        for pk, values in current.items():
+            values.pop('date_created')
+            drifted = [field for field in fields if not is_close(values[field], expected[pk][field])]
+            if drifted:
+                corrected.update(drifted)
+                to_update.append(model(pk=pk, **expected[pk]))
+        corrected['rows'] += len(to_update)
+        if to_update and not dry_run:
+            votables.bulk_update(to_update, fields)
+    return corrected
+
+
+def reconcile_boards(board_names, chunk_size, dry_run=False):
+    """
+    Reconciles the topics and posts of the given boards, on the database of the shard of each board, and
+    returns Counters of corrected rows by model.
+    """
+    report = {'topic': Counter(), 'post': Counter()}
+    boards_by_database = {}
+    for name in board_names:
+        boards_by_database.setdefault(shard_database(models.Board(name=name).get_shard()), []).append(name)
+    for database, names in boards_by_database.items():
+        querysets = (
+            (models.Topic, models.Topic.objects.using(database).filter(board__in=names)),
+            (models.Post, models.Post.objects.using(database).filter(topic__board__in=names)),
+        )
+        for model, queryset in querysets:
+            for ids in chunked_ids(queryset, chunk_size):
+                report[model._meta.model_name].update(reconcile_chunk(model, ids, database, dry_run))
+                report[model._meta.model_name]['checked'] += len(ids)
+    return report
+
+
+class Command(BaseCommand):
+    help = ('Recompute the denormalized counters of topics and posts (likes, dislikes, shares, score, post_count '
+            'and hot_score) '
+            'from the votes and posts, one chunk of ids at a time, and fix the ones that drifted')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--board', action='append', dest='boards', help='Only reconcile this board (repeatable)')
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of worker processes, each reconciling its own share of the boards')
+        parser.add_argument('--dry-run', action='store_true', help='Report the drift without fixing it')
+
+    def handle(self, *args, **options):
+        started = time.time()
+        boards = options['boards'] or list(models.Board.objects.order_by('name').values_list('name', flat=True))
+        workers = max(1, min(options['workers'], len(boards)))
+        partitions = [boards[i::workers] for i in range(workers)]
+        job_args = [(partition, options['chunk_size'], options['dry_run']) for partition in partitions]
+
+        if workers == 1:
+            reports = [reconcile_boards(*job_args[0])]
+        else:
+            # Forked workers must not share the parent's database connections
+            connections.close_all()
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                reports = pool.starmap(reconcile_boards, job_args)
+
+        for model_name in ('topic', 'post'):
+            total = sum((report[model_name] for report in reports), Counter())
+            fields = ', '.join(f'{field}={count}' for field, count in sorted(total.items())
+                               if field not in ('checked', 'rows'))
+            self.stdout.write(f'{model_name.capitalize()}s checked={total["checked"]} '
+                              f'corrected={total["rows"]} ({fields or "no drift"})')
+        action = 'Found' if options['dry_run'] else 'Reconciled'
+        self.stdout.write(f'{action} counters of {len(boards)} boards in {time.time() - started:.1f}s '
+                          f'with {workers} worker(s)')
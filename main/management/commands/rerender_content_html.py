@@ -0,0 +1,178 @@
+import json
+import multiprocessing
+import os
+import time
+from collections import deque
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.timezone import make_aware, is_naive
+
+from commenting.utils import render_html
+from koboland.helpers import id_range
+from main import models
+
+
+def iter_chunks(queryset, chunk_size, after=None):
+    """ Streams `(pk, content)` of `queryset` in ascending primary key order, `chunk_size` rows at a time. """
+    queryset = queryset.order_by('pk')
+    if after is not None:
+        queryset = queryset.filter(pk__gt=after)
+    chunk = []
+    for row in queryset.values_list('pk', 'content').iterator(chunk_size=chunk_size):
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def render_chunk(rows):
+    return [(pk, content, render_html(content)) for pk, content in rows]
+
+
+def render_chunks(chunks, pool=None, window=1):
+    """
+    Yields the rendered chunks in order. With a `pool`, up to `window` chunks are rendered ahead,
+    while the chunks are still read (and their results written) by the calling thread.
+    """
+    if pool is None:
+        yield from map(render_chunk, chunks)
+        return
+    pending = deque()
+    for chunk in chunks:
+        pending.append(pool.apply_async(render_chunk, (chunk,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def write_chunk(model, rendered, using):
+    """
+    Stores the rendered HTML of a chunk read from the database `using` with one `bulk_update`, skipping the
+    rows whose content was edited since it was read (their save rendered it already). Returns the number
+    of rows written.
+    """
+    votables = model.objects.using(using)
+    with transaction.atomic(using=using):
+        current = dict(votables.select_for_update().filter(pk__in=[pk for pk, _, _ in rendered])
+                       .order_by('pk').values_list('pk', 'content'))
+        to_update = [model(pk=pk, content_html=html, html_stale=False)
+                     for pk, content, html in rendered if current.get(pk) == content]
+        votables.bulk_update(to_update, ['content_html', 'html_stale'])
+    return len(to_update)
+
+
+def parse_since(value):
+    """ Parses an ISO 8601 date or datetime, in the current time zone unless it has an offset. """
+    try:
+        since = parse_datetime(value)
+        if since is None:
+            day = parse_date(value)
+            since = day and datetime.combine(day, datetime.min.time())
+    except ValueError:
+        since = None
+    if since is None:
+        raise CommandError(f'Invalid --since date `{value}`')
+    return make_aware(since) if is_naive(since) else since
+
+
+class Checkpoint:
+    """
+    The last primary key written for each model and shard database, saved to a JSON file after every chunk.
+    The shard databases are walked one after the other, and the positions on the default one are keyed by
+    the model name alone, e.g. `{"topic": 42}`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.positions = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.positions = json.load(f)
+
+    @staticmethod
+    def key(model_name, database):
+        return model_name if database == 'default' else f'{model_name}@{database}'
+
+    def get(self, model_name, database='default'):
+        return self.positions.get(self.key(model_name, database))
+
+    def save(self, model_name, pk, database='default'):
+        self.positions[self.key(model_name, database)] = pk
+        if self.path:
+            with open(f'{self.path}.tmp', 'w') as f:
+                json.dump(self.positions, f)
+            os.replace(f'{self.path}.tmp', self.path)
+
+    def clear(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class Command(BaseCommand):
+    help = ('Render the stored content_html of topics and posts again from their content, e.g. after a change '
+            'of the Markdown renderer, streaming them in primary key chunks over a pool of worker processes')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--board', action='append', dest='boards', help='Only render this board (repeatable)')
+        parser.add_argument('--since', help='Only render votables created or modified since this date (ISO 8601)')
+        parser.add_argument('--stale', action='store_true', help='Only render votables whose content_html is stale')
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--workers', type=int, default=1, help='Number of rendering processes')
+        parser.add_argument('--checkpoint',
+                            help='JSON file recording progress. An interrupted run started again with the same file '
+                                 'resumes after the last written chunk. It is deleted once the run completes.')
+
+    def get_querysets(self, options):
+        filters = Q()
+        if options['since']:
+            since = parse_since(options['since'])
+            # Ids follow the creation time (see helpers.id_range)
+            filters &= Q(pk__gte=id_range(since)[0]) | Q(date_modified__gte=since)
+        if options['stale']:
+            filters &= Q(html_stale=True)
+        topics, posts = models.Topic.objects.filter(filters), models.Post.objects.filter(filters)
+        if options['boards']:
+            topics, posts = topics.filter(board__in=options['boards']), posts.filter(topic__board__in=options['boards'])
+        return (models.Topic, topics), (models.Post, posts)
+
+    def handle(self, *args, **options):
+        querysets = self.get_querysets(options)
+        checkpoint = Checkpoint(options['checkpoint'])
+        workers = max(1, options['workers'])
+        pool = None
+        if workers > 1:
+            # Forked workers must not share the parent's database connections
+            connections.close_all()
+            pool = multiprocessing.get_context('fork').Pool(workers)
+
+        started, total = time.time(), 0
+        try:
+            for model, queryset in querysets:
+                model_name = model._meta.model_name
+                model_started, written, rendered_count = time.time(), 0, 0
+                for database_queryset in queryset.on_every_database():
+                    database = database_queryset.db
+                    chunks = iter_chunks(database_queryset, options['chunk_size'],
+                                         after=checkpoint.get(model_name, database))
+                    for rendered in render_chunks(chunks, pool, window=2 * workers):
+                        written += write_chunk(model, rendered, database)
+                        rendered_count += len(rendered)
+                        checkpoint.save(model_name, rendered[-1][0], database)
+                elapsed = time.time() - model_started
+                self.stdout.write(f'{model_name.capitalize()}s rendered={rendered_count} written={written} '
+                                  f'in {elapsed:.1f}s ({rendered_count / max(elapsed, 1e-6):.0f}/s)')
+                total += rendered_count
+        finally:
+            if pool:
+                pool.terminate()
+        checkpoint.clear()
+        elapsed = time.time() - started
+        self.stdout.write(f'Rendered {total} votables in {elapsed:.1f}s ({total / max(elapsed, 1e-6):.0f}/s) '
+                          f'with {workers} worker(s)')
@@ -0,0 +1,38 @@
+# Generated by Django 2.2.2 on 2026-10-17 15:53
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def delete_duplicate_votes(apps, schema_editor):
+    """
+    Keeps only the latest vote of every `(voter, content_type, object_id)`.
+    The counters of the affected votables still include the deleted duplicates
+    and have to be recomputed from the remaining votes.
+    """
+    Vote = apps.get_model('main', 'Vote')
+    db_alias = schema_editor.connection.alias
+    duplicates = (Vote.objects.using(db_alias)
+                  .values('voter', 'content_type', 'object_id')
+                  .annotate(count=Count('id'), keep=Max('id'))
+                  .filter(count__gt=1))
+    for duplicate in duplicates.iterator():
+        (Vote.objects.using(db_alias)
+         .filter(voter=duplicate['voter'], content_type=duplicate['content_type'], object_id=duplicate['object_id'])
+         .exclude(id=duplicate['keep'])
+         .delete())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0002_auto_20190626_2211'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_votes, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='vote',
+            constraint=models.UniqueConstraint(fields=('voter', 'content_type', 'object_id'), name='unique_vote_per_votable'),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 2.2.2 on 2026-10-17 15:57
+
+from django.db import migrations, models
+from django.db.models import F
+
+from main.utils import hot
+
+
+def backfill_scores(apps, schema_editor):
+    """ Sets `score` from the vote counters of every topic and post, and computes the initial `hot_score` of topics. """
+    db_alias = schema_editor.connection.alias
+    for model_name in ('Topic', 'Post'):
+        apps.get_model('main', model_name).objects.using(db_alias).update(score=F('likes') - F('dislikes'))
+
+    Topic = apps.get_model('main', 'Topic')
+    topics = []
+    for topic in Topic.objects.using(db_alias).only('likes', 'dislikes', 'date_created').iterator():
+        topic.hot_score = hot(topic.likes, topic.dislikes, topic.date_created)
+        topics.append(topic)
+        if len(topics) == 1000:
+            Topic.objects.using(db_alias).bulk_update(topics, ['hot_score'])
+            topics = []
+    Topic.objects.using(db_alias).bulk_update(topics, ['hot_score'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0003_unique_vote_per_votable'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='topic',
+            name='hot_score',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='topic',
+            index=models.Index(fields=['-hot_score', '-id'], name='topic_hot_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='topic',
+            index=models.Index(fields=['board', '-hot_score', '-id'], name='topic_board_hot_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='topic',
+            index=models.Index(fields=['-score', '-id'], name='topic_top_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='topic',
+            index=models.Index(fields=['board', '-score', '-id'], name='topic_board_top_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='topic',
+            index=models.Index(fields=['-date_created', '-id'], name='topic_new_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='topic',
+            index=models.Index(fields=['board', '-date_created', '-id'], name='topic_board_new_idx'),
+        ),
+        migrations.RunPython(backfill_scores, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 2.2.2 on 2026-10-17 16:10
+
+from collections import Counter
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils import timezone
+
+from main.utils import period_starts
+
+
+def backfill_leaderboards(apps, schema_editor):
+    """ Builds the leaderboard entries from the existing likes and dislikes, by `vote_time`. """
+    db_alias = schema_editor.connection.alias
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    Vote = apps.get_model('main', 'Vote')
+    LeaderboardEntry = apps.get_model('main', 'LeaderboardEntry')
+    board_lookups = {'topic': 'board_id', 'post': 'topic__board_id'}
+
+    for model_name, board_lookup in board_lookups.items():
+        content_type = ContentType.objects.using(db_alias).filter(app_label='main', model=model_name).first()
+        if content_type is None:
+            continue
+        scores = Counter()
+        votes = (Vote.objects.using(db_alias).filter(content_type=content_type, vote_type__in=[1, -1])
+                 .values_list('object_id', 'vote_type', 'vote_time'))
+        for object_id, vote_type, vote_time in votes.iterator():
+            for period, start in period_starts(timezone.localdate(vote_time)).items():
+                scores[object_id, period, start] += vote_type
+
+        model = apps.get_model('main', model_name)
+        boards = dict(model.objects.using(db_alias).values_list('id', board_lookup).iterator())
+        LeaderboardEntry.objects.using(db_alias).bulk_create(
+            [LeaderboardEntry(content_type=content_type, object_id=object_id, board_id=boards[object_id],
+                              period=period, period_start=start, score=score)
+             for (object_id, period, start), score in scores.items() if object_id in boards],
+            batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('main', '0004_topic_hot_score'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LeaderboardEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.CharField(max_length=9)),
+                ('period', models.CharField(choices=[('day', 'Today'), ('week', 'This week'), ('month', 'This month'), ('all', 'All time')], max_length=5)),
+                ('period_start', models.DateField()),
+                ('score', models.IntegerField(default=0)),
+                ('board', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.Board')),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='leaderboardentry',
+            index=models.Index(fields=['content_type', 'period', 'period_start', '-score', 'object_id'], name='leaderboard_top_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='leaderboardentry',
+            index=models.Index(fields=['content_type', 'period', 'period_start', 'board', '-score', 'object_id'], name='leaderboard_board_top_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='leaderboardentry',
+            constraint=models.UniqueConstraint(fields=('content_type', 'object_id', 'period', 'period_start'), name='unique_leaderboard_entry'),
+        ),
+        migrations.RunPython(backfill_leaderboards, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.2.2 on 2026-10-17 16:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0005_leaderboardentry'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['topic', 'date_created', 'id'], name='post_topic_created_idx'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 2.2.2 on 2026-10-17 16:40
+
+from django.db import migrations, models
+
+
+def number_posts(apps, schema_editor):
+    """ Numbers the posts of every topic from 1, by `date_created`, and sets `Topic.last_post_seq`. """
+    db_alias = schema_editor.connection.alias
+    Post = apps.get_model('main', 'Post')
+    Topic = apps.get_model('main', 'Topic')
+
+    last_seqs = {}
+    posts = []
+    for post in Post.objects.using(db_alias).only('id', 'topic').order_by('topic_id', 'date_created', 'id').iterator():
+        post.seq = last_seqs[post.topic_id] = last_seqs.get(post.topic_id, 0) + 1
+        posts.append(post)
+        if len(posts) == 1000:
+            Post.objects.using(db_alias).bulk_update(posts, ['seq'])
+            posts = []
+    Post.objects.using(db_alias).bulk_update(posts, ['seq'])
+
+    Topic.objects.using(db_alias).bulk_update(
+        [Topic(id=topic_id, last_post_seq=seq) for topic_id, seq in last_seqs.items()], ['last_post_seq'],
+        batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_post_topic_created_idx'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='post',
+            name='post_topic_created_idx',
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='seq',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='topic',
+            name='last_post_seq',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(number_posts, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='post',
+            constraint=models.UniqueConstraint(fields=('topic', 'seq'), name='unique_post_seq_per_topic'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 2.2.2 on 2026-10-17 16:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Max, OuterRef, Subquery
+
+
+def set_last_post_at(apps, schema_editor):
+    db_alias = schema_editor.connection.alias
+    Post = apps.get_model('main', 'Post')
+    Topic = apps.get_model('main', 'Topic')
+    last_post_at = (Post.objects.using(db_alias).filter(topic=OuterRef('pk')).order_by()
+                    .values('topic').annotate(last=Max('date_created')).values('last'))
+    Topic.objects.using(db_alias).update(last_post_at=Subquery(last_post_at))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0007_post_seq'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='topic',
+            name='last_post_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.CreateModel(
+            name='TopicCounterShard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.PositiveSmallIntegerField()),
+                ('post_count', models.IntegerField(default=0)),
+                ('last_post_at', models.DateTimeField(null=True)),
+                ('topic', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='counter_shards', to='main.Topic')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='topiccountershard',
+            constraint=models.UniqueConstraint(fields=('topic', 'shard'), name='unique_topic_counter_shard'),
+        ),
+        migrations.RunPython(set_last_post_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.2 on 2026-10-17 17:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_topiccountershard'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='html_stale',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='topic',
+            name='html_stale',
+            field=models.BooleanField(default=False),
+        ),
+    ]
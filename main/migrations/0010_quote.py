@@ -0,0 +1,53 @@
+# Generated by Django 2.2.2 on 2026-10-17 17:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from commenting.quoted_post import quoted_ids
+
+
+def backfill_quotes(apps, schema_editor):
+    """ Builds the quote edges from the `<<<[[author|id]]` blocks of the existing topics and posts. """
+    db_alias = schema_editor.connection.alias
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    Quote = apps.get_model('main', 'Quote')
+
+    for model_name in ('topic', 'post'):
+        content_type = ContentType.objects.using(db_alias).filter(app_label='main', model=model_name).first()
+        if content_type is None:
+            continue
+        model = apps.get_model('main', model_name)
+        votables = model.objects.using(db_alias).filter(content__contains='<<<').values_list('id', 'content')
+        Quote.objects.using(db_alias).bulk_create(
+            [Quote(source_content_type=content_type, source_id=pk, quoted_id=quoted_id)
+             for pk, content in votables.iterator() for quoted_id in quoted_ids(content)],
+            batch_size=1000, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('main', '0009_votable_html_stale'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Quote',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source_id', models.CharField(max_length=9)),
+                ('quoted_id', models.CharField(max_length=9)),
+                ('source_content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='quote',
+            index=models.Index(fields=['quoted_id'], name='quote_quoted_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='quote',
+            constraint=models.UniqueConstraint(fields=('source_content_type', 'source_id', 'quoted_id'), name='unique_quote'),
+        ),
+        migrations.RunPython(backfill_quotes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,191 @@
+# Generated by Django 2.2.2 on 2026-10-17 18:30
+
+import random
+import re
+import string
+import zlib
+
+from django.db import migrations, models
+
+# Frozen copies of the id layout of koboland.helpers (with ID_SHARD_BITS = 6 and TIME_ZONE = 'UTC') and of the
+# quote grammar of commenting.quoted_post, so that later changes to either do not change what this migration does
+START_TIME = 1561170949
+ID_LOW_BITS = 23
+ID_SHARD_BITS = 6
+PUBLIC_ID_LENGTH = 11
+BASE62_ALPHABET = string.digits + string.ascii_uppercase + string.ascii_lowercase
+QUOTE_MARKER = '<<<'
+QUOTE_RE = re.compile(re.escape(QUOTE_MARKER) + r'\s*\[\[([^|\]\n]{1,150})\|([A-Za-z0-9]{1,32})\]\]')
+
+
+def make_id_at(timestamp, shard):
+    """ Returns a k-sortable id of the logical shard `shard` for a row created at `timestamp`, with random low bits. """
+    t = max(int(timestamp * 1000) - START_TIME * 1000, 0)
+    shift = ID_LOW_BITS - ID_SHARD_BITS
+    low = random.SystemRandom().getrandbits(shift)
+    return (t << ID_LOW_BITS) | (shard << shift) | low
+
+
+def board_shard(board_id):
+    """ Returns the logical shard of the topics and posts of a board, like `Board.get_shard`. """
+    return zlib.crc32(board_id.lower().encode()) % (1 << ID_SHARD_BITS)
+
+
+def to_base62(number, length):
+    digits = []
+    while number:
+        number, digit = divmod(number, 62)
+        digits.append(BASE62_ALPHABET[digit])
+    return ''.join(reversed(digits)).rjust(length, BASE62_ALPHABET[0])
+
+
+def new_ids(model, board_lookup, db_alias, taken):
+    """
+    Maps the ids of the rows of `model` to k-sortable ids made from their `date_created`, carrying the
+    logical shard of their board. Ids in `taken`, which gets the new ones, are not given again, so that
+    topics and posts never share an id.
+    """
+    ids = {}
+    rows = model.objects.using(db_alias).values_list('pk', 'date_created', board_lookup)
+    for pk, date_created, board_id in rows.iterator():
+        shard = board_shard(board_id)
+        new_id = make_id_at(date_created.timestamp(), shard)
+        while new_id in taken:
+            new_id = make_id_at(date_created.timestamp(), shard)
+        taken.add(new_id)
+        ids[pk] = new_id
+    return ids
+
+
+def rewrite_quotes(content, public_ids):
+    """ Replaces the former ids in the `<<<[[author|id]]` blocks of `content` with public ids. """
+    def replace(match):
+        public_id = public_ids.get(match.group(2))
+        if public_id is None:
+            return match.group(0)
+        start, end = match.span(2)
+        return match.string[match.start():start] + public_id + match.string[end:match.end()]
+    return QUOTE_RE.sub(replace, content)
+
+
+def remap_votable_ids(apps, schema_editor):
+    """
+    Gives every topic and post a k-sortable id, keeping the former one in `legacy_id`, and rewrites the
+    columns referring to them with the new ids, which become bigints in the next migration. Quote blocks
+    are rewritten with the new public ids, and their `content_html` is left to be rendered again.
+    """
+    db_alias = schema_editor.connection.alias
+    qn = schema_editor.quote_name
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    Topic, Post, User = apps.get_model('main', 'Topic'), apps.get_model('main', 'Post'), apps.get_model('main', 'User')
+    Vote, LeaderboardEntry = apps.get_model('main', 'Vote'), apps.get_model('main', 'LeaderboardEntry')
+    Quote, TopicCounterShard = apps.get_model('main', 'Quote'), apps.get_model('main', 'TopicCounterShard')
+
+    taken = set()
+    ids = {'topic': new_ids(Topic, 'board_id', db_alias, taken),
+           'post': new_ids(Post, 'topic__board_id', db_alias, taken)}
+    if not any(ids.values()):
+        return
+
+    def through_column(model, name, reverse=False):
+        field = model._meta.get_field(name)
+        column = field.m2m_reverse_name() if reverse else field.m2m_column_name()
+        return field.remote_field.through._meta.db_table, column
+
+    references = {
+        'topic': [
+            (Post._meta.db_table, Post._meta.get_field('topic').column),
+            (TopicCounterShard._meta.db_table, TopicCounterShard._meta.get_field('topic').column),
+            through_column(Topic, 'files'),
+            through_column(User, 'topics_following', reverse=True),
+        ],
+        'post': [
+            through_column(Post, 'files'),
+        ],
+    }
+    generic_references = [
+        (Vote._meta.db_table, 'content_type_id', 'object_id'),
+        (LeaderboardEntry._meta.db_table, 'content_type_id', 'object_id'),
+        (Quote._meta.db_table, 'source_content_type_id', 'source_id'),
+    ]
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('CREATE TEMPORARY TABLE votable_id_map (model varchar(8), old_id varchar(10), '
+                       'new_id varchar(20), PRIMARY KEY (model, old_id)) ON COMMIT DROP')
+        cursor.executemany('INSERT INTO votable_id_map (model, old_id, new_id) VALUES (%s, %s, %s)',
+                           [(model_name, old_id, str(new_id)) for model_name, model_ids in ids.items()
+                            for old_id, new_id in model_ids.items()])
+        cursor.execute('CREATE INDEX ON votable_id_map (new_id)')
+
+        # The new ids are stored as decimal strings until the next migration makes the columns bigints
+        columns = [(Topic._meta.db_table, 'id'), (Post._meta.db_table, 'id'), *references['topic'],
+                   *references['post'], *((table, column) for table, _, column in generic_references),
+                   (Quote._meta.db_table, 'quoted_id')]
+        for table, column in columns:
+            cursor.execute(f'ALTER TABLE {qn(table)} ALTER COLUMN {qn(column)} TYPE varchar(20)')
+
+        for model_name, model in (('topic', Topic), ('post', Post)):
+            table = qn(model._meta.db_table)
+            # Foreign keys are checked once every column has the new ids
+            cursor.execute(f'UPDATE {table} SET legacy_id = {table}.id, id = m.new_id FROM votable_id_map m '
+                           f'WHERE m.model = %s AND {table}.id = m.old_id', [model_name])
+            for ref_table, column in references[model_name]:
+                cursor.execute(f'UPDATE {qn(ref_table)} SET {qn(column)} = m.new_id FROM votable_id_map m '
+                               f'WHERE m.model = %s AND {qn(ref_table)}.{qn(column)} = m.old_id', [model_name])
+
+            content_type = ContentType.objects.using(db_alias).filter(app_label='main', model=model_name).first()
+            if content_type is None:
+                continue
+            for ref_table, content_type_column, column in generic_references:
+                ref_table, content_type_column, column = qn(ref_table), qn(content_type_column), qn(column)
+                # Rows left by deleted votables would not fit in a bigint column
+                cursor.execute(f'DELETE FROM {ref_table} WHERE {content_type_column} = %s AND NOT EXISTS '
+                               f'(SELECT 1 FROM votable_id_map m '
+                               f'WHERE m.model = %s AND m.old_id = {ref_table}.{column})',
+                               [content_type.pk, model_name])
+                cursor.execute(f'UPDATE {ref_table} SET {column} = m.new_id FROM votable_id_map m '
+                               f'WHERE {ref_table}.{content_type_column} = %s AND m.model = %s '
+                               f'AND {ref_table}.{column} = m.old_id', [content_type.pk, model_name])
+
+        # Former ids start with a letter, so they never match the decimal new ids. Posts first, like the permalinks.
+        quote_table = qn(Quote._meta.db_table)
+        for model_name in ('post', 'topic'):
+            cursor.execute(f'UPDATE {quote_table} SET quoted_id = m.new_id FROM votable_id_map m '
+                           f'WHERE m.model = %s AND {quote_table}.quoted_id = m.old_id', [model_name])
+        cursor.execute(f'DELETE FROM {quote_table} WHERE NOT EXISTS '
+                       f'(SELECT 1 FROM votable_id_map m WHERE m.new_id = {quote_table}.quoted_id)')
+
+    public_ids = {old_id: to_base62(new_id, PUBLIC_ID_LENGTH) for model_name in ('topic', 'post')
+                  for old_id, new_id in ids[model_name].items()}
+    for model in (Topic, Post):
+        votables = model.objects.using(db_alias).filter(content__contains=QUOTE_MARKER)
+        for pk, content in votables.values_list('pk', 'content').iterator():
+            rewritten = rewrite_quotes(content, public_ids)
+            if rewritten != content:
+                model.objects.using(db_alias).filter(pk=pk).update(content=rewritten, html_stale=True)
+
+    # Checks the foreign keys now, as the indexes of the new fields cannot be created while checks are pending
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('main', '0010_quote'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='legacy_id',
+            field=models.CharField(editable=False, max_length=10, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='topic',
+            name='legacy_id',
+            field=models.CharField(editable=False, max_length=10, null=True, unique=True),
+        ),
+        migrations.RunPython(remap_votable_ids, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,101 @@
+# Generated by Django 2.2.2 on 2026-10-17 18:35
+
+from django.db import migrations, models
+
+import koboland.helpers
+
+
+def m2m_fields(apps):
+    """ Returns the foreign keys to topics and posts of the many-to-many tables, with their table. """
+    Topic, Post, User = apps.get_model('main', 'Topic'), apps.get_model('main', 'Post'), apps.get_model('main', 'User')
+    fields = []
+    for model, name, reverse in ((Topic, 'files', False), (Post, 'files', False), (User, 'topics_following', True)):
+        field = model._meta.get_field(name)
+        through = field.remote_field.through
+        fields.append((through, through._meta.get_field(field.m2m_reverse_field_name() if reverse
+                                                        else field.m2m_field_name())))
+    return fields
+
+
+def drop_like_indexes(schema_editor, model, column):
+    """ Drops the `varchar_pattern_ops` index PostgreSQL has for LIKE queries on a varchar `column`. """
+    for name in schema_editor._constraint_names(model, [column], index=True):
+        if name.endswith('_like'):
+            schema_editor.execute(schema_editor._delete_index_sql(model, name))
+
+
+def alter_m2m_columns(apps, schema_editor):
+    """
+    Changes the topic and post columns of the many-to-many tables to bigints. AlterField of a primary key
+    only updates the foreign keys of models, and the constraints of these would not allow the change.
+    Indexes for LIKE queries would not allow it either, for the foreign keys of models too.
+    """
+    qn = schema_editor.quote_name
+    for model, name in (('post', 'topic'), ('topiccountershard', 'topic')):
+        model = apps.get_model('main', model)
+        drop_like_indexes(schema_editor, model, model._meta.get_field(name).column)
+    for through, field in m2m_fields(apps):
+        for name in schema_editor._constraint_names(through, [field.column], foreign_key=True):
+            schema_editor.execute(schema_editor._delete_fk_sql(through, name))
+        drop_like_indexes(schema_editor, through, field.column)
+        schema_editor.execute(f'ALTER TABLE {qn(through._meta.db_table)} ALTER COLUMN {qn(field.column)} '
+                              f'TYPE bigint USING {qn(field.column)}::bigint')
+
+
+def add_m2m_foreign_keys(apps, schema_editor):
+    for through, field in m2m_fields(apps):
+        schema_editor.execute(schema_editor._create_fk_sql(through, field, '_fk_%(to_table)s_%(to_column)s'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_votable_legacy_id'),
+    ]
+
+    operations = [
+        migrations.RunPython(alter_m2m_columns, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='topic',
+            name='id',
+            field=models.BigIntegerField(default=koboland.helpers.make_id, primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='post',
+            name='id',
+            field=models.BigIntegerField(default=koboland.helpers.make_id, primary_key=True, serialize=False),
+        ),
+        migrations.RunPython(add_m2m_foreign_keys, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='vote',
+            name='object_id',
+            field=models.BigIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='leaderboardentry',
+            name='object_id',
+            field=models.BigIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='quote',
+            name='source_id',
+            field=models.BigIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='quote',
+            name='quoted_id',
+            field=models.BigIntegerField(),
+        ),
+        migrations.RemoveIndex(
+            model_name='topic',
+            name='topic_new_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='topic',
+            name='topic_board_new_idx',
+        ),
+        migrations.AddIndex(
+            model_name='topic',
+            index=models.Index(fields=['board', '-id'], name='topic_board_new_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.2 on 2026-10-17 18:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_votable_bigint_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='board',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='topic',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
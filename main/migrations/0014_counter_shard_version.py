@@ -0,0 +1,18 @@
+# Generated by Django 2.2.2 on 2026-10-17 18:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_page_versions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='topiccountershard',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
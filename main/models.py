@@ -1,30 +1,48 @@
 import os
 import uuid
+from collections import defaultdict
 from datetime import timedelta
+from functools import partial
+import logging
 import math
+import random
+from concurrent import futures
 
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser, BaseUserManager
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
 from django.core.validators import MinLengthValidator
-from django.db import models
+from django.db import close_old_connections, connections, models, router, transaction
+from django.db.models import Count, F, Max, Q, Sum, Value
+from django.db.models.functions import Coalesce, Greatest
 from django.template.defaultfilters import pluralize
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.text import slugify
 from django.utils.translation import gettext_lazy as _
 
+from commenting.engine import get_engine
+from commenting.quoted_post import QUOTE_LINK_RE, quoted_ids, resolve_quote_links
 from commenting.utils import render_html
 from koboland import fields as model_fields
 from koboland import models as koboland_models
+from koboland.db_routers import id_database, shard_database, shard_databases
+from koboland.helpers import id_range, key_shard, shard_of, side_connection, with_shard
+from . import page_cache
+from .counters import COUNTER_FIELDS, get_counter_buffer
+from .utils import PERIOD_ALL, PERIOD_DAY, PERIOD_MONTH, PERIOD_WEEK, hot, hot_order_expression, period_starts
 from .validators import UsernameValidator
 
+logger = logging.getLogger(__name__)
+
 
 class Board(models.Model):
     name = model_fields.CICharField(max_length=32, primary_key=True)
     description = models.TextField(blank=True)
     moderators = models.ManyToManyField('User', related_name='moderates_on')
+    # Bumped when topics of the board are added or edited, see `main.conditional`
+    version = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return self.name
@@ -35,6 +53,11 @@ class Board(models.Model):
     def get_absolute_url(self):
         return reverse('board', kwargs={'board': self.name})
 
+    def get_shard(self):
+        """ Returns the logical shard of the topics and posts of this board, see `koboland.db_routers`. """
+        # Names are case insensitive
+        return key_shard(self.name.lower())
+
 
 def get_file_path(instance, filename):
     ext = filename.split('.')[-1]
@@ -51,9 +74,193 @@ class SubmissionMedia(models.Model):
         return self.content_type.startswith('image')
 
 
-class Votable(koboland_models.RandomPrimaryIdModel):
+class ShardedQuerySet(models.QuerySet):
+    """ Queries of a model whose rows are on the database of a logical shard, see `koboland.db_routers`. """
+
+    def on_shard(self, shard):
+        """ Reads from the database of the logical shard `shard`. """
+        return self.using(shard_database(shard))
+
+    def on_shard_of(self, pk):
+        """ Reads from the database of the shard of the id `pk`, unless the queryset picked one. """
+        return self if self._db else self.using(id_database(pk))
+
+    def by_database(self, pks):
+        """ Splits the ids `pks` by the database of their shard, as `(queryset on it, pks)` pairs. """
+        if self._db:
+            return [(self, list(pks))]
+        pks_by_database = defaultdict(list)
+        for pk in pks:
+            pks_by_database[id_database(pk)].append(pk)
+        return [(self.using(database), database_pks) for database, database_pks in pks_by_database.items()]
+
+    def on_every_database(self):
+        """ Returns the queryset on every shard database, or only itself if it picked one. """
+        return [self] if self._db else [self.using(database) for database in shard_databases()]
+
+
+class VotableQuerySet(ShardedQuerySet):
+    COUNTER_FIELDS = COUNTER_FIELDS
+
+    def create(self, **kwargs):
+        if self._db:
+            return super().create(**kwargs)
+        # `QuerySet.create` would save on the default database, `save` lets the router pick the one of the row
+        obj = self.model(**kwargs)
+        obj.save(force_insert=True)
+        return obj
+
+    def bulk_create(self, objs, batch_size=None, ignore_conflicts=False):
+        """
+        Inserts new votables in batches, with what `save` adds to a new row: the rendered `content_html`
+        and the quote edges. Posts should be added with `Topic.create_posts`. Unless the queryset picked
+        a database, every row goes to the one of its shard.
+        """
+        objs = list(objs)
+        for obj in objs:
+            obj.prepare_insert()
+        if self._db:
+            self._bulk_create_prepared(objs, batch_size, ignore_conflicts)
+            return objs
+        objs_by_database = defaultdict(list)
+        for obj in objs:
+            objs_by_database[id_database(obj.pk)].append(obj)
+        for database, database_objs in objs_by_database.items():
+            self.using(database)._bulk_create_prepared(database_objs, batch_size, ignore_conflicts)
+        return objs
+
+    def _bulk_create_prepared(self, objs, batch_size=None, ignore_conflicts=False):
+        objs = super().bulk_create(objs, batch_size, ignore_conflicts)
+        Quote.objects.using(self.db).index(objs)
+        tags = {tag for obj in objs for tag in obj.get_changed_page_tags(created=True)}
+        transaction.on_commit(partial(page_cache.touch, tags), using=self.db)
+        versions = {version for obj in objs for version in obj.get_changed_versions(created=True)}
+        transaction.on_commit(partial(bump_versions, versions, self.db), using=self.db)
+
+    def get(self, *args, **kwargs):
+        """ Looks a votable up by primary key on the database of its shard, unless the queryset picked one. """
+        if not (self._db or args) and kwargs.keys() & {'pk', 'id'}:
+            try:
+                database = id_database(kwargs.get('pk', kwargs.get('id')))
+            except (TypeError, ValueError):
+                # Not an id, which fails the lookup on any database
+                database = None
+            if database:
+                return self.using(database).get(**kwargs)
+        return super().get(*args, **kwargs)
+
+    def public(self, public_id):
+        """
+        Filters on the votable with the public id `public_id`, none if it is not a public id. The row is
+        read from the database of its shard, unless the queryset picked one.
+        """
+        pk = self.model.pk_from_public_id(public_id)
+        if pk is None:
+            return self.none()
+        return self.on_shard_of(pk).filter(pk=pk)
+
+    def created_between(self, start=None, end=None):
+        """ Filters on the votables created from `start` to `end` excluded, by their ids (see `helpers.id_range`). """
+        low, high = id_range(start, end)
+        queryset = self if low is None else self.filter(pk__gte=low)
+        return queryset if high is None else queryset.filter(pk__lt=high)
+
+    def apply_counter_deltas(self, pk, likes=0, dislikes=0, shares=0):
+        """
+        Adds the signed deltas to the counters of the votable with primary key `pk` and returns
+        the new totals as a dict keyed by `COUNTER_FIELDS`.
+
+        The increment is done by the database in a single `UPDATE ... SET likes = likes + n`
+        touching only the counter columns, so concurrent votes never overwrite each other.
+        With a write-behind buffer (see `main.counters`), the totals include the pending deltas.
+        """
+        queryset = self.on_shard_of(pk)
+        deltas = {'likes': likes, 'dislikes': dislikes, 'shares': shares}
+        with transaction.atomic(using=queryset.db):
+            queryset.increment_counters(pk, **deltas)
+            counters = queryset.get_counters([pk])
+            if not counters:
+                raise self.model.DoesNotExist(f'{self.model._meta.object_name} matching query does not exist.')
+            counters, = counters.values()
+        if get_counter_buffer() is not None:
+            # Buffered deltas only reach the buffer once the transaction commits
+            counters = {field: value + deltas[field] for field, value in counters.items()}
+        return counters
+
+    def increment_counters(self, pk, likes=0, dislikes=0, shares=0):
+        """ Adds the signed deltas to the counters, through the write-behind buffer if there is one. """
+        queryset = self.on_shard_of(pk)
+        deltas = {'likes': likes, 'dislikes': dislikes, 'shares': shares}
+        buffer = get_counter_buffer()
+        if buffer is None:
+            queryset.write_counter_deltas(pk, **deltas)
+        elif any(deltas.values()):
+            transaction.on_commit(partial(buffer.add, self.model._meta.label_lower, pk, deltas), using=queryset.db)
+
+    def write_counter_deltas(self, pk, likes=0, dislikes=0, shares=0):
+        queryset = self.on_shard_of(pk)
+        deltas = {'likes': likes, 'dislikes': dislikes, 'shares': shares}
+        updates = {field: F(field) + delta for field, delta in deltas.items() if delta}
+        if likes != dislikes:
+            updates['score'] = F('score') + (likes - dislikes)
+            updates.update(self.model.get_ranking_updates(likes - dislikes))
+        if updates:
+            queryset.filter(pk=pk).update(**updates)
+            transaction.on_commit(partial(page_cache.touch, [page_cache.votable_tag(self.model, pk)], counters=True),
+                                  using=queryset.db)
+        if likes != dislikes:
+            LeaderboardEntry.objects.record(self.model, pk, likes - dislikes)
+
+    def get_counters(self, pks):
+        """ Returns a dict mapping each primary key in `pks` to the counters of that votable. """
+        counters = {row.pop('id'): row for queryset, database_pks in self.by_database(pks)
+                    for row in queryset.filter(pk__in=database_pks).values('id', *self.COUNTER_FIELDS)}
+        buffer = get_counter_buffer()
+        if buffer is not None:
+            for pk, deltas in buffer.pending(self.model._meta.label_lower, list(counters)).items():
+                counters[pk] = {field: value + deltas[field] for field, value in counters[pk].items()}
+        return counters
+
+
+def store_rendered_html(model, pk, content, html):
+    """ Stores the `html` rendered from `content`, unless the content changed or it was stored already. """
+    model.objects.on_shard_of(pk).filter(pk=pk, html_stale=True, content=content).update(content_html=html,
+                                                                                      html_stale=False)
+
+
+def store_pending_html(model, pk, content, future):
+    """ Runs in a background worker: waits for the `future` rendering of `content` and stores it. """
+    try:
+        store_rendered_html(model, pk, content, future.result())
+    except Exception:
+        logger.exception(f'Could not store the rendered content of {model._meta.label} {pk}')
+    finally:
+        close_old_connections()
+
+
+def bump_versions(versions, using=None):
+    """
+    Bumps the `version` of the topics and boards given as `(model, pk)` pairs in `versions`. `using` is
+    the database of the topics, those of their shards by default, and boards are on the default one.
+    """
+    pks = defaultdict(set)
+    for model, pk in versions:
+        pks[model].add(pk)
+    for model, model_pks in pks.items():
+        if not getattr(model, 'SHARDED', False):
+            model.objects.filter(pk__in=model_pks).update(version=F('version') + 1)
+            continue
+        for queryset, database_pks in model.objects.using(using).by_database(model_pks):
+            queryset.filter(pk__in=database_pks).update(version=F('version') + 1)
+
+
+class Votable(koboland_models.BaseModel):
+    # Random id the votable had before the k-sortable ones, so that old links can be redirected
+    legacy_id = models.CharField(max_length=10, unique=True, null=True, editable=False)
     content = models.TextField(blank=True)
     content_html = models.TextField(blank=True)
+    # `content_html` does not match `content` yet, see `render_content_html`
+    html_stale = models.BooleanField(default=False)
     modified = models.BooleanField(default=False)
     date_created = models.DateTimeField(auto_now_add=True)
     date_modified = models.DateTimeField(null=True)
@@ -67,11 +274,22 @@ class Votable(koboland_models.RandomPrimaryIdModel):
     flags = models.IntegerField(default=0)
 
     votes = GenericRelation('Vote')
+    quotes = GenericRelation('Quote', content_type_field='source_content_type', object_id_field='source_id')
+
+    # Rows are stored on the database of their logical shard, see `koboland.db_routers`
+    SHARDED = True
+
+    objects = VotableQuerySet.as_manager()
 
     class Meta:
         abstract = True
 
     def how_long_ago(self):
+        """
+        Returns how long ago the votable was created, e.g. "5 minutes ago". Pages show the creation time
+        with `includes/votable/created.html` instead, made relative by the browser, so that they do not
+        change with the clock and can be cached.
+        """
         how_long = timezone.now() - self.date_created
         if how_long < timedelta(minutes=1):
             return f'{how_long.seconds} second{pluralize(how_long.seconds)} ago'
@@ -83,13 +301,162 @@ class Votable(koboland_models.RandomPrimaryIdModel):
             return f'{hours} hour{pluralize(hours)} ago'
         return f'{how_long.days} day{pluralize(how_long.days)} ago'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using, fields)
+        # Loading a deferred field only refreshes that field, the others may have been assigned meanwhile
+        self._store_loaded_values(fields)
+
+    def _store_loaded_values(self, attnames=None):
+        """ Records the current value of the loaded fields as the state of the row in the database. """
+        if attnames is None:
+            attnames = [field.attname for field in self._meta.concrete_fields]
+        loaded_values = getattr(self, '_loaded_values', None) or {}
+        loaded_values.update({attname: self.__dict__[attname] for attname in attnames if attname in self.__dict__})
+        self._loaded_values = loaded_values
+
+    def get_dirty_fields(self):
+        """
+        Returns the set of fields changed since this instance was loaded or last saved,
+        or None if that is unknown (e.g. the instance was never loaded from the database).
+        Deferred fields that were assigned without being loaded are dirty.
+        """
+        loaded_values = getattr(self, '_loaded_values', None)
+        if self._state.adding or loaded_values is None:
+            return None
+        missing = object()
+        dirty_fields = {field.attname for field in self._meta.concrete_fields
+                        if field.attname in self.__dict__
+                        and self.__dict__[field.attname] != loaded_values.get(field.attname, missing)}
+        if self._meta.pk.attname in dirty_fields:
+            return None
+        return dirty_fields
+
     def generate_html(self):
         return render_html(self.content)
 
+    def set_shard(self):
+        """ Moves the id to the logical shard given by the `get_shard` of the model (see `koboland.db_routers`). """
+        self.pk = with_shard(self.pk, self.get_shard())
+
+    def get_database(self, using=None):
+        """ Returns `using`, or the database of the shard of the votable. """
+        return using or router.db_for_write(type(self), instance=self)
+
+    def get_changed_page_tags(self, created):
+        """ Returns the tags of the cached pages (see `main.page_cache`) that saving this votable changes. """
+        return [] if created else [page_cache.votable_tag(type(self), self.pk)]
+
+    def get_changed_versions(self, created):
+        """
+        Returns the topics and boards, as `(model, pk)` pairs, whose page saving this votable changes. Their
+        `version` is bumped once the save is committed (see `main.conditional`).
+        """
+        return []
+
+    @classmethod
+    def get_counter_versions(cls, pks, using=None):
+        """ Returns the `(model, pk)` pairs of the pages showing the counters of the votables `pks`. """
+        return []
+
+    @classmethod
+    def bump_counter_versions(cls, pks, using=None):
+        """
+        Bumps the versions of the pages showing the counters of the votables `pks`. Only flushes of the counter
+        buffer do (see `main.counters`), so that votes do not write the topic rows one by one, and changes of
+        the quotes of posts (see `QuoteQuerySet.touch_quoted`).
+        """
+        bump_versions(cls.get_counter_versions(pks, using), using)
+
+    def prepare_insert(self):
+        """ Sets the fields that `save` computes for a new row, for `VotableQuerySet.bulk_create`. """
+        self.set_shard()
+        self.content_html, self.html_stale = self.generate_html(), False
+
+    def render_content_html(self):
+        """
+        Renders `content_html` from `content`. With `CONTENT_HTML_RENDERING = 'async'`, rendering
+        goes to the background workers and is only waited for `MARKDOWN_RENDER_BUDGET` seconds.
+        If it takes longer, the row is saved with `html_stale` and the worker stores the HTML once
+        the save is committed, unless a reader (see `get_content_html`) did it first.
+        """
+        if getattr(settings, 'CONTENT_HTML_RENDERING', 'sync') != 'async':
+            self.content_html, self.html_stale = self.generate_html(), False
+            return
+        future = get_engine().submit(self.content)
+        try:
+            self.content_html, self.html_stale = future.result(timeout=settings.MARKDOWN_RENDER_BUDGET), False
+        except futures.TimeoutError:
+            self.html_stale = True
+            self._pending_html = future
+
+    def get_content_html(self):
+        """ Returns `content_html`, rendering and storing it first if it is stale. """
+        if self.html_stale:
+            self.content_html, self.html_stale = self.generate_html(), False
+            store_rendered_html(type(self), self.pk, self.content, self.content_html)
+            self._store_loaded_values(['content_html', 'html_stale'])
+        return self.content_html
+
+    def get_counters(self):
+        return {field: getattr(self, field) for field in VotableQuerySet.COUNTER_FIELDS}
+
+    @classmethod
+    def get_ranking_updates(cls, score_delta):
+        """ Returns the extra `UPDATE` expressions of ranking columns when `score` changes by `score_delta`. """
+        return {}
+
+    def apply_counter_deltas(self, likes=0, dislikes=0, shares=0):
+        """ Atomically updates the vote counters in the database and refreshes them on this instance. """
+        if not (likes or dislikes or shares):
+            return self.get_counters()
+        counters = type(self).objects.using(self.get_database()).apply_counter_deltas(
+            self.pk, likes=likes, dislikes=dislikes, shares=shares)
+        for field, value in counters.items():
+            setattr(self, field, value)
+        self._store_loaded_values(counters.keys())
+        return counters
+
     def save(self, force_insert=False, force_update=False, using=None,
              update_fields=None):
-        self.content_html = self.generate_html()
+        created = self._state.adding
+        if created:
+            self.set_shard()
+        # Markdown is only rendered again when `content` changed, and only the changed columns are written
+        dirty_fields = self.get_dirty_fields()
+        content_changed = True
+        if dirty_fields is None or force_insert:
+            self.render_content_html()
+        elif update_fields is None:
+            content_changed = 'content' in dirty_fields
+            if content_changed:
+                self.render_content_html()
+                dirty_fields |= {'content_html', 'html_stale'}
+            # Without any change, Django's save writes the row and sends `post_save` as usual
+            if dirty_fields:
+                update_fields = dirty_fields
+        elif 'content' in update_fields:
+            self.render_content_html()
+            update_fields = set(update_fields) | {'content_html', 'html_stale'}
+        else:
+            content_changed = False
         super().save(force_insert, force_update, using, update_fields)
+        using = self._state.db
+        self._store_loaded_values()
+        if content_changed:
+            Quote.objects.using(using).sync(self)
+        transaction.on_commit(partial(page_cache.touch, self.get_changed_page_tags(created)), using=using)
+        transaction.on_commit(partial(bump_versions, self.get_changed_versions(created), using), using=using)
+
+        future = self.__dict__.pop('_pending_html', None)
+        if future is not None:
+            transaction.on_commit(partial(get_engine().executor.submit, store_pending_html, type(self), self.pk,
+                                          self.content, future), using=using)
 
         # if len(self.pseudoid) == 0:
         #     self.pseudoid = get_random_string()
@@ -117,20 +484,150 @@ class Topic(Votable):
     is_removed = models.BooleanField(default=False)
 
     post_count = models.IntegerField(default=0)
+    last_post_at = models.DateTimeField(null=True)
+    # `seq` of the latest post, which unlike `post_count` never goes down
+    last_post_seq = models.IntegerField(default=0)
+    hot_score = models.FloatField(default=0)
+    # Bumped when the page of the topic changes, see `main.conditional`
+    version = models.PositiveIntegerField(default=0)
+
+    BOARD_LOOKUP = 'board_id'
+
+    class Meta:
+        # Every listing order ends with `id` so that it is stable, and is served by an index scan
+        indexes = [
+            models.Index(fields=['-hot_score', '-id'], name='topic_hot_idx'),
+            models.Index(fields=['board', '-hot_score', '-id'], name='topic_board_hot_idx'),
+            models.Index(fields=['-score', '-id'], name='topic_top_idx'),
+            models.Index(fields=['board', '-score', '-id'], name='topic_board_top_idx'),
+            # Ids sort by creation time, so the primary key index serves the newest topics of every board
+            models.Index(fields=['board', '-id'], name='topic_board_new_idx'),
+        ]
 
     def save(self, force_insert=False, force_update=False, using=None,
              update_fields=None):
         value = self.title
         # Only set the slug once ==> Updates not permitted
-        # Initially, before the first save, this is None
-        if not self.id or len(self.id) == 0:
-            self.slug = slugify(value, allow_unicode=True)[:48]
+        if self._state.adding:
+            self.set_initial_ranking(value)
         super().save(force_insert=force_insert, force_update=force_update, using=using,
                      update_fields=update_fields)
 
+    def get_shard(self):
+        return key_shard(self.board_id.lower())
+
+    def get_changed_page_tags(self, created):
+        if created:
+            return [page_cache.board_tag(self.board_id), page_cache.ALL_TOPICS_TAG]
+        return super().get_changed_page_tags(created)
+
+    def get_changed_versions(self, created):
+        # New topics are only on the board page
+        return [(Board, self.board_id)] if created else [(Topic, self.pk), (Board, self.board_id)]
+
+    @classmethod
+    def get_counter_versions(cls, pks, using=None):
+        # Counters on the board page are only as old as `PAGE_CACHE_COUNTER_STALENESS`, see `main.conditional`
+        return [(Topic, pk) for pk in pks]
+
+    def set_initial_ranking(self, title):
+        self.slug = slugify(title, allow_unicode=True)[:48]
+        self.hot_score = hot(self.likes, self.dislikes, self.date_created or timezone.now())
+
+    def prepare_insert(self):
+        super().prepare_insert()
+        self.set_initial_ranking(self.title)
+
+    @classmethod
+    def get_ranking_updates(cls, score_delta):
+        # The time part of the hot score is constant, so only its vote part is swapped
+        return {'hot_score': F('hot_score') - hot_order_expression(F('score'))
+                             + hot_order_expression(F('score') + score_delta)}
+
+    def next_post_seq(self, using=None, count=1):
+        """
+        Returns the next post sequence number of this topic, or the last of the next `count` ones.
+        The topic row is only locked for one statement, like a database sequence, so a rolled back post
+        leaves a gap. Pages are found by `seq`, which must follow the order of the posts without large
+        gaps, so every reply to a topic still updates its row here, even with `TOPIC_COUNTER_SHARDS`.
+        Inside a transaction, the update then runs on a connection of its own (see `helpers.side_connection`),
+        unless the topic is not committed yet or the transaction locked its row.
+        """
+        using = self.get_database(using)
+        connection = connections[using]
+        if connection.vendor == 'postgresql':
+            sql = (f'UPDATE {connection.ops.quote_name(self._meta.db_table)} '
+                   f'SET last_post_seq = last_post_seq + %s WHERE id = %s RETURNING last_post_seq')
+            row = None
+            if connection.in_atomic_block and getattr(settings, 'TOPIC_COUNTER_SHARDS', 0):
+                try:
+                    lock_timeout = getattr(settings, 'POST_SEQ_LOCK_TIMEOUT', 100)
+                    with side_connection(using, lock_timeout).cursor() as cursor:
+                        cursor.execute(sql, [count, self.pk])
+                        row = cursor.fetchone()
+                except connection.Database.Error:
+                    # The row stayed locked, by this transaction or another one as long
+                    row = None
+            if row is None:
+                with connection.cursor() as cursor:
+                    cursor.execute(sql, [count, self.pk])
+                    row = cursor.fetchone()
+            self.last_post_seq, = row
+        else:
+            with transaction.atomic(using=using):
+                topics = type(self).objects.using(using).filter(pk=self.pk)
+                topics.update(last_post_seq=F('last_post_seq') + count)
+                self.last_post_seq = topics.values_list('last_post_seq', flat=True).get()
+        self._store_loaded_values(['last_post_seq'])
+        return self.last_post_seq
+
+    def count_posts(self, delta, using=None):
+        """
+        Adds `delta` to `post_count` and, for a new post, bumps `last_post_at`. With `TOPIC_COUNTER_SHARDS`,
+        the change goes to a random `TopicCounterShard` row instead, so that the topic row is not locked
+        until the reply commits: concurrent replies to the same topic only wait for each other during
+        the single statement of `next_post_seq`.
+        """
+        using = self.get_database(using)
+        last_post_at = timezone.now() if delta > 0 else None
+        shards = getattr(settings, 'TOPIC_COUNTER_SHARDS', 0)
+        if shards:
+            TopicCounterShard.objects.using(using).add(self.pk, delta, last_post_at, shards)
+            self.post_count += delta
+            if last_post_at:
+                self.last_post_at = last_post_at
+        else:
+            updates = {'post_count': F('post_count') + delta, 'version': F('version') + 1}
+            if last_post_at:
+                updates['last_post_at'] = last_post_at
+            topics = type(self).objects.using(using).filter(pk=self.pk)
+            topics.update(**updates)
+            self.post_count, self.last_post_at = topics.values_list('post_count', 'last_post_at').get()
+        # Keep the counters out of the dirty fields so that a later save never writes them
+        self._store_loaded_values(['post_count', 'last_post_at'])
+        transaction.on_commit(partial(page_cache.touch, [page_cache.thread_tag(self.pk)]), using=using)
+        transaction.on_commit(partial(page_cache.touch, [page_cache.topic_tag(self.pk)], counters=True), using=using)
+
+    def create_posts(self, posts, using=None):
+        """
+        Adds new `posts` to this topic with a few statements for the whole list, instead of the ones of
+        `Post.save` for every post: one sequence number allocation, a `bulk_create` and one counter update.
+        """
+        posts = list(posts)
+        if not posts:
+            return posts
+        using = self.get_database(using)
+        last_seq = self.next_post_seq(using, count=len(posts))
+        for seq, post in enumerate(posts, start=last_seq - len(posts) + 1):
+            post.topic, post.seq = self, seq
+        with transaction.atomic(using=using):
+            Post.objects.using(using).bulk_create(posts)
+            self.count_posts(len(posts), using)
+        return posts
+
     def get_absolute_url(self):
         kwargs = {
-            'topic_id': self.id,
+            'topic_id': self.public_id,
             'topic_slug': self.slug,
             'board': self.board.name
         }
@@ -143,43 +640,375 @@ class Topic(Votable):
 class Post(Votable):
     author = models.ForeignKey('User', related_name='posts', on_delete=models.SET_NULL, null=True)
     topic = models.ForeignKey('Topic', related_name='posts', on_delete=models.CASCADE)
+    # Position of the post in its topic, from 1. Deleted posts leave gaps.
+    seq = models.PositiveIntegerField(default=0, editable=False)
+
+    BOARD_LOOKUP = 'topic__board_id'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['topic', 'seq'], name='unique_post_seq_per_topic'),
+        ]
 
     def __str__(self):
         return f'{self.id} - {self.author} - {self.content[:20]}...'
 
+    def get_shard(self):
+        # Posts are stored with their topic
+        return shard_of(self.topic_id)
+
+    def get_changed_versions(self, created):
+        # The topic of a new post is bumped by `Topic.count_posts`
+        return [] if created else [(Topic, self.topic_id)]
+
+    @classmethod
+    def get_counter_versions(cls, pks, using=None):
+        return [(Topic, topic_id) for queryset, database_pks in cls.objects.using(using).by_database(pks)
+                for topic_id in queryset.filter(pk__in=database_pks).values_list('topic_id', flat=True).distinct()]
+
     def save(self, force_insert=False, force_update=False, using=None,
              update_fields=None):
-        # Initially, before first save, this is None
-        if self.id is None or len(self.id) == 0:
-            self.topic.post_count += 1
-            self.topic.save()
+        if self._state.adding:
+            using = self.get_database(using)
+            self.seq = self.topic.next_post_seq(using)
+            with transaction.atomic(using=using):
+                super().save(force_insert=force_insert, force_update=force_update, using=using,
+                             update_fields=update_fields)
+                self.topic.count_posts(1, using)
+            return
         super().save(force_insert=force_insert, force_update=force_update, using=using,
                      update_fields=update_fields)
 
-    # TODO ... fix this ... currently not working at all
     def delete(self, using=None, keep_parents=False):
-        self.topic.post_count -= 1
-        self.topic.save()
-        super().delete(using, keep_parents)
+        using = self.get_database(using)
+        with transaction.atomic(using=using):
+            self.topic.count_posts(-1, using)
+            # The quote edges of the post are deleted with it
+            Quote.objects.using(using).touch_quoted(set(self.quotes.values_list('quoted_id', flat=True)))
+            return super().delete(using, keep_parents)
+
+    def get_page(self):
+        """ Returns the page of the topic this post is on, see `main.pagination.SequencePaginator`. """
+        return max(math.ceil(self.seq / getattr(settings, 'VOTABLE_PAGE_SIZE', 30)), 1)
 
     def get_absolute_url(self):
-        page_size = getattr(settings, 'VOTABLE_PAGE_SIZE', 30)
-        page = math.ceil(self.topic.post_count / page_size)
-        return self.topic.get_absolute_url() + f'?page={page}#{self.id}'
+        return self.topic.get_absolute_url() + f'?page={self.get_page()}#{self.public_id}'
+
 
+class TopicCounterShardQuerySet(ShardedQuerySet):
 
-class VoteQuerySet(models.QuerySet):
+    def add(self, topic_id, post_count, last_post_at=None, shards=1):
+        """
+        Adds `post_count` to one of the first `shards` counter rows of a topic, picked at random, and bumps
+        its `version`. On PostgreSQL this is a single `INSERT ... ON CONFLICT DO UPDATE`.
+        """
+        shard = random.randrange(shards)
+        connection = connections[self.db]
+        if connection.vendor == 'postgresql':
+            table = connection.ops.quote_name(TopicCounterShard._meta.db_table)
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'INSERT INTO {table} (topic_id, shard, post_count, last_post_at, version) '
+                    f'VALUES (%s, %s, %s, %s, 1) '
+                    f'ON CONFLICT (topic_id, shard) DO UPDATE SET post_count = {table}.post_count + EXCLUDED.post_count, '
+                    f'last_post_at = GREATEST({table}.last_post_at, EXCLUDED.last_post_at), '
+                    f'version = {table}.version + 1',
+                    [topic_id, shard, post_count, last_post_at])
+            return
+
+        with transaction.atomic(using=self.db):
+            counter, created = self.get_or_create(topic_id=topic_id, shard=shard, defaults={
+                'post_count': post_count, 'last_post_at': last_post_at, 'version': 1})
+            if not created:
+                updates = {'post_count': F('post_count') + post_count, 'version': F('version') + 1}
+                if last_post_at and (counter.last_post_at is None or last_post_at > counter.last_post_at):
+                    updates['last_post_at'] = last_post_at
+                self.filter(pk=counter.pk).update(**updates)
+
+    def pending(self, topic_ids):
+        """ Returns the counts not yet folded into the topics of `topic_ids`, keyed by topic id. """
+        return {row.pop('topic'): row for queryset, database_topic_ids in self.by_database(topic_ids)
+                for row in queryset.filter(topic__in=database_topic_ids).values('topic').annotate(
+                    post_count=Sum('post_count'), last_post_at=Max('last_post_at'))}
+
+    def fold(self, topic_id):
+        """ Moves the counts of the shards of a topic into the `Topic` row and returns the folded `post_count`. """
+        if not self._db:
+            return self.on_shard_of(topic_id).fold(topic_id)
+        with transaction.atomic(using=self.db):
+            shards = list(self.select_for_update().filter(topic=topic_id).order_by('shard'))
+            post_count = sum(shard.post_count for shard in shards)
+            last_post_ats = [shard.last_post_at for shard in shards if shard.last_post_at]
+            updates = {'post_count': F('post_count') + post_count}
+            if last_post_ats:
+                last_post_at = Value(max(last_post_ats), output_field=models.DateTimeField())
+                updates['last_post_at'] = Greatest(Coalesce('last_post_at', last_post_at), last_post_at)
+            Topic.objects.using(self.db).filter(pk=topic_id).update(**updates)
+            self.filter(pk__in=[shard.pk for shard in shards]).update(post_count=0, last_post_at=None)
+        return post_count
+
+
+class TopicCounterShard(models.Model):
+    """ Part of the `post_count` and `last_post_at` of a topic, see `Topic.count_posts`. """
+    topic = models.ForeignKey('Topic', related_name='counter_shards', on_delete=models.CASCADE)
+    shard = models.PositiveSmallIntegerField()
+    post_count = models.IntegerField(default=0)
+    last_post_at = models.DateTimeField(null=True)
+    # Bumped with the counts and never folded: the version of the topic page adds the versions of its shards
+    version = models.PositiveIntegerField(default=0)
+
+    objects = TopicCounterShardQuerySet.as_manager()
+
+    # Stored with their topic, see `koboland.db_routers`
+    SHARDED = True
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['topic', 'shard'], name='unique_topic_counter_shard'),
+        ]
+
+    def get_shard(self):
+        return shard_of(self.topic_id)
+
+
+class VoteQuerySet(ShardedQuerySet):
     TYPE_TOPIC = 'topic'
     TYPE_POST = 'post'
 
+    # Filtering on the (per-process cached) content type id avoids a join on `django_content_type`
     def on_topics(self):
-        return self.filter(content_type__model='topic')
+        return self.filter(content_type_id=self.content_type_id(self.TYPE_TOPIC))
 
     def on_posts(self):
-        return self.filter(content_type__model='post')
+        return self.filter(content_type_id=self.content_type_id(self.TYPE_POST))
 
     def get_object(self, voter, votable_type, votable_id):
-        return self.get(object_id=votable_id, voter=voter, content_type__model=votable_type)
+        return self.on_shard_of(votable_id).get(object_id=votable_id, voter=voter,
+                                                content_type_id=self.content_type_id(votable_type))
+
+    def get_viewer_states(self, voter, pks):
+        """
+        Returns the `(vote_type, is_shared)` of the votes of `voter` on the votables `pks`, a dict of lists of
+        primary keys by votable model, keyed by `(model, pk)`. Votables without a vote are left out. This is one
+        lookup on the `(voter, content_type, object_id)` index that never loads other users' votes.
+        """
+        if not self._db:
+            # Votes are stored with their votable
+            pks_by_database = defaultdict(dict)
+            for model, model_pks in pks.items():
+                for queryset, database_pks in self.by_database(model_pks):
+                    pks_by_database[queryset.db][model] = database_pks
+            return {key: state for database, database_pks in pks_by_database.items()
+                    for key, state in self.using(database).get_viewer_states(voter, database_pks).items()}
+        models_by_id = {ContentType.objects.get_for_model(model).id: model for model, model_pks in pks.items()
+                        if model_pks}
+        if not models_by_id:
+            return {}
+        lookups = Q()
+        for content_type_id, model in models_by_id.items():
+            lookups |= Q(content_type_id=content_type_id, object_id__in=pks[model])
+        votes = self.filter(lookups, voter=voter).values_list('content_type_id', 'object_id', 'vote_type', 'is_shared')
+        return {(models_by_id[content_type_id], pk): tuple(state) for content_type_id, pk, *state in votes}
+
+    def merge_viewer_state(self, voter, votables):
+        """ Sets the `vote_type` (None without a vote) and `is_shared` of `voter` on already fetched votables. """
+        pks = defaultdict(list)
+        for votable in votables:
+            pks[type(votable)].append(votable.pk)
+        states = self.get_viewer_states(voter, pks)
+        for votable in votables:
+            votable.vote_type, votable.is_shared = states.get((type(votable), votable.pk), (None, False))
+        return votables
+
+    @classmethod
+    def votable_model(cls, votable_type):
+        if votable_type == cls.TYPE_TOPIC:
+            return Topic
+        if votable_type == cls.TYPE_POST:
+            return Post
+        raise ValueError(f'Unknown votable_type `{votable_type}`')
+
+    @classmethod
+    def content_type_id(cls, votable_type):
+        return ContentType.objects.get_for_model(cls.votable_model(votable_type)).id
+
+    def cast(self, voter, votable_type, votable_id, vote_type=None, is_shared=None):
+        """
+        Sets the vote of `voter` on a votable (`vote_type`/`is_shared` may be None to leave them
+        unchanged), updates the votable's counters and returns the new counters.
+        Raises `DoesNotExist` of the votable model if there is no such votable.
+        """
+        if not self._db:
+            # Votes are stored with their votable
+            return self.on_shard_of(votable_id).cast(voter, votable_type, votable_id, vote_type, is_shared)
+        model = self.votable_model(votable_type)
+        with transaction.atomic(using=self.db):
+            previous, current = self.upsert(voter, votable_type, votable_id, vote_type, is_shared)
+            deltas = Vote.counter_deltas(*(previous or (Vote.NO_VOTE, False)), *current)
+            counters = model.objects.using(self.db).apply_counter_deltas(votable_id, **deltas)
+            if current == (Vote.NO_VOTE, False):
+                # No point storing vote that indicates `not-shared && NO_VOTE`
+                self.filter(voter=voter, content_type_id=self.content_type_id(votable_type),
+                            object_id=votable_id).delete()
+        return counters
+
+    UPSERT_SQL = """
+        WITH previous AS (
+            SELECT id, vote_type, is_shared FROM {table}
+            WHERE voter_id = %(voter)s AND content_type_id = %(content_type)s AND object_id = %(object_id)s
+            FOR UPDATE
+        ), updated AS (
+            UPDATE {table} SET vote_type = COALESCE(%(vote_type)s, {table}.vote_type),
+                               is_shared = COALESCE(%(is_shared)s, {table}.is_shared)
+            FROM previous WHERE {table}.id = previous.id
+            RETURNING previous.vote_type, previous.is_shared, {table}.vote_type, {table}.is_shared
+        ), inserted AS (
+            INSERT INTO {table} (voter_id, content_type_id, object_id, vote_type, is_shared, vote_time)
+            SELECT %(voter)s, %(content_type)s, %(object_id)s,
+                   COALESCE(%(vote_type)s, {no_vote}), COALESCE(%(is_shared)s, FALSE), %(now)s
+            WHERE NOT EXISTS (SELECT 1 FROM previous)
+            ON CONFLICT (voter_id, content_type_id, object_id) DO NOTHING
+            RETURNING NULL::integer, NULL::boolean, vote_type, is_shared
+        )
+        SELECT * FROM updated UNION ALL SELECT * FROM inserted
+    """
+
+    def upsert(self, voter, votable_type, votable_id, vote_type=None, is_shared=None):
+        """
+        Inserts or updates the vote of `voter` on a votable, relying on the unique
+        `(voter, content_type, object_id)` key, without touching the votable counters.
+
+        Returns `(previous, current)` `(vote_type, is_shared)` pairs, `previous` being None if the
+        vote did not exist. On PostgreSQL this is a single statement that locks the existing vote
+        (so that concurrent double clicks see each other's result) and updates it, or inserts it
+        `ON CONFLICT DO NOTHING`. A concurrent insert of the same vote makes it return no row,
+        and it is retried once the other transaction committed. Other databases lock the row
+        and update it in separate queries.
+        """
+        if not self._db:
+            return self.on_shard_of(votable_id).upsert(voter, votable_type, votable_id, vote_type, is_shared)
+        params = {
+            'voter': voter.pk, 'content_type': self.content_type_id(votable_type), 'object_id': votable_id,
+            'vote_type': vote_type, 'is_shared': is_shared, 'now': timezone.now(),
+        }
+        connection = connections[self.db]
+        if connection.vendor == 'postgresql':
+            sql = self.UPSERT_SQL.format(table=connection.ops.quote_name(Vote._meta.db_table), no_vote=Vote.NO_VOTE)
+            row = None
+            with connection.cursor() as cursor:
+                while row is None:
+                    cursor.execute(sql, params)
+                    row = cursor.fetchone()
+            previous_vote_type, previous_is_shared, *current = row
+            previous = None if previous_vote_type is None else (previous_vote_type, previous_is_shared)
+            return previous, tuple(current)
+
+        with transaction.atomic(using=self.db):
+            lookup = {'voter': voter, 'content_type_id': params['content_type'], 'object_id': params['object_id']}
+            vote = self.select_for_update().filter(**lookup).first()
+            previous = None if vote is None else (vote.vote_type, vote.is_shared)
+            vote_type = vote_type if vote_type is not None else previous[0] if previous else Vote.NO_VOTE
+            is_shared = is_shared if is_shared is not None else previous[1] if previous else False
+            if vote is None:
+                # `bulk_create` bypasses `Vote.save`, which would also update the counters
+                self.bulk_create([Vote(vote_type=vote_type, is_shared=is_shared, **lookup)])
+            elif previous != (vote_type, is_shared):
+                self.filter(pk=vote.pk).update(vote_type=vote_type, is_shared=is_shared)
+        return previous, (vote_type, is_shared)
+
+    def apply_batch(self, voter, operations):
+        """
+        Applies a list of vote operations of a single voter in one transaction.
+
+        Every operation is a dict with `votable_type`, `votable_id`, `vote_type` and `is_shared`
+        (`vote_type`/`is_shared` may be None to leave them unchanged), applied in order.
+        Vote rows are created, updated and deleted in bulk, and the counter deltas are
+        aggregated so that each affected votable is written once. The votes are read locked,
+        like in `upsert`, so that concurrent votes of the voter never count the same change twice.
+
+        Returns `(results, counters)`: the vote state after each operation (or an `error`),
+        and the final counters keyed by votable_type and votable_id. The votes on the votables of
+        each shard database are applied in a transaction on that database.
+        """
+        if not self._db:
+            databases = [id_database(op['votable_id']) for op in operations]
+            batches = {database: self.using(database).apply_batch(
+                voter, [op for op, op_database in zip(operations, databases) if op_database == database])
+                for database in dict.fromkeys(databases)}
+            results = {database: iter(database_results) for database, (database_results, _) in batches.items()}
+            counters = defaultdict(dict)
+            for _, database_counters in batches.values():
+                for votable_type, votable_counters in database_counters.items():
+                    counters[votable_type].update(votable_counters)
+            return [next(results[database]) for database in databases], dict(counters)
+
+        ids = defaultdict(set)
+        for op in operations:
+            if op['votable_type'] in (self.TYPE_TOPIC, self.TYPE_POST):
+                ids[op['votable_type']].add(op['votable_id'])
+        content_types = {votable_type: ContentType.objects.get_for_model(self.votable_model(votable_type))
+                         for votable_type in ids}
+        # Votes are locked in the same order by every batch
+        votable_types = sorted(ids, key=lambda votable_type: content_types[votable_type].id)
+
+        with transaction.atomic(using=self.db):
+            existing_ids, votes = {}, {}
+            for votable_type in votable_types:
+                model = self.votable_model(votable_type)
+                existing_ids[votable_type] = set(model.objects.using(self.db).filter(id__in=ids[votable_type])
+                                                 .values_list('id', flat=True))
+            # Every vote of the batch gets a row, empty if the voter had none, so that they can all be locked:
+            # a concurrent `cast` or batch of the voter waits for this one, and then sees its result
+            self.bulk_create([Vote(voter=voter, content_type=content_types[votable_type], object_id=votable_id)
+                              for votable_type in votable_types for votable_id in sorted(existing_ids[votable_type])],
+                             ignore_conflicts=True)
+            for votable_type in votable_types:
+                for vote in self.select_for_update().filter(
+                        voter=voter, content_type=content_types[votable_type],
+                        object_id__in=existing_ids[votable_type]).order_by('object_id'):
+                    votes[(votable_type, vote.object_id)] = vote
+
+            results = []
+            states = {key: (vote.vote_type, vote.is_shared) for key, vote in votes.items()}
+            deltas = defaultdict(lambda: {'likes': 0, 'dislikes': 0, 'shares': 0})
+            for op in operations:
+                key = (op['votable_type'], op['votable_id'])
+                if key not in states:
+                    results.append({'votable_type': key[0], 'votable_id': key[1], 'error': 'votable not found'})
+                    continue
+                vote_type, is_shared = states[key]
+                new_vote_type = vote_type if op.get('vote_type') is None else op['vote_type']
+                new_is_shared = is_shared if op.get('is_shared') is None else op['is_shared']
+                for field, delta in Vote.counter_deltas(vote_type, is_shared, new_vote_type, new_is_shared).items():
+                    deltas[key][field] += delta
+                states[key] = (new_vote_type, new_is_shared)
+                results.append({'votable_type': key[0], 'votable_id': key[1],
+                                'vote_type': new_vote_type, 'is_shared': new_is_shared})
+
+            to_update, to_delete = [], []
+            for key, (vote_type, is_shared) in states.items():
+                vote = votes[key]
+                if vote_type == Vote.NO_VOTE and not is_shared:
+                    # No point storing vote that indicates `not-shared && NO_VOTE`
+                    to_delete.append(vote.pk)
+                elif (vote.vote_type, vote.is_shared) != (vote_type, is_shared):
+                    vote.vote_type, vote.is_shared = vote_type, is_shared
+                    to_update.append(vote)
+            self.bulk_update(to_update, ['vote_type', 'is_shared'])
+            self.filter(pk__in=to_delete).delete()
+
+            for (votable_type, votable_id), votable_deltas in deltas.items():
+                self.votable_model(votable_type).objects.using(self.db).increment_counters(votable_id,
+                                                                                           **votable_deltas)
+            counters = {votable_type: self.votable_model(votable_type).objects.using(self.db).get_counters(votable_ids)
+                        for votable_type, votable_ids in existing_ids.items()}
+        if get_counter_buffer() is not None:
+            # Buffered deltas only reach the buffer once the transaction commits
+            for (votable_type, votable_id), votable_deltas in deltas.items():
+                votable_counters = counters[votable_type][votable_id]
+                for field, delta in votable_deltas.items():
+                    votable_counters[field] += delta
+        return results, counters
 
     def create_object(self, user, votable=None, votable_type=None, votable_id=None, vote_type=None, is_shared=None):
         """
@@ -207,7 +1036,9 @@ class VoteQuerySet(models.QuerySet):
         else:
             content_object = Topic.objects.get(id=votable_id) if votable_type == self.TYPE_TOPIC else Post.objects.get(
                 id=votable_id)
-        return self.create(object_id=votable_id, content_object=content_object, voter=user, **kwargs)
+        # Votes are stored with their votable
+        return self.on_shard_of(votable_id).create(object_id=votable_id, content_object=content_object, voter=user,
+                                                   **kwargs)
 
 
 class Vote(models.Model):
@@ -225,81 +1056,293 @@ class Vote(models.Model):
     is_shared = models.BooleanField(default=False)
 
     content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
-    object_id = models.CharField(max_length=koboland_models.RandomPrimaryIdModel.CRYPT_KEY_LEN_MAX)
+    object_id = models.BigIntegerField()
     content_object = GenericForeignKey('content_type', 'object_id')
 
     objects = VoteQuerySet.as_manager()
 
+    # Votes are stored with their votable, see `koboland.db_routers`
+    SHARDED = True
+
     class Meta:
         index_together = [
             ['content_type', 'object_id']
         ]
+        constraints = [
+            models.UniqueConstraint(fields=['voter', 'content_type', 'object_id'], name='unique_vote_per_votable'),
+        ]
 
     def __str__(self):
         return f'{self.vote_type} - votable_type:{self.content_type}'
 
+    def get_shard(self):
+        return None if self.object_id is None else shard_of(self.object_id)
+
     def set_shared(self, is_shared):
         self.change_vote(new_share_status=is_shared)
 
-    def change_vote(self, new_vote_type=None, new_share_status=None):
-        votable = self.content_object
+    @classmethod
+    def counter_deltas(cls, old_vote_type, old_is_shared, new_vote_type, new_is_shared):
+        """ Returns the signed changes to a votable's `likes`, `dislikes` and `shares` for a vote transition. """
+        return {
+            'likes': int(new_vote_type == cls.LIKE) - int(old_vote_type == cls.LIKE),
+            'dislikes': int(new_vote_type == cls.DIS_LIKE) - int(old_vote_type == cls.DIS_LIKE),
+            'shares': int(bool(new_is_shared)) - int(bool(old_is_shared)),
+        }
 
+    def change_vote(self, new_vote_type=None, new_share_status=None):
+        """ Changes the vote and returns the new counters of the votable. """
+        old_vote_type, old_is_shared = self.vote_type, self.is_shared
         if new_vote_type is not None:
-            if self.vote_type == self.LIKE and new_vote_type == self.DIS_LIKE:
-                votable.likes -= 1
-                votable.dislikes += 1
-            elif self.vote_type == self.LIKE and new_vote_type == self.NO_VOTE:
-                votable.likes -= 1
-            elif self.vote_type == self.DIS_LIKE and new_vote_type == self.LIKE:
-                votable.likes += 1
-                votable.dislikes -= 1
-            elif self.vote_type == self.DIS_LIKE and new_vote_type == self.NO_VOTE:
-                votable.dislikes -= 1
-            elif self.vote_type == self.NO_VOTE and new_vote_type == self.LIKE:
-                votable.likes += 1
-            elif self.vote_type == self.NO_VOTE and new_vote_type == self.DIS_LIKE:
-                votable.dislikes += 1
             self.vote_type = new_vote_type
-
         if new_share_status is not None:
-            if self.is_shared is True and new_share_status is False:
-                votable.shares -= 1
-            elif self.is_shared is False and new_share_status is True:
-                votable.shares += 1
             self.is_shared = new_share_status
-        votable.save()
-        if (self.vote_type is None or self.vote_type == self.NO_VOTE) and (
-                self.is_shared is None or self.is_shared is False):
-            self.delete()
-        else:
-            self.save()
+
+        deltas = self.counter_deltas(old_vote_type, old_is_shared, self.vote_type, self.is_shared)
+        with transaction.atomic(using=self._state.db):
+            counters = self.content_object.apply_counter_deltas(**deltas)
+            if (self.vote_type is None or self.vote_type == self.NO_VOTE) and (
+                    self.is_shared is None or self.is_shared is False):
+                self.delete()
+            else:
+                self.save()
+        return counters
 
     def save(self, force_insert=False, force_update=False, using=None,
              update_fields=None):
         # Initially created
         if not self.pk:
-            votable = self.content_object
-            if self.vote_type == self.LIKE:
-                votable.likes += 1
-            elif self.vote_type == self.DIS_LIKE:
-                votable.dislikes += 1
-
-            if self.is_shared:
-                votable.shares += 1
-            votable.save()
-        super().save(force_insert, force_update, using, update_fields)
+            using = using or router.db_for_write(Vote, instance=self)
+            deltas = self.counter_deltas(self.NO_VOTE, False, self.vote_type, self.is_shared)
+            with transaction.atomic(using=using):
+                self.content_object.apply_counter_deltas(**deltas)
+                super().save(force_insert, force_update, using, update_fields)
+        else:
+            super().save(force_insert, force_update, using, update_fields)
 
     def delete(self, using=None, keep_parents=False):
-        votable = self.content_object
-        if self.vote_type == self.LIKE:
-            votable.likes -= 1
-        elif self.vote_type == self.DIS_LIKE:
-            votable.dislikes -= 1
+        deltas = self.counter_deltas(self.vote_type, self.is_shared, self.NO_VOTE, False)
+        using = using or router.db_for_write(Vote, instance=self)
+        with transaction.atomic(using=using):
+            self.content_object.apply_counter_deltas(**deltas)
+            return super().delete(using, keep_parents)
+
+
+class LeaderboardQuerySet(models.QuerySet):
+
+    def record(self, model, pk, score_delta, at=None):
+        """
+        Adds `score_delta` to the day, week, month and all-time leaderboard entries of the votable
+        of `model` with primary key `pk`, for the periods containing `at` (now by default).
+        On PostgreSQL the entries are upserted in a single `INSERT ... ON CONFLICT DO UPDATE`.
+        """
+        board_id = model.objects.on_shard_of(pk).filter(pk=pk).values_list(model.BOARD_LOOKUP, flat=True).first()
+        if board_id is None:
+            return
+        # Keys from the counter buffers are strings
+        pk = model._meta.pk.to_python(pk)
+        content_type_id = ContentType.objects.get_for_model(model).id
+        starts = period_starts(timezone.localdate(at))
+
+        connection = connections[self.db]
+        if connection.vendor == 'postgresql':
+            table = connection.ops.quote_name(LeaderboardEntry._meta.db_table)
+            values = ', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(starts))
+            params = []
+            for period, start in starts.items():
+                params += [content_type_id, pk, board_id, period, start, score_delta]
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'INSERT INTO {table} (content_type_id, object_id, board_id, period, period_start, score) '
+                    f'VALUES {values} ON CONFLICT (content_type_id, object_id, period, period_start) '
+                    f'DO UPDATE SET score = {table}.score + EXCLUDED.score', params)
+            return
+
+        with transaction.atomic(using=self.db):
+            for period, start in starts.items():
+                entry, created = self.get_or_create(content_type_id=content_type_id, object_id=pk, period=period,
+                                                    period_start=start,
+                                                    defaults={'board_id': board_id, 'score': score_delta})
+                if not created:
+                    self.filter(pk=entry.pk).update(score=F('score') + score_delta)
+
+    def top(self, model, period, board=None, at=None):
+        """
+        Returns the leaderboard entries of `model` votables for the `period` containing `at` (now by default),
+        best first. The ordering matches the leaderboard indexes, so every page is an index range scan.
+        """
+        entries = self.filter(content_type_id=ContentType.objects.get_for_model(model).id, period=period,
+                              period_start=period_starts(timezone.localdate(at))[period])
+        if board is not None:
+            entries = entries.filter(board=board)
+        return entries.order_by('-score', 'object_id')
+
+    @staticmethod
+    def load_votables(model, entries):
+        """ Returns the `model` votables of `entries` in the same order, each with its `period_score`. """
+        related = ('topic__board', 'author') if model is Post else ('board', 'author')
+        votables = {}
+        for queryset, pks in model.objects.by_database([entry.object_id for entry in entries]):
+            votables.update(queryset.select_related(*related).in_bulk(pks))
+        ordered = []
+        for entry in entries:
+            votable = votables.get(entry.object_id)
+            if votable is not None:
+                votable.period_score = entry.score
+                ordered.append(votable)
+        return ordered
+
+
+class LeaderboardEntry(models.Model):
+    """
+    Net score (likes minus dislikes) received by a votable from the votes cast during a day, week,
+    month or ever. Entries are fed incrementally whenever the vote counters of a votable are written.
+    """
+    PERIODS = (
+        (PERIOD_DAY, _('Today')), (PERIOD_WEEK, _('This week')), (PERIOD_MONTH, _('This month')),
+        (PERIOD_ALL, _('All time')),
+    )
+
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.BigIntegerField()
+    content_object = GenericForeignKey('content_type', 'object_id')
+    board = models.ForeignKey('Board', on_delete=models.CASCADE)
+    period = models.CharField(max_length=5, choices=PERIODS)
+    period_start = models.DateField()
+    score = models.IntegerField(default=0)
+
+    objects = LeaderboardQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['content_type', 'object_id', 'period', 'period_start'],
+                                    name='unique_leaderboard_entry'),
+        ]
+        indexes = [
+            models.Index(fields=['content_type', 'period', 'period_start', '-score', 'object_id'],
+                         name='leaderboard_top_idx'),
+            models.Index(fields=['content_type', 'period', 'period_start', 'board', '-score', 'object_id'],
+                         name='leaderboard_board_top_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.content_type} {self.object_id} - {self.period} {self.period_start}: {self.score}'
+
+
+class QuoteQuerySet(ShardedQuerySet):
+
+    @staticmethod
+    def quoted_pks(content):
+        """ Returns the primary keys of the votables quoted in `content`, leaving out what are not public ids. """
+        pks = (Votable.pk_from_public_id(quoted_id) for quoted_id in quoted_ids(content))
+        return [pk for pk in pks if pk is not None]
+
+    def sync(self, votable):
+        """ Replaces the quote edges of `votable` with the ids quoted in its current `content`. """
+        content_type = ContentType.objects.get_for_model(votable)
+        pks = set(self.quoted_pks(votable.content))
+        edges = self.filter(source_content_type=content_type, source_id=votable.pk)
+        existing = set(edges.values_list('quoted_id', flat=True))
+        edges.filter(quoted_id__in=existing - pks).delete()
+        self.bulk_create([Quote(source_content_type=content_type, source_id=votable.pk, quoted_id=pk)
+                          for pk in pks - existing], ignore_conflicts=True)
+        self.touch_quoted(existing ^ pks)
+
+    def index(self, votables):
+        """ Adds the quote edges of new `votables`, with one insert for all of them. """
+        edges = [Quote(source_content_type=ContentType.objects.get_for_model(votable), source_id=votable.pk,
+                       quoted_id=pk)
+                 for votable in votables for pk in self.quoted_pks(votable.content)]
+        self.bulk_create(edges, ignore_conflicts=True)
+        self.touch_quoted({edge.quoted_id for edge in edges})
+
+    def touch_quoted(self, pks):
+        """
+        Refreshes the pages showing the `quote_count` of the posts `pks` once the changes of their quotes
+        are committed: their tags in the page cache, and the versions of their topics.
+        """
+        if not pks:
+            return
+        tags = [page_cache.post_tag(pk) for pk in pks]
+        transaction.on_commit(partial(page_cache.touch, tags), using=self.db)
+        # The quoted posts may be on the database of another shard
+        transaction.on_commit(partial(Post.bump_counter_versions, pks), using=self.db)
+
+    def counts(self, pks):
+        """ Returns a dict mapping each primary key in `pks` to the number of votables quoting it, with one query. """
+        counts = dict.fromkeys(pks, 0)
+        # Quotes are stored with the quoting votable, on any shard
+        for queryset in self.on_every_database():
+            for row in queryset.filter(quoted_id__in=pks).values('quoted_id').annotate(count=Count('id')):
+                counts[row['quoted_id']] += row['count']
+        return counts
+
+    @staticmethod
+    def permalinks(public_ids):
+        """
+        Returns a dict mapping the public ids in `public_ids` to the URL of the post (or topic) with that id.
+        Ids are unique across posts and topics, so topics are only looked up for the ids of no post: at most a
+        lookup of each on the database of every shard of the ids, whatever the number of ids.
+        """
+        pks = {Votable.pk_from_public_id(public_id) for public_id in public_ids} - {None}
+        urls = {post.public_id: post.get_absolute_url()
+                for posts, database_pks in Post.objects.by_database(pks)
+                for post in posts.filter(pk__in=database_pks).select_related('topic__board').only(
+                    'id', 'seq', 'topic__id', 'topic__slug', 'topic__board__name')}
+        missing = pks - {Votable.pk_from_public_id(public_id) for public_id in urls}
+        if missing:
+            urls.update((topic.public_id, topic.get_absolute_url())
+                        for topics, database_pks in Topic.objects.by_database(missing)
+                        for topic in topics.filter(pk__in=database_pks).select_related('board').only(
+                            'id', 'slug', 'board__name'))
+        return urls
+
+    def resolve(self, votables):
+        """
+        Points the quote links in the `content_html` of already fetched votables to the permalinks
+        of the quoted posts, and sets their `quote_count`, with one lookup for the whole list.
+        """
+        links = {votable.pk: QUOTE_LINK_RE.findall(votable.get_content_html()) for votable in votables}
+        urls = self.permalinks({quoted_id for ids in links.values() for quoted_id in ids})
+        counts = self.counts([votable.pk for votable in votables])
+        for votable in votables:
+            if links[votable.pk]:
+                votable.content_html = resolve_quote_links(votable.content_html, urls)
+                # The resolved links are only for display, a later save must not write them
+                votable._store_loaded_values(['content_html'])
+            votable.quote_count = counts[votable.pk]
+        return votables
+
+
+class Quote(models.Model):
+    """
+    Edge from a votable to a post (or topic) it quotes with a `<<<[[author|id]]...<<<` block.
+    Edges are replaced from the content whenever it is saved, see `QuoteQuerySet.sync`.
+    """
+    source_content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    source_id = models.BigIntegerField()
+    source = GenericForeignKey('source_content_type', 'source_id')
+    # Primary key of the quoted post or topic
+    quoted_id = models.BigIntegerField()
+
+    objects = QuoteQuerySet.as_manager()
+
+    # Stored with the quoting votable, see `koboland.db_routers`
+    SHARDED = True
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['source_content_type', 'source_id', 'quoted_id'], name='unique_quote'),
+        ]
+        indexes = [
+            models.Index(fields=['quoted_id'], name='quote_quoted_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.source_content_type} {self.source_id} quotes {self.quoted_id}'
 
-        if self.is_shared:
-            votable.shares -= 1
-        votable.save()
-        super().delete(using, keep_parents)
+    def get_shard(self):
+        return shard_of(self.source_id)
 
 
 class UserManager(BaseUserManager):
@@ -346,6 +1389,8 @@ class User(AbstractUser):
     email = models.EmailField('email address', unique=True)
     is_banned = models.BooleanField(default=False)
     boards = models.ManyToManyField('Board', related_name='followers')
+    # The follows of a topic are stored on the database of its shard, with the copy of the user there, so
+    # they are read and written from the side of the topic, e.g. `topic.followers.add(user)`
     topics_following = models.ManyToManyField('Topic', related_name='followers')
     followers = models.ManyToManyField('User', related_name='following')
 
@@ -0,0 +1,198 @@
+"""
+Cache of the topic and board pages.
+
+When `PAGE_CACHE_TIMEOUT` is set, the responses of views using `PageCacheMixin` are kept
+for that many seconds in the `PAGE_CACHE_ALIAS` cache, keyed by their URL (with its `page`,
+`cursor` and `sort`). Every page is tagged with what it shows:
+
+* `topic:<pk>` and `post:<pk>`: a topic or post of the page.
+* `thread:<pk>`: the list of posts of a topic.
+* `board:<name>` and `topics`: the list of topics of a board, and of the home page.
+
+Saving a votable, adding a post or a topic touches the tags of what changed (see `touch`), which
+drops the pages rendered before. Vote counters change much more often, so a page whose counters
+changed is still served for `PAGE_CACHE_COUNTER_STALENESS` seconds after it was rendered.
+
+Only GET requests without pending `messages` are cached, and only the body of a response is
+kept: headers like Turbolinks-Location are added by the middlewares for every request. Hits and
+misses are counted in the cache, see `get_stats`.
+
+With `cache_member_pages`, logged in readers get a page shared by all of them, rendered with
+`page_cache_holes` set in the template context. Templates then leave out the state of the user,
+fetched by the page from `ViewerStateAPI`, and put holes (`<!--page-cache-hole:name-->`) in place
+of the bits that need the request, like the CSRF token. The holes are filled on every response
+with the `HOLES` templates, which only use the request and the user.
+"""
+import hashlib
+import re
+import time
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.template.loader import render_to_string
+
+ALL_TOPICS_TAG = 'topics'
+STATS = ('hits', 'misses')
+
+HOLES = {
+    'user_nav': 'includes/user_nav.html',
+    'csrf_token': 'includes/csrf_token.html',
+}
+HOLE_RE = re.compile(rb'<!--page-cache-hole:(\w+)-->')
+
+
+def votable_tag(model, pk):
+    return f'{model._meta.model_name}:{pk}'
+
+
+def topic_tag(pk):
+    return f'topic:{pk}'
+
+
+def post_tag(pk):
+    return f'post:{pk}'
+
+
+def thread_tag(topic_pk):
+    return f'thread:{topic_pk}'
+
+
+def board_tag(name):
+    # Board names are case insensitive
+    return f'board:{name.lower()}'
+
+
+def is_enabled():
+    return getattr(settings, 'PAGE_CACHE_TIMEOUT', 0) > 0
+
+
+def get_cache():
+    return caches[getattr(settings, 'PAGE_CACHE_ALIAS', 'default')]
+
+
+def tag_key(tag, counters=False):
+    return f'page-cache:{"counters" if counters else "tag"}:{tag}'
+
+
+def touch(tags, counters=False):
+    """
+    Marks the pages tagged with any of `tags` and rendered before now as stale: right away, or once
+    they are `PAGE_CACHE_COUNTER_STALENESS` seconds old for a change of `counters`. Should be called
+    once the change is committed, so that pages rendered afterwards see it.
+    """
+    if not is_enabled() or not tags:
+        return
+    now = time.time()
+    get_cache().set_many({tag_key(tag, counters): now for tag in tags}, None)
+
+
+def page_key(request, members=False):
+    url_hash = hashlib.md5(request.build_absolute_uri().encode()).hexdigest()
+    return f'page-cache:{"member-page" if members else "page"}:{url_hash}'
+
+
+def is_cacheable(request, members=False):
+    return (is_enabled() and request.method == 'GET' and (members or not request.user.is_authenticated)
+            and not len(get_messages(request)))
+
+
+def fill_holes(request, content):
+    """ Replaces the holes of a page with their `HOLES` template rendered for `request`. """
+    return HOLE_RE.sub(lambda match: render_to_string(HOLES[match.group(1).decode()], request=request).encode(),
+                       content)
+
+
+def get_page(request, members=False):
+    """ Returns the cached response of `request`, or None if it has none or it is stale. """
+    cache = get_cache()
+    entry = cache.get(page_key(request, members))
+    if entry is not None:
+        rendered_at, tags, content, content_type = entry
+        keys = [tag_key(tag, counters) for tag in tags for counters in (False, True)]
+        touched = cache.get_many(keys)
+        staleness = getattr(settings, 'PAGE_CACHE_COUNTER_STALENESS', 0)
+        # A tag missing from the cache may have been evicted after being touched
+        if all(touched.get(tag_key(tag), rendered_at) < rendered_at for tag in tags) and (
+                time.time() < rendered_at + staleness
+                or all(touched.get(tag_key(tag, True), rendered_at) < rendered_at for tag in tags)):
+            count('hits')
+            return HttpResponse(content, content_type=content_type)
+    count('misses')
+    return None
+
+
+def store_page(request, response, tags, rendered_at, members=False):
+    """
+    Caches the rendered `response` of `request`, tagged with `tags`, unless it is not the same for
+    every reader. `rendered_at` is the time the view started reading the database.
+    """
+    if response.status_code != 200 or response.streaming or response.cookies:
+        return
+    if request.META.get('CSRF_COOKIE_USED'):
+        return
+    cache = get_cache()
+    keys = [tag_key(tag, counters) for tag in tags for counters in (False, True)]
+    # Tags never touched, or evicted, get a time that only the pages rendered before this one are stale for.
+    # `add` keeps the time of a touch made meanwhile.
+    for key in set(keys) - set(cache.get_many(keys)):
+        cache.add(key, rendered_at - 0.001, None)
+    cache.set(page_key(request, members), (rendered_at, list(tags), response.content, response['Content-Type']),
+              settings.PAGE_CACHE_TIMEOUT)
+
+
+def count(stat):
+    cache = get_cache()
+    key = f'page-cache:stats:{stat}'
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 1, None)
+
+
+def get_stats():
+    """ Returns the numbers of hits and misses of the page cache, over every process using the cache. """
+    values = get_cache().get_many([f'page-cache:stats:{stat}' for stat in STATS])
+    return {stat: values.get(f'page-cache:stats:{stat}', 0) for stat in STATS}
+
+
+class PageCacheMixin:
+    """
+    Serves the cached page of anonymous readers, and of logged in readers with `cache_member_pages`,
+    tagged by `get_page_cache_tags`. Views check `page_cache_holes` to skip loading the user's state.
+    """
+    cache_member_pages = False
+
+    def get_page_cache_tags(self, context):
+        """ Returns the tags of the page rendered with the template `context`. """
+        raise NotImplementedError
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['page_cache_holes'] = self.page_cache_holes
+        return context
+
+    def dispatch(self, request, *args, **kwargs):
+        members = self.cache_member_pages and request.user.is_authenticated
+        self.page_cache_holes = members and is_cacheable(request, members)
+        if not is_cacheable(request, members):
+            return super().dispatch(request, *args, **kwargs)
+        response = get_page(request, members)
+        if response is not None:
+            if members:
+                response.content = fill_holes(request, response.content)
+            response['X-Page-Cache'] = 'hit'
+            return response
+        rendered_at = time.time()
+        response = super().dispatch(request, *args, **kwargs)
+        response['X-Page-Cache'] = 'miss'
+        if response.status_code == 200 and hasattr(response, 'add_post_render_callback'):
+            tags = self.get_page_cache_tags(response.context_data)
+
+            def store(rendered):
+                store_page(request, rendered, tags, rendered_at, members)
+                if members:
+                    rendered.content = fill_holes(request, rendered.content)
+            response.add_post_render_callback(store)
+        return response
@@ -0,0 +1,185 @@
+import base64
+import binascii
+import json
+from collections import OrderedDict
+from datetime import date
+
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.http import Http404
+from django.utils.translation import gettext_lazy as _
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+from koboland.db_routers import across_shards
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+class KeysetPage:
+    is_keyset = True
+
+    def __init__(self, object_list, paginator, has_next, has_previous):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    @property
+    def next_cursor(self):
+        if not (self.has_next() and self.object_list):
+            return None
+        return self.paginator.encode_cursor(self.object_list[-1])
+
+    @property
+    def previous_cursor(self):
+        if not (self.has_previous() and self.object_list):
+            return None
+        return self.paginator.encode_cursor(self.object_list[0], reverse=True)
+
+
+class KeysetPaginator:
+    """
+    Paginates a queryset on an ordering such as `['-hot_score', '-id']`, which must end with a unique field.
+    A page is the `per_page` rows after (or before) the sort key of a cursor row, so there is no
+    `COUNT(*)` and no `OFFSET`, and with an index on the ordering every page is an index range scan.
+    Sharded rows that may be on several databases are read from each (see `across_shards`).
+    """
+
+    def __init__(self, queryset, ordering, per_page):
+        self.queryset = queryset
+        self.ordering = list(ordering)
+        self.per_page = per_page
+        self.fields = [(name.lstrip('-'), name.startswith('-')) for name in self.ordering]
+
+    def encode_cursor(self, obj, reverse=False):
+        values = [getattr(obj, name) for name, _ in self.fields]
+        # `DjangoJSONEncoder` truncates microseconds, which would skip or repeat rows
+        values = [value.isoformat() if isinstance(value, date) else value for value in values]
+        payload = json.dumps({'k': values, 'r': reverse}).encode()
+        return base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+            values, reverse = payload['k'], bool(payload['r'])
+            if len(values) != len(self.fields):
+                raise ValueError(cursor)
+            opts = self.queryset.model._meta
+            values = [opts.get_field(name).to_python(value) for (name, _), value in zip(self.fields, values)]
+        except (TypeError, KeyError, ValueError, binascii.Error, ValidationError):
+            raise InvalidCursor(cursor)
+        return values, reverse
+
+    def filter_after(self, values, reverse=False):
+        """ Returns the `Q` of the rows after the sort key `values` in the ordering (before it if `reverse`). """
+        lookups = [(name, 'lt' if descending != reverse else 'gt') for name, descending in self.fields]
+        name, lookup = lookups[-1]
+        q = Q(**{f'{name}__{lookup}': values[-1]})
+        for (name, lookup), value in reversed(list(zip(lookups[:-1], values[:-1]))):
+            q = Q(**{f'{name}__{lookup}': value}) | Q(**{name: value}) & q
+        # A bound on the leading column alone lets the database start the index scan at the cursor
+        name, lookup = lookups[0]
+        return Q(**{f'{name}__{lookup}e': values[0]}) & q
+
+    def page(self, cursor=None):
+        values, reverse = self.decode_cursor(cursor) if cursor else (None, False)
+        ordering = [name if descending else f'-{name}' for name, descending in self.fields] if reverse \
+            else self.ordering
+        queryset = self.queryset.order_by(*ordering)
+        if values is not None:
+            queryset = queryset.filter(self.filter_after(values, reverse))
+        rows = list(across_shards(queryset)[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if reverse:
+            rows.reverse()
+            return KeysetPage(rows, self, has_next=True, has_previous=has_more)
+        return KeysetPage(rows, self, has_next=has_more, has_previous=values is not None)
+
+
+class SequencePaginator(Paginator):
+    """
+    Paginates rows numbered from 1 by a per-parent sequence field (e.g. `Post.seq`), page N holding the
+    rows numbered `(N - 1) * per_page + 1` to `N * per_page`. Pages are index range lookups and `count`
+    is the last sequence number, so there is no `COUNT(*)` and no `OFFSET`. Gaps make pages shorter.
+    """
+
+    def __init__(self, object_list, per_page, count, seq_field='seq', **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.count = count
+        self.seq_field = seq_field
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        rows = self.object_list.filter(**{f'{self.seq_field}__gt': bottom,
+                                          f'{self.seq_field}__lte': bottom + self.per_page})
+        return self._get_page(rows.order_by(self.seq_field), number, self)
+
+
+class KeysetPaginationMixin:
+    """
+    Paginates a `ListView` with `?cursor=` (see `KeysetPaginator`) on `get_ordering()`.
+    Numbered pages (`?page=`) are still served by Django's `Paginator`, so permalinks keep working.
+    """
+    cursor_kwarg = 'cursor'
+
+    def paginate_queryset(self, queryset, page_size):
+        if self.page_kwarg in self.kwargs or self.page_kwarg in self.request.GET:
+            return super().paginate_queryset(across_shards(queryset), page_size)
+        paginator = KeysetPaginator(queryset, self.get_ordering(), page_size)
+        try:
+            page = paginator.page(self.request.GET.get(self.cursor_kwarg))
+        except InvalidCursor:
+            raise Http404(_('Invalid cursor.'))
+        return paginator, page, page.object_list, page.has_other_pages()
+
+
+class KeysetPagination(BasePagination):
+    """ Django REST framework counterpart of `KeysetPaginationMixin`, ordered on the `ordering` of the view. """
+    cursor_query_param = 'cursor'
+    page_size = api_settings.PAGE_SIZE
+    ordering = ('-id',)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        paginator = KeysetPaginator(queryset, getattr(view, 'ordering', None) or self.ordering, self.page_size)
+        try:
+            self.page = paginator.page(request.query_params.get(self.cursor_query_param))
+        except InvalidCursor:
+            raise NotFound(_('Invalid cursor.'))
+        return list(self.page)
+
+    def get_link(self, cursor):
+        if cursor is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, cursor)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_link(self.page.next_cursor)),
+            ('previous', self.get_link(self.page.previous_cursor)),
+            ('results', data),
+        ]))
@@ -1,11 +1,12 @@
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.urls import reverse
 from rest_framework import status
 
 import json
 from main import factories
 from main.api import VotableVoteAPI
+from main.models import Topic, User, Vote
 from main.utils import create_image
 
 
@@ -21,7 +22,7 @@ class TestVoteAPI(TestCase):
     def test_like_post_works(self):
         resp = self.client.post(reverse('votable_vote'), data={
             'vote_type': VotableVoteAPI.LIKE,
-            'votable_id': self.post.id,
+            'votable_id': self.post.public_id,
             'votable_type': 'post',
         }, content_type='application/json')
         self.assertEquals(resp.status_code, status.HTTP_200_OK)
@@ -29,10 +30,26 @@ class TestVoteAPI(TestCase):
         self.assertEquals(self.post.likes, 1)
         self.assertEquals(self.post.votes.count(), 1)
 
+    def test_vote_returns_new_counters(self):
+        resp = self.client.post(reverse('votable_vote'), data={
+            'vote_type': VotableVoteAPI.LIKE,
+            'votable_id': self.post.public_id,
+            'votable_type': 'post',
+        }, content_type='application/json')
+        self.assertEquals(resp.status_code, status.HTTP_200_OK)
+        self.assertEquals(resp.data, {'likes': 1, 'dislikes': 0, 'shares': 0})
+
+        resp = self.client.post(reverse('votable_vote'), data={
+            'vote_type': VotableVoteAPI.SHARE,
+            'votable_id': self.post.public_id,
+            'votable_type': 'post',
+        }, content_type='application/json')
+        self.assertEquals(resp.data, {'likes': 1, 'dislikes': 0, 'shares': 1})
+
     def test_dislike_post_works(self):
         resp = self.client.post(reverse('votable_vote'), data={
             'vote_type': VotableVoteAPI.DISLIKE,
-            'votable_id': self.post.id,
+            'votable_id': self.post.public_id,
             'votable_type': 'post',
         }, content_type='application/json')
         self.assertEquals(resp.status_code, status.HTTP_200_OK)
@@ -43,7 +60,7 @@ class TestVoteAPI(TestCase):
     def test_share_post_works(self):
         resp = self.client.post(reverse('votable_vote'), data={
             'vote_type': VotableVoteAPI.SHARE,
-            'votable_id': self.post.id,
+            'votable_id': self.post.public_id,
             'votable_type': 'post',
         }, content_type='application/json')
         self.assertEquals(resp.status_code, status.HTTP_200_OK)
@@ -54,7 +71,7 @@ class TestVoteAPI(TestCase):
     def test_unlike_liked_post_works(self):
         resp = self.client.post(reverse('votable_vote'), data={
             'vote_type': VotableVoteAPI.LIKE,
-            'votable_id': self.post.id,
+            'votable_id': self.post.public_id,
             'votable_type': 'post',
         }, content_type='application/json')
         self.assertEquals(resp.status_code, status.HTTP_200_OK)
@@ -64,7 +81,7 @@ class TestVoteAPI(TestCase):
 
         resp = self.client.post(reverse('votable_vote'), data={
             'vote_type': VotableVoteAPI.NO_VOTE,
-            'votable_id': self.post.id,
+            'votable_id': self.post.public_id,
             'votable_type': 'post',
         }, content_type='application/json')
         self.assertEquals(resp.status_code, status.HTTP_200_OK)
@@ -75,7 +92,7 @@ class TestVoteAPI(TestCase):
     def test_un_dislike_disliked_post_works(self):
         resp = self.client.post(reverse('votable_vote'), data={
             'vote_type': VotableVoteAPI.DISLIKE,
-            'votable_id': self.post.id,
+            'votable_id': self.post.public_id,
             'votable_type': 'post',
         }, content_type='application/json')
         self.assertEquals(resp.status_code, status.HTTP_200_OK)
@@ -85,7 +102,7 @@ class TestVoteAPI(TestCase):
 
         resp = self.client.post(reverse('votable_vote'), data={
             'vote_type': VotableVoteAPI.NO_VOTE,
-            'votable_id': self.post.id,
+            'votable_id': self.post.public_id,
             'votable_type': 'post',
         }, content_type='application/json')
         self.assertEquals(resp.status_code, status.HTTP_200_OK)
@@ -96,7 +113,7 @@ class TestVoteAPI(TestCase):
     def test_unshare_shared_post_works(self):
         resp = self.client.post(reverse('votable_vote'), data={
             'vote_type': VotableVoteAPI.SHARE,
-            'votable_id': self.post.id,
+            'votable_id': self.post.public_id,
             'votable_type': 'post',
         }, content_type='application/json')
         self.assertEquals(resp.status_code, status.HTTP_200_OK)
@@ -106,7 +123,7 @@ class TestVoteAPI(TestCase):
 
         resp = self.client.post(reverse('votable_vote'), data={
             'vote_type': VotableVoteAPI.UNSHARE,
-            'votable_id': self.post.id,
+            'votable_id': self.post.public_id,
             'votable_type': 'post',
         }, content_type='application/json')
         self.assertEquals(resp.status_code, status.HTTP_200_OK)
@@ -145,6 +162,115 @@ class TestVoteAPI(TestCase):
         self.assertEquals(self.post.votes.count(), 0)
 
 
+class TestVoteBatchAPI(TestCase):
+
+    def setUp(self) -> None:
+        self.user = factories.UserFactory(username='testUser')
+        board = factories.BoardFactory(name='testBoard')
+        self.topic = factories.TopicFactory(board=board, author=self.user, title='testTitle')
+        self.post = factories.PostFactory(topic=self.topic, author=self.user)
+        self.other_post = factories.PostFactory(topic=self.topic, author=self.user)
+        self.client.force_login(self.user)
+
+    def vote(self, votes):
+        return self.client.post(reverse('votable_vote_batch'), data={'votes': votes},
+                                content_type='application/json')
+
+    def test_batch_vote_works(self):
+        resp = self.vote([
+            {'vote_type': VotableVoteAPI.LIKE, 'votable_id': self.post.public_id, 'votable_type': 'post'},
+            {'vote_type': VotableVoteAPI.DISLIKE, 'votable_id': self.other_post.public_id, 'votable_type': 'post'},
+            {'vote_type': VotableVoteAPI.SHARE, 'votable_id': self.topic.public_id, 'votable_type': 'topic'},
+        ])
+        self.assertEquals(resp.status_code, status.HTTP_200_OK)
+        self.assertEquals(resp.data['counters']['post'][self.post.public_id], {'likes': 1, 'dislikes': 0, 'shares': 0})
+        self.assertEquals(resp.data['counters']['post'][self.other_post.public_id],
+                          {'likes': 0, 'dislikes': 1, 'shares': 0})
+        self.assertEquals(resp.data['counters']['topic'][self.topic.public_id], {'likes': 0, 'dislikes': 0, 'shares': 1})
+        self.assertEquals(self.post.votes.count(), 1)
+        self.assertEquals(self.other_post.votes.count(), 1)
+        self.assertEquals(self.topic.votes.count(), 1)
+
+    def test_batch_vote_aggregates_operations_on_same_votable(self):
+        resp = self.vote([
+            {'vote_type': VotableVoteAPI.LIKE, 'votable_id': self.post.public_id, 'votable_type': 'post'},
+            {'vote_type': VotableVoteAPI.SHARE, 'votable_id': self.post.public_id, 'votable_type': 'post'},
+            {'vote_type': VotableVoteAPI.DISLIKE, 'votable_id': self.post.public_id, 'votable_type': 'post'},
+        ])
+        self.assertEquals(resp.status_code, status.HTTP_200_OK)
+        self.assertEquals([r['vote_type'] for r in resp.data['results']], [1, 1, -1])
+        self.assertEquals([r['is_shared'] for r in resp.data['results']], [False, True, True])
+        self.post.refresh_from_db()
+        self.assertEquals((self.post.likes, self.post.dislikes, self.post.shares), (0, 1, 1))
+        self.assertEquals(self.post.votes.count(), 1)
+
+    def test_batch_vote_updates_and_deletes_existing_votes(self):
+        self.vote([{'vote_type': VotableVoteAPI.LIKE, 'votable_id': self.post.public_id, 'votable_type': 'post'},
+                   {'vote_type': VotableVoteAPI.LIKE, 'votable_id': self.other_post.public_id, 'votable_type': 'post'}])
+        resp = self.vote([
+            {'vote_type': VotableVoteAPI.NO_VOTE, 'votable_id': self.post.public_id, 'votable_type': 'post'},
+            {'vote_type': VotableVoteAPI.DISLIKE, 'votable_id': self.other_post.public_id, 'votable_type': 'post'},
+        ])
+        self.assertEquals(resp.status_code, status.HTTP_200_OK)
+        self.assertEquals(self.post.votes.count(), 0)
+        self.assertEquals(self.other_post.votes.get().vote_type, VotableVoteAPI.DISLIKE)
+        self.assertEquals(resp.data['counters']['post'][self.post.public_id], {'likes': 0, 'dislikes': 0, 'shares': 0})
+        self.assertEquals(resp.data['counters']['post'][self.other_post.public_id],
+                          {'likes': 0, 'dislikes': 1, 'shares': 0})
+
+    def test_batch_vote_reports_invalid_items(self):
+        resp = self.vote([
+            {'votable_id': self.post.public_id, 'votable_type': 'post'},
+            {'vote_type': VotableVoteAPI.LIKE, 'votable_id': 'missing', 'votable_type': 'post'},
+            {'vote_type': VotableVoteAPI.LIKE, 'votable_id': self.post.public_id, 'votable_type': 'post'},
+        ])
+        self.assertEquals(resp.status_code, status.HTTP_200_OK)
+        self.assertIn('error', resp.data['results'][0])
+        self.assertIn('error', resp.data['results'][1])
+        self.assertEquals(resp.data['results'][2]['vote_type'], VotableVoteAPI.LIKE)
+        self.post.refresh_from_db()
+        self.assertEquals(self.post.likes, 1)
+
+    def test_empty_batch_returns_400(self):
+        resp = self.vote([])
+        self.assertEquals(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TestViewerStateAPI(TestCase):
+
+    def setUp(self) -> None:
+        self.user = factories.UserFactory(username='testUser')
+        other_user = factories.UserFactory(username='otherUser', email='other@email.com')
+        board = factories.BoardFactory(name='testBoard')
+        self.topic = factories.TopicFactory(board=board, author=self.user, title='testTitle')
+        self.posts = [factories.PostFactory(topic=self.topic, author=self.user) for _ in range(2)]
+        Vote.objects.cast(self.user, 'post', self.posts[0].pk, vote_type=Vote.LIKE)
+        Vote.objects.cast(self.user, 'topic', self.topic.pk, is_shared=True)
+        Vote.objects.cast(other_user, 'post', self.posts[1].pk, vote_type=Vote.DIS_LIKE)
+        self.user.topics_following.add(self.topic)
+        self.client.force_login(self.user)
+
+    def get_state(self, topics, posts):
+        return self.client.get(reverse('viewer_state'), {'topics': ','.join(topics), 'posts': ','.join(posts)})
+
+    def test_returns_votes_and_follows_of_user(self):
+        resp = self.get_state([self.topic.public_id], [post.public_id for post in self.posts] + ['missing'])
+        self.assertEquals(resp.status_code, status.HTTP_200_OK)
+        self.assertEquals(resp.data, {
+            'username': 'testUser',
+            'votes': {self.topic.public_id: {'vote_type': Vote.NO_VOTE, 'is_shared': True},
+                      self.posts[0].public_id: {'vote_type': Vote.LIKE, 'is_shared': False}},
+            'followed_topics': [self.topic.public_id],
+        })
+
+    def test_requires_login_and_limits_ids(self):
+        with self.settings(VOTE_BATCH_LIMIT=2):
+            resp = self.get_state([self.topic.public_id], [post.public_id for post in self.posts])
+        self.assertEquals(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.client.logout()
+        self.assertEquals(self.get_state([self.topic.public_id], []).status_code, status.HTTP_403_FORBIDDEN)
+
+
 class TestPostCreateAPI(TestCase):
     def setUp(self) -> None:
         self.user = factories.UserFactory(username='testUser')
@@ -411,7 +537,7 @@ class TestFollowTopicAPI(TestCase):
         self.assertEquals(self.user.topics_following.count(), 0)
         resp = self.client.post(reverse('follow_topic'), data={
             'follow': True,
-            'topic': self.topic.id,
+            'topic': self.topic.public_id,
         }, content_type='application/json')
         self.assertEquals(resp.status_code, status.HTTP_200_OK)
         self.assertEquals(self.user.topics_following.count(), 1)
@@ -420,13 +546,13 @@ class TestFollowTopicAPI(TestCase):
         self.assertEquals(self.user.topics_following.count(), 0)
         self.client.post(reverse('follow_topic'), data={
             'follow': True,
-            'topic': self.topic.id,
+            'topic': self.topic.public_id,
         }, content_type='application/json')
         self.assertEquals(self.user.topics_following.count(), 1)
 
         resp = self.client.post(reverse('follow_topic'), data={
             'follow': False,
-            'topic': self.topic.id,
+            'topic': self.topic.public_id,
         }, content_type='application/json')
         self.assertEquals(resp.status_code, status.HTTP_200_OK)
         self.assertEquals(self.user.topics_following.count(), 0)
@@ -435,14 +561,14 @@ class TestFollowTopicAPI(TestCase):
         self.assertEquals(self.user.topics_following.count(), 0)
         resp = self.client.post(reverse('follow_topic'), data={
             'follow': True,
-            'topic': self.topic.id,
+            'topic': self.topic.public_id,
         }, content_type='application/json')
         self.assertEquals(resp.status_code, status.HTTP_200_OK)
         self.assertEquals(self.user.topics_following.count(), 1)
 
         resp = self.client.post(reverse('follow_topic'), data={
             'follow': True,
-            'topic': self.topic.id,
+            'topic': self.topic.public_id,
         }, content_type='application/json')
         self.assertEquals(resp.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertEquals(self.user.topics_following.count(), 1)
@@ -451,12 +577,47 @@ class TestFollowTopicAPI(TestCase):
         self.assertEquals(self.user.topics_following.count(), 0)
         resp = self.client.post(reverse('follow_topic'), data={
             'follow': False,
-            'topic': self.topic.id,
+            'topic': self.topic.public_id,
         }, content_type='application/json')
         self.assertEquals(resp.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertEquals(self.user.topics_following.count(), 0)
 
 
+@override_settings(SHARD_DATABASES=['default', 'shard1'])
+class TestFollowShardedTopicAPI(TestCase):
+    databases = {'default', 'shard1'}
+
+    def setUp(self) -> None:
+        self.user = factories.UserFactory(username='testUser')
+        # Shard 49, on the second database
+        board = factories.BoardFactory(name='games')
+        # Replicated to every shard database
+        for row in (self.user, board):
+            row.save(using='shard1', force_insert=True)
+        self.topic = Topic.objects.create(board=board, author=self.user, title='Sharded', content='Sharded topic')
+        self.client.force_login(self.user)
+
+    def follow(self, follow):
+        return self.client.post(reverse('follow_topic'), data={
+            'follow': follow,
+            'topic': self.topic.public_id,
+        }, content_type='application/json')
+
+    def test_follows_are_stored_with_the_topic(self):
+        resp = self.follow(True)
+        self.assertEquals(resp.status_code, status.HTTP_200_OK)
+        self.assertEquals(list(self.topic.followers.all()), [self.user])
+        self.assertFalse(User.topics_following.through.objects.using('default').exists())
+
+        resp = self.client.get(reverse('viewer_state'), {'topics': self.topic.public_id})
+        self.assertEquals(resp.data['followed_topics'], [self.topic.public_id])
+        self.assertEquals(self.follow(True).status_code, status.HTTP_400_BAD_REQUEST)
+
+        resp = self.follow(False)
+        self.assertEquals(resp.status_code, status.HTTP_200_OK)
+        self.assertEquals(self.topic.followers.count(), 0)
+
+
 class TestFollowUserAPI(TestCase):
     def setUp(self) -> None:
         self.user = factories.UserFactory(username='testUser')
@@ -599,7 +760,7 @@ class TestPostUpdateAPI(TestCase):
     def test_update_post_without_file_works(self):
         content = 'b'
         resp = self.client.post(reverse('post_edit'), data={
-            'votable_id': self.p1.id,
+            'votable_id': self.p1.public_id,
             'content': content,
             'files_to_keep': '{}',
         })
@@ -609,7 +770,7 @@ class TestPostUpdateAPI(TestCase):
 
     def test_update_post_by_emptying_fields_fails(self):
         resp = self.client.post(reverse('post_edit'), data={
-            'votable_id': self.p1.id,
+            'votable_id': self.p1.public_id,
             'content': '',
             'files_to_keep': '{}',
         })
@@ -618,7 +779,7 @@ class TestPostUpdateAPI(TestCase):
 
     def test_update_post_by_faking_files_to_keep_fails(self):
         resp = self.client.post(reverse('post_edit'), data={
-            'votable_id': self.p1.id,
+            'votable_id': self.p1.public_id,
             'content': self.p1.content,
             'files_to_keep': json.dumps({1: 2}),
         })
@@ -629,7 +790,7 @@ class TestPostUpdateAPI(TestCase):
         user2 = factories.UserFactory(username='user2', email='user2@mail.com')
         self.client.force_login(user2)
         resp = self.client.post(reverse('post_edit'), data={
-            'votable_id': self.p1.id,
+            'votable_id': self.p1.public_id,
             'content': self.p1.content,
             'files_to_keep': json.dumps({}),
         })
@@ -640,7 +801,7 @@ class TestPostUpdateAPI(TestCase):
         self.assertEquals(self.p1.files.count(), 0)
         file = SimpleUploadedFile('in1.jpg', create_image(None, "main/sample_data/images/in1.jpg").getvalue())
         resp = self.client.post(reverse('post_edit'), {
-            'votable_id': self.p1.id,
+            'votable_id': self.p1.public_id,
             'content': '',
             'files': [file],
             'files_to_keep': json.dumps({}),
@@ -665,7 +826,7 @@ class TestPostUpdateAPI(TestCase):
         self.assertEquals(post.files.count(), 1)
 
         resp = self.client.post(reverse('post_edit'), {
-            'votable_id': post.id,
+            'votable_id': post.public_id,
             'content': '',
             'files': [],
             'files_to_keep': json.dumps({}),
@@ -692,7 +853,7 @@ class TestPostUpdateAPI(TestCase):
 
         name_of_kept = post.files.all()[1].file.name
         resp = self.client.post(reverse('post_edit'), {
-            'votable_id': post.id,
+            'votable_id': post.public_id,
             'content': 'a',
             'files': [],
             'files_to_keep': json.dumps({1: 0}),  # [keep first] ===> [Index in resulting file list]
@@ -720,7 +881,7 @@ class TestPostUpdateAPI(TestCase):
 
         name_of_kept = post.files.all()[0].file.name
         resp = self.client.post(reverse('post_edit'), {
-            'votable_id': post.id,
+            'votable_id': post.public_id,
             'content': 'a',
             'files': [],
             'files_to_keep': json.dumps({0: 0}),  # [keep first] ===> [Index in resulting file list]
@@ -748,7 +909,7 @@ class TestTopicUpdateAPI(TestCase):
         content = 'b'
         title = 'newTitle'
         resp = self.client.post(reverse('topic_edit'), data={
-            'votable_id': self.t1.id,
+            'votable_id': self.t1.public_id,
             'content': content,
             'title': title,
             'files_to_keep': '{}',
@@ -760,7 +921,7 @@ class TestTopicUpdateAPI(TestCase):
 
     def test_update_topic_by_emptying_fields_fails(self):
         resp = self.client.post(reverse('topic_edit'), data={
-            'votable_id': self.t1.id,
+            'votable_id': self.t1.public_id,
             'content': '',
             'title': '',
             'files_to_keep': '{}',
@@ -770,7 +931,7 @@ class TestTopicUpdateAPI(TestCase):
 
     def test_update_topic_by_faking_files_to_keep_fails(self):
         resp = self.client.post(reverse('topic_edit'), data={
-            'votable_id': self.t1.id,
+            'votable_id': self.t1.public_id,
             'content': self.t1.content,
             'title': self.t1.title,
             'files_to_keep': json.dumps({1: 2}),
@@ -782,7 +943,7 @@ class TestTopicUpdateAPI(TestCase):
         user2 = factories.UserFactory(username='user2', email='user2@mail.com')
         self.client.force_login(user2)
         resp = self.client.post(reverse('topic_edit'), data={
-            'votable_id': self.t1.id,
+            'votable_id': self.t1.public_id,
             'content': self.t1.content,
             'title': self.t1.title,
             'files_to_keep': json.dumps({}),
@@ -794,7 +955,7 @@ class TestTopicUpdateAPI(TestCase):
         self.assertEquals(self.t1.files.count(), 0)
         file = SimpleUploadedFile('in1.jpg', create_image(None, "main/sample_data/images/in1.jpg").getvalue())
         resp = self.client.post(reverse('topic_edit'), {
-            'votable_id': self.t1.id,
+            'votable_id': self.t1.public_id,
             'content': '',
             'title': self.t1.title,
             'files': [file],
@@ -820,7 +981,7 @@ class TestTopicUpdateAPI(TestCase):
         self.assertEquals(topic.files.count(), 1)
 
         resp = self.client.post(reverse('topic_edit'), {
-            'votable_id': topic.id,
+            'votable_id': topic.public_id,
             'content': '',
             'title': topic.title,
             'files': [],
@@ -848,7 +1009,7 @@ class TestTopicUpdateAPI(TestCase):
 
         name_of_kept = topic.files.all()[1].file.name
         resp = self.client.post(reverse('topic_edit'), {
-            'votable_id': topic.id,
+            'votable_id': topic.public_id,
             'content': 'a',
             'title': topic.title,
             'files': [],
@@ -877,7 +1038,7 @@ class TestTopicUpdateAPI(TestCase):
 
         name_of_kept = topic.files.all()[0].file.name
         resp = self.client.post(reverse('topic_edit'), {
-            'votable_id': topic.id,
+            'votable_id': topic.public_id,
             'content': 'a',
             'title': topic.title,
             'files': [],
@@ -0,0 +1,180 @@
+import json
+import os
+import tempfile
+from io import StringIO
+
+from django.core.management import CommandError, call_command
+from django.test import TestCase, override_settings
+
+from koboland.helpers import close_side_connections
+from main import factories
+from main.models import Post, Topic, TopicCounterShard, Vote
+from main.utils import hot
+
+
+class TestReconcileCounters(TestCase):
+
+    def setUp(self) -> None:
+        self.user = factories.UserFactory()
+        other_user = factories.UserFactory(username='otherUser', email='other@email.com')
+        board = factories.BoardFactory()
+        self.topic = factories.TopicFactory(board=board, author=self.user, title='New Topic')
+        self.post = factories.PostFactory(author=self.user, topic=self.topic)
+        Vote.objects.create_object(user=self.user, votable=self.post, vote_type=Vote.LIKE, is_shared=True)
+        Vote.objects.create_object(user=other_user, votable=self.post, vote_type=Vote.DIS_LIKE)
+        Vote.objects.create_object(user=self.user, votable=self.topic, vote_type=Vote.LIKE)
+
+    def reconcile(self, *args):
+        out = StringIO()
+        call_command('reconcile_counters', *args, stdout=out)
+        return out.getvalue()
+
+    def test_reconcile_fixes_drifted_counters(self):
+        Post.objects.filter(id=self.post.id).update(likes=7, dislikes=0, shares=3)
+        Topic.objects.filter(id=self.topic.id).update(likes=0, post_count=42)
+        out = self.reconcile('--chunk-size', '1')
+        self.assertIn('Posts checked=1 corrected=1 (dislikes=1, likes=1, shares=1)', out)
+        self.assertIn('Topics checked=1 corrected=1 (likes=1, post_count=1)', out)
+
+        self.post.refresh_from_db()
+        self.topic.refresh_from_db()
+        self.assertEqual((self.post.likes, self.post.dislikes, self.post.shares), (1, 1, 1))
+        self.assertEqual((self.topic.likes, self.topic.post_count), (1, 1))
+
+    def test_reconcile_fixes_drifted_scores(self):
+        Topic.objects.filter(id=self.topic.id).update(score=5, hot_score=0)
+        out = self.reconcile()
+        self.assertIn('Topics checked=1 corrected=1 (hot_score=1, score=1)', out)
+        self.topic.refresh_from_db()
+        self.assertEqual(self.topic.score, 1)
+        self.assertAlmostEqual(self.topic.hot_score, hot(1, 0, self.topic.date_created))
+
+    def test_reconcile_leaves_correct_counters_alone(self):
+        out = self.reconcile()
+        self.assertIn('Posts checked=1 corrected=0 (no drift)', out)
+        self.assertIn('Topics checked=1 corrected=0 (no drift)', out)
+
+    @override_settings(TOPIC_COUNTER_SHARDS=2)
+    def test_reconcile_leaves_unfolded_post_counts_alone(self):
+        self.addCleanup(close_side_connections)
+        factories.PostFactory(author=self.user, topic=self.topic)
+        out = self.reconcile()
+        self.assertIn('Topics checked=1 corrected=0 (no drift)', out)
+
+    def test_dry_run_does_not_write(self):
+        Post.objects.filter(id=self.post.id).update(likes=7)
+        out = self.reconcile('--dry-run', '--board', 'testBoard')
+        self.assertIn('Posts checked=1 corrected=1 (likes=1)', out)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.likes, 7)
+
+
+class TestFoldPostCounters(TestCase):
+
+    @override_settings(TOPIC_COUNTER_SHARDS=2)
+    def test_fold_once(self):
+        self.addCleanup(close_side_connections)
+        user = factories.UserFactory()
+        topic = factories.TopicFactory(board=factories.BoardFactory(), author=user)
+        factories.PostFactory(author=user, topic=topic)
+        out = StringIO()
+        call_command('fold_post_counters', '--once', stdout=out)
+        self.assertIn('Folded post counters of 1 topics', out.getvalue())
+        topic.refresh_from_db()
+        self.assertEqual(topic.post_count, 1)
+        self.assertFalse(TopicCounterShard.objects.exclude(post_count=0).exists())
+
+
+class TestRerenderContentHtml(TestCase):
+
+    def setUp(self) -> None:
+        user = factories.UserFactory()
+        self.board = factories.BoardFactory()
+        other_board = factories.BoardFactory(name='otherBoard')
+        self.topic = factories.TopicFactory(board=self.board, author=user, title='New Topic', content='*a*')
+        self.post = factories.PostFactory(author=user, topic=self.topic, content='**b**')
+        self.other_topic = factories.TopicFactory(board=other_board, author=user, title='Other Topic', content='c')
+        for model in (Topic, Post):
+            model.objects.update(content_html='outdated', html_stale=True)
+
+    def rerender(self, *args):
+        out = StringIO()
+        call_command('rerender_content_html', *args, stdout=out)
+        return out.getvalue()
+
+    def test_rerender_all(self):
+        out = self.rerender('--chunk-size', '1')
+        self.assertIn('Topics rendered=2 written=2', out)
+        self.assertIn('Posts rendered=1 written=1', out)
+        self.topic.refresh_from_db()
+        self.post.refresh_from_db()
+        self.assertEqual((self.topic.content_html, self.topic.html_stale), ('<p><em>a</em></p>\n', False))
+        self.assertEqual(self.post.content_html, '<p><strong>b</strong></p>\n')
+
+    def test_rerender_filters(self):
+        out = self.rerender('--board', self.board.name, '--since', '2000-01-01')
+        self.assertIn('Topics rendered=1 written=1', out)
+        self.assertEqual(Topic.objects.get(id=self.other_topic.id).content_html, 'outdated')
+
+        with self.assertRaises(CommandError):
+            self.rerender('--since', 'yesterday')
+
+    def test_rerender_resumes_from_checkpoint(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'checkpoint.json')
+            last_topic_id = max(self.topic.id, self.other_topic.id)
+            with open(path, 'w') as f:
+                json.dump({'topic': last_topic_id}, f)
+            out = self.rerender('--checkpoint', path)
+            self.assertIn('Topics rendered=0 written=0', out)
+            self.assertIn('Posts rendered=1 written=1', out)
+            self.assertFalse(os.path.exists(path))
+
+
+@override_settings(SHARD_DATABASES=['default', 'shard1'])
+class TestCommandsOnShardDatabases(TestCase):
+    databases = {'default', 'shard1'}
+
+    def setUp(self) -> None:
+        user = factories.UserFactory()
+        # Shard 49, on the second database
+        board = factories.BoardFactory(name='games')
+        # Replicated to every shard database
+        for row in (user, board):
+            row.save(using='shard1', force_insert=True)
+        self.topic = Topic.objects.create(board=board, author=user, title='Sharded', content='*a*')
+        self.post = factories.PostFactory(topic=self.topic, author=user, content='**b**')
+        Vote.objects.cast(user, 'post', self.post.pk, vote_type=Vote.LIKE)
+        self.news_topic = Topic.objects.create(board=factories.BoardFactory(name='news'), author=user,
+                                               title='Unsharded', content='c')
+        self.assertEqual((self.topic._state.db, self.news_topic._state.db), ('shard1', 'default'))
+
+    def test_reconcile_every_database(self):
+        Post.objects.using('shard1').filter(id=self.post.id).update(likes=7)
+        Topic.objects.using('shard1').filter(id=self.topic.id).update(post_count=42)
+        out = StringIO()
+        call_command('reconcile_counters', stdout=out)
+        self.assertIn('Posts checked=1 corrected=1 (likes=1)', out.getvalue())
+        self.assertIn('Topics checked=2 corrected=1 (post_count=1)', out.getvalue())
+        self.post.refresh_from_db()
+        self.topic.refresh_from_db()
+        self.assertEqual((self.post.likes, self.topic.post_count), (1, 1))
+
+    def test_rerender_every_database(self):
+        for model in (Topic, Post):
+            for database in ('default', 'shard1'):
+                model.objects.using(database).update(content_html='outdated', html_stale=True)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'checkpoint.json')
+            # The topics of the default database were written by an interrupted run
+            with open(path, 'w') as f:
+                json.dump({'topic': self.news_topic.id}, f)
+            out = StringIO()
+            call_command('rerender_content_html', '--checkpoint', path, stdout=out)
+        self.assertIn('Topics rendered=1 written=1', out.getvalue())
+        self.assertIn('Posts rendered=1 written=1', out.getvalue())
+        self.topic.refresh_from_db()
+        self.post.refresh_from_db()
+        self.assertEqual((self.topic.content_html, self.topic.html_stale), ('<p><em>a</em></p>\n', False))
+        self.assertEqual(self.post.content_html, '<p><strong>b</strong></p>\n')
+        self.assertEqual(Topic.objects.get(id=self.news_topic.id).content_html, 'outdated')
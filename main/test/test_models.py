@@ -1,11 +1,27 @@
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
 from unittest import mock
 
-from django.test import TestCase
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, connection, transaction
+from django.db.models.signals import post_save
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 from django.utils import timezone
 
+from koboland.db_routers import ShardRouter
+from koboland import helpers
+from koboland.helpers import (ID_LOW_BITS, IdGenerator, claim_worker_id, close_side_connections, from_base62,
+                              make_id_at, reverse_id, shard_of)
 from main import factories
-from main.models import Post, Topic, Vote
+from main.counters import (flush_counter_buffer, fold_post_counter_shards, get_counter_buffer,
+                           merge_pending_post_counts)
+from main.models import Board, LeaderboardEntry, Post, Quote, Topic, TopicCounterShard, Vote, store_pending_html
+from main.utils import hot
 
 
 class TestVote(TestCase):
@@ -91,6 +107,52 @@ class TestVote(TestCase):
         self.assertEqual(self.topic.shares, 0)
         self.assertEqual(self.user.vote_set.on_topics().count(), 0)
 
+    def test_votes_on_stale_instances_are_not_lost(self):
+        other_user = factories.UserFactory(username='otherUser', email='other@email.com')
+        stale_post = Post.objects.get(id=self.post.id)
+        Vote.objects.create_object(user=self.user, votable=self.post, vote_type=Vote.LIKE)
+        Vote.objects.create_object(user=other_user, votable=stale_post, vote_type=Vote.LIKE)
+        self.assertEqual(stale_post.likes, 2)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.likes, 2)
+
+    def test_change_vote_returns_new_counters(self):
+        vote = Vote.objects.create_object(user=self.user, votable=self.post, vote_type=Vote.LIKE)
+        counters = vote.change_vote(new_vote_type=Vote.DIS_LIKE, new_share_status=True)
+        self.assertEqual(counters, {'likes': 0, 'dislikes': 1, 'shares': 1})
+
+    def test_counter_update_does_not_touch_other_columns(self):
+        Post.objects.filter(id=self.post.id).update(content='edited elsewhere')
+        Vote.objects.create_object(user=self.user, votable=self.post, vote_type=Vote.LIKE)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.content, 'edited elsewhere')
+        self.assertEqual(self.post.likes, 1)
+
+    def test_duplicate_votes_are_rejected(self):
+        Vote.objects.create_object(user=self.user, votable=self.post, vote_type=Vote.LIKE)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Vote.objects.create_object(user=self.user, votable=self.post, vote_type=Vote.LIKE)
+
+    def test_upsert_returns_previous_state(self):
+        self.assertEqual(Vote.objects.upsert(self.user, 'post', self.post.id, vote_type=Vote.LIKE),
+                         (None, (Vote.LIKE, False)))
+        self.assertEqual(Vote.objects.upsert(self.user, 'post', self.post.id, is_shared=True),
+                         ((Vote.LIKE, False), (Vote.LIKE, True)))
+        self.assertEqual(self.post.votes.count(), 1)
+
+    def test_cast_twice_does_not_inflate_counters(self):
+        Vote.objects.cast(self.user, 'post', self.post.id, vote_type=Vote.LIKE)
+        counters = Vote.objects.cast(self.user, 'post', self.post.id, vote_type=Vote.LIKE)
+        self.assertEqual(counters, {'likes': 1, 'dislikes': 0, 'shares': 0})
+        counters = Vote.objects.cast(self.user, 'post', self.post.id, vote_type=Vote.NO_VOTE)
+        self.assertEqual(counters, {'likes': 0, 'dislikes': 0, 'shares': 0})
+        self.assertEqual(self.post.votes.count(), 0)
+
+    def test_cast_on_missing_votable_raises(self):
+        with self.assertRaises(Post.DoesNotExist):
+            Vote.objects.cast(self.user, 'post', 0, vote_type=Vote.LIKE)
+        self.assertEqual(Vote.objects.count(), 0)
+
     # def test_post_shares_works_correctly(self):
     #     user = factories.UserFactory()
     #     board = factories.BoardFactory()
@@ -161,6 +223,79 @@ class TestVote(TestCase):
     #     self.assertEqual(topic.post_count, 0)
 
 
+@override_settings(VOTE_COUNTER_BUFFER='local', VOTE_COUNTER_FLUSH_INTERVAL=None)
+class TestBufferedVoteCounters(TransactionTestCase):
+
+    def setUp(self) -> None:
+        self.user = factories.UserFactory()
+        board = factories.BoardFactory()
+        self.topic = factories.TopicFactory(board=board, author=self.user, title='New Topic',
+                                            content='This is content', )
+        self.post = factories.PostFactory(author=self.user, topic=self.topic)
+
+    def test_vote_is_buffered_and_merged_on_read(self):
+        Vote.objects.create_object(user=self.user, votable=self.post, vote_type=Vote.LIKE)
+        self.assertEqual(self.post.likes, 1)
+        self.assertEqual(self.post.votes.count(), 1)
+        self.assertEqual(Post.objects.values_list('likes', flat=True).get(id=self.post.id), 0)
+        self.assertEqual(Post.objects.get_counters([self.post.id])[self.post.id],
+                         {'likes': 1, 'dislikes': 0, 'shares': 0})
+
+    def test_flush_writes_buffered_deltas(self):
+        vote = Vote.objects.create_object(user=self.user, votable=self.post, vote_type=Vote.LIKE)
+        vote.change_vote(new_vote_type=Vote.DIS_LIKE, new_share_status=True)
+        self.assertEqual(flush_counter_buffer(), 1)
+        self.assertEqual(get_counter_buffer().pending('main.post', [self.post.id]), {})
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.likes, self.post.dislikes, self.post.shares), (0, 1, 1))
+
+
+class TestConcurrentVotes(TransactionTestCase):
+
+    def setUp(self) -> None:
+        self.user = factories.UserFactory()
+        topic = factories.TopicFactory(board=factories.BoardFactory(), author=self.user)
+        self.post = factories.PostFactory(author=self.user, topic=topic)
+
+    @staticmethod
+    def in_thread(func, *args, **kwargs):
+        """ Runs `func` with its own database connection, returning its future. """
+        def run():
+            try:
+                return func(*args, **kwargs)
+            finally:
+                connection.close()
+                close_side_connections()
+        executor = ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(run)
+        executor.shutdown(wait=False)
+        return future
+
+    def test_batch_waits_for_a_vote_cast_meanwhile(self):
+        with transaction.atomic():
+            Vote.objects.cast(self.user, 'post', self.post.pk, vote_type=Vote.LIKE)
+            future = self.in_thread(Vote.objects.apply_batch, self.user, [
+                {'votable_type': 'post', 'votable_id': self.post.pk, 'vote_type': Vote.DIS_LIKE, 'is_shared': None}])
+            # The batch is blocked by the uncommitted vote
+            time.sleep(0.3)
+            self.assertFalse(future.done())
+        results, counters = future.result(timeout=10)
+        self.assertEqual(counters['post'][self.post.pk], {'likes': 0, 'dislikes': 1, 'shares': 0})
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.likes, self.post.dislikes), (0, 1))
+        self.assertEqual(self.post.votes.get().vote_type, Vote.DIS_LIKE)
+
+    def test_cast_waits_for_a_batch(self):
+        with transaction.atomic():
+            Vote.objects.apply_batch(self.user, [
+                {'votable_type': 'post', 'votable_id': self.post.pk, 'vote_type': Vote.LIKE, 'is_shared': None}])
+            future = self.in_thread(Vote.objects.cast, self.user, 'post', self.post.pk, vote_type=Vote.LIKE)
+            time.sleep(0.3)
+            self.assertFalse(future.done())
+        future.result(timeout=10)
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.likes, self.post.dislikes), (1, 0))
+
 class TestTopic(TestCase):
 
     def setUp(self) -> None:
@@ -172,6 +307,142 @@ class TestTopic(TestCase):
     def test_create_topic_sets_slug(self):
         self.assertGreater(len(self.topic.slug), 0)
 
+    def test_create_topic_sets_hot_score(self):
+        self.topic.refresh_from_db()
+        self.assertAlmostEqual(self.topic.hot_score, hot(0, 0, self.topic.date_created), places=5)
+
+    def test_votes_update_score_and_hot_score(self):
+        other_user = factories.UserFactory(username='otherUser', email='other@email.com')
+        for user in (self.user, other_user):
+            Vote.objects.cast(user, 'topic', self.topic.id, vote_type=Vote.LIKE)
+        self.topic.refresh_from_db()
+        self.assertEqual(self.topic.score, 2)
+        self.assertAlmostEqual(self.topic.hot_score, hot(2, 0, self.topic.date_created), places=5)
+
+        for user in (self.user, other_user):
+            Vote.objects.cast(user, 'topic', self.topic.id, vote_type=Vote.DIS_LIKE)
+        self.topic.refresh_from_db()
+        self.assertEqual(self.topic.score, -2)
+        self.assertAlmostEqual(self.topic.hot_score, hot(0, 2, self.topic.date_created), places=5)
+
+
+class TestVotableDirtyFields(TestCase):
+
+    def setUp(self) -> None:
+        self.user = factories.UserFactory()
+        board = factories.BoardFactory()
+        self.topic = factories.TopicFactory(board=board, author=self.user, title='New Topic',
+                                            content='This is *content*', )
+
+    def test_loaded_votable_has_no_dirty_fields(self):
+        topic = Topic.objects.get(id=self.topic.id)
+        self.assertEqual(topic.get_dirty_fields(), set())
+        topic.post_count += 1
+        self.assertEqual(topic.get_dirty_fields(), {'post_count'})
+
+    def test_save_without_content_change_skips_rendering(self):
+        topic = Topic.objects.get(id=self.topic.id)
+        topic.post_count += 1
+        with mock.patch('main.models.render_html') as render_html:
+            topic.save()
+            render_html.assert_not_called()
+        topic.refresh_from_db()
+        self.assertEqual(topic.post_count, 1)
+        self.assertEqual(topic.content_html, '<p>This is <em>content</em></p>\n')
+
+    def test_save_only_writes_dirty_fields(self):
+        topic = Topic.objects.get(id=self.topic.id)
+        Topic.objects.filter(id=self.topic.id).update(likes=5)
+        topic.post_count += 1
+        topic.save()
+        topic.refresh_from_db()
+        self.assertEqual(topic.likes, 5)
+        self.assertEqual(topic.post_count, 1)
+
+    def test_save_with_content_change_renders_html(self):
+        topic = Topic.objects.get(id=self.topic.id)
+        topic.content = 'New **content**'
+        topic.save()
+        topic.refresh_from_db()
+        self.assertEqual(topic.content_html, '<p>New <strong>content</strong></p>\n')
+        self.assertEqual(topic.get_dirty_fields(), set())
+
+    def test_save_without_changes_sends_post_save(self):
+        topic = Topic.objects.get(id=self.topic.id)
+        saved = []
+
+        def receiver(instance, update_fields, **kwargs):
+            saved.append((instance.pk, update_fields))
+        post_save.connect(receiver, sender=Topic)
+        try:
+            with mock.patch('main.models.render_html') as render_html:
+                topic.save()
+            render_html.assert_not_called()
+        finally:
+            post_save.disconnect(receiver, sender=Topic)
+        self.assertEqual(saved, [(topic.pk, None)])
+
+    def test_save_writes_assigned_deferred_fields(self):
+        topic = Topic.objects.only('id', 'title', 'board_id').get(id=self.topic.id)
+        topic.content = 'Deferred **content**'
+        # Loading another deferred field keeps the assigned one
+        self.assertEqual(topic.post_count, 0)
+        self.assertEqual(topic.get_dirty_fields(), {'content'})
+        topic.save()
+        topic = Topic.objects.get(id=self.topic.id)
+        self.assertEqual(topic.content, 'Deferred **content**')
+        self.assertEqual(topic.content_html, '<p>Deferred <strong>content</strong></p>\n')
+
+
+@override_settings(CONTENT_HTML_RENDERING='async', MARKDOWN_RENDER_BUDGET=5)
+class TestAsyncContentHtml(TestCase):
+
+    def setUp(self) -> None:
+        self.user = factories.UserFactory()
+        self.topic = factories.TopicFactory(board=factories.BoardFactory(), author=self.user, title='New Topic',
+                                            content='This is *content*', )
+
+    def save_with_slow_rendering(self, topic):
+        with mock.patch('main.models.get_engine') as get_engine:
+            get_engine.return_value.submit.return_value = Future()
+            topic.save()
+
+    def test_fast_rendering_is_saved_right_away(self):
+        topic = Topic.objects.get(id=self.topic.id)
+        self.assertFalse(topic.html_stale)
+        self.assertEqual(topic.content_html, '<p>This is <em>content</em></p>\n')
+
+    @override_settings(MARKDOWN_RENDER_BUDGET=0)
+    def test_slow_rendering_is_saved_stale_and_rendered_by_first_reader(self):
+        topic = Topic.objects.get(id=self.topic.id)
+        topic.content = 'New **content**'
+        self.save_with_slow_rendering(topic)
+        topic = Topic.objects.get(id=self.topic.id)
+        self.assertTrue(topic.html_stale)
+
+        self.assertEqual(topic.get_content_html(), '<p>New <strong>content</strong></p>\n')
+        topic = Topic.objects.get(id=self.topic.id)
+        self.assertFalse(topic.html_stale)
+        self.assertEqual(topic.content_html, '<p>New <strong>content</strong></p>\n')
+
+    @override_settings(MARKDOWN_RENDER_BUDGET=0)
+    # Workers close their own connection, which here is the one of the test transaction
+    @mock.patch('main.models.close_old_connections')
+    def test_worker_stores_rendering_unless_content_changed(self, close_old_connections):
+        topic = Topic.objects.get(id=self.topic.id)
+        topic.content = 'New **content**'
+        self.save_with_slow_rendering(topic)
+        future = Future()
+        future.set_result('<p>stale</p>')
+        store_pending_html(Topic, topic.id, 'Older content', future)
+        self.assertTrue(Topic.objects.get(id=self.topic.id).html_stale)
+
+        future = Future()
+        future.set_result('<p>rendered</p>')
+        store_pending_html(Topic, topic.id, 'New **content**', future)
+        topic = Topic.objects.get(id=self.topic.id)
+        self.assertEqual((topic.html_stale, topic.content_html), (False, '<p>rendered</p>'))
+
 
 class TestPost(TestCase):
 
@@ -195,6 +466,95 @@ class TestPost(TestCase):
         self.assertEquals(self.topic.post_count, 0)
         self.assertEquals(self.topic.posts.count(), 0)
 
+    @override_settings(VOTABLE_PAGE_SIZE=2)
+    def test_posts_are_numbered_per_topic(self):
+        posts = [factories.PostFactory(author=self.user, topic=self.topic) for _ in range(3)]
+        self.assertEqual([post.seq for post in posts], [1, 2, 3])
+        self.assertEqual(self.topic.last_post_seq, 3)
+        self.assertEqual([post.get_page() for post in posts], [1, 1, 2])
+        self.assertTrue(posts[2].get_absolute_url().endswith(f'?page=2#{posts[2].public_id}'))
+
+        other_topic = factories.TopicFactory(board=self.topic.board, author=self.user, title='Other Topic')
+        self.assertEqual(factories.PostFactory(author=self.user, topic=other_topic).seq, 1)
+
+    def test_new_post_sets_last_post_at(self):
+        post = factories.PostFactory(author=self.user, topic=self.topic)
+        self.topic.refresh_from_db()
+        self.assertGreaterEqual(self.topic.last_post_at, post.date_created)
+
+    @override_settings(TOPIC_COUNTER_SHARDS=4)
+    def test_sharded_post_counts_are_merged_and_folded(self):
+        self.addCleanup(close_side_connections)
+        for _ in range(3):
+            factories.PostFactory(author=self.user, topic=self.topic)
+        self.assertEqual(self.topic.post_count, 3)
+        topic = Topic.objects.get(id=self.topic.id)
+        self.assertEqual((topic.post_count, topic.last_post_at), (0, None))
+        self.assertEqual(sum(self.topic.counter_shards.values_list('post_count', flat=True)), 3)
+
+        merge_pending_post_counts([topic])
+        self.assertEqual(topic.post_count, 3)
+        self.assertIsNotNone(topic.last_post_at)
+
+        self.assertEqual(fold_post_counter_shards(), 1)
+        topic.refresh_from_db()
+        self.assertEqual(topic.post_count, 3)
+        self.assertIsNotNone(topic.last_post_at)
+        self.assertEqual(TopicCounterShard.objects.pending([topic.id])[topic.id]['post_count'], 0)
+        self.assertEqual(fold_post_counter_shards(), 0)
+
+
+@override_settings(TOPIC_COUNTER_SHARDS=4)
+class TestShardedReplies(TransactionTestCase):
+    # Includes what runs once the reply is committed
+
+    def setUp(self) -> None:
+        self.user = factories.UserFactory()
+        self.topic = factories.TopicFactory(board=factories.BoardFactory(), author=self.user)
+
+    def test_reply_only_updates_the_topic_row_for_its_seq(self):
+        with CaptureQueriesContext(connection) as queries:
+            factories.PostFactory(author=self.user, topic=self.topic)
+        updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len([sql for sql in updates if sql.startswith('UPDATE "main_topic"')]), 1)
+        self.assertIn('last_post_seq', updates[0])
+        self.assertFalse([sql for sql in updates if 'post_count' in sql or 'main_board' in sql])
+        self.assertEqual(self.topic.counter_shards.get().post_count, 1)
+
+    def reply_in_transaction(self, content, replied=None, done=None):
+        with transaction.atomic():
+            post = factories.PostFactory(author=self.user, topic=self.topic, content=content)
+            if replied is not None:
+                replied.set()
+                done.wait(10)
+        return post
+
+    def test_concurrent_replies_do_not_wait_for_each_other(self):
+        self.addCleanup(close_side_connections)
+        replied, done = threading.Event(), threading.Event()
+        shards = iter(range(2))
+        # Each reply counts itself in a counter row of its own
+        with mock.patch('main.models.random.randrange', side_effect=lambda stop: next(shards)):
+            first = TestConcurrentVotes.in_thread(self.reply_in_transaction, 'First', replied, done)
+            self.assertTrue(replied.wait(10))
+            try:
+                second = TestConcurrentVotes.in_thread(self.reply_in_transaction, 'Second').result(timeout=5)
+            finally:
+                done.set()
+            first = first.result(timeout=10)
+        self.assertEqual((first.seq, second.seq), (1, 2))
+        self.assertEqual(TopicCounterShard.objects.pending([self.topic.pk])[self.topic.pk]['post_count'], 2)
+
+    def test_replies_to_topics_locked_by_their_transaction(self):
+        self.addCleanup(close_side_connections)
+        with transaction.atomic():
+            topic = factories.TopicFactory(board=self.topic.board, author=self.user, title='New')
+            first = factories.PostFactory(author=self.user, topic=topic)
+            self.topic.title = 'Renamed'
+            self.topic.save()
+            second = factories.PostFactory(author=self.user, topic=self.topic)
+        self.assertEqual((first.seq, second.seq), (1, 1))
+
 
 # noinspection PyArgumentList
 class TestHowLongAgo(TestCase):
@@ -326,3 +686,269 @@ class TestHowLongAgo(TestCase):
             dt.now = mock.Mock()
             dt.now.return_value = creation + timedelta(seconds=59, milliseconds=999)
             self.assertEqual(post.how_long_ago(), '59 seconds ago')
+
+
+class TestLeaderboardEntry(TestCase):
+
+    def setUp(self) -> None:
+        self.users = [factories.UserFactory(username=f'user{i}', email=f'user{i}@email.com') for i in range(2)]
+        self.board = factories.BoardFactory()
+        self.topic = factories.TopicFactory(board=self.board, author=self.users[0], title='Liked Topic')
+        self.other_topic = factories.TopicFactory(board=self.board, author=self.users[0], title='Other Topic')
+        self.post = factories.PostFactory(author=self.users[0], topic=self.topic)
+
+    def test_votes_feed_every_period(self):
+        for user in self.users:
+            Vote.objects.cast(user, 'topic', self.topic.id, vote_type=Vote.LIKE)
+        Vote.objects.cast(self.users[0], 'topic', self.other_topic.id, vote_type=Vote.LIKE)
+        for period, _ in LeaderboardEntry.PERIODS:
+            entries = LeaderboardEntry.objects.top(Topic, period)
+            self.assertEqual([(entry.object_id, entry.score) for entry in entries],
+                             [(self.topic.id, 2), (self.other_topic.id, 1)])
+            self.assertEqual(LeaderboardEntry.objects.top(Topic, period, board=self.board).count(), 2)
+
+    def test_changed_vote_updates_entries(self):
+        Vote.objects.cast(self.users[0], 'post', self.post.id, vote_type=Vote.LIKE)
+        Vote.objects.cast(self.users[0], 'post', self.post.id, vote_type=Vote.DIS_LIKE)
+        entry, = LeaderboardEntry.objects.top(Post, 'week')
+        self.assertEqual((entry.object_id, entry.board_id, entry.score), (self.post.id, self.board.name, -1))
+        self.assertFalse(LeaderboardEntry.objects.top(Topic, 'week').exists())
+
+    def test_periods_are_bucketed_by_vote_time(self):
+        last_month = timezone.now() - timedelta(days=40)
+        LeaderboardEntry.objects.record(Topic, self.topic.id, 3, at=last_month)
+        self.assertFalse(LeaderboardEntry.objects.top(Topic, 'month').exists())
+        self.assertEqual(LeaderboardEntry.objects.top(Topic, 'month', at=last_month).get().score, 3)
+        self.assertEqual(LeaderboardEntry.objects.top(Topic, 'all').get().score, 3)
+
+    def test_load_votables_keeps_order(self):
+        LeaderboardEntry.objects.record(Topic, self.topic.id, 1)
+        LeaderboardEntry.objects.record(Topic, self.other_topic.id, 2)
+        votables = LeaderboardEntry.objects.load_votables(Topic, list(LeaderboardEntry.objects.top(Topic, 'day')))
+        self.assertEqual([(votable.id, votable.period_score) for votable in votables],
+                         [(self.other_topic.id, 2), (self.topic.id, 1)])
+
+
+class TestQuote(TestCase):
+
+    def setUp(self) -> None:
+        self.user = factories.UserFactory()
+        self.topic = factories.TopicFactory(board=factories.BoardFactory(), author=self.user)
+        self.quoted = factories.PostFactory(author=self.user, topic=self.topic)
+
+    def quote(self, post):
+        return f'<<<[[{self.user.username}|{post.public_id}]]{post.content}<<<\n\n'
+
+    def test_save_indexes_quoted_ids(self):
+        post = factories.PostFactory(author=self.user, topic=self.topic, content=self.quote(self.quoted) + 'Agreed')
+        self.assertEqual(list(post.quotes.values_list('quoted_id', flat=True)), [self.quoted.id])
+        self.assertEqual(Quote.objects.counts([self.quoted.id, post.id]), {self.quoted.id: 1, post.id: 0})
+
+        post.content = 'Never mind'
+        post.save()
+        self.assertFalse(post.quotes.exists())
+
+    def test_deleted_votable_removes_its_quotes(self):
+        post = factories.PostFactory(author=self.user, topic=self.topic, content=self.quote(self.quoted))
+        post.delete()
+        self.assertFalse(Quote.objects.exists())
+
+    def test_resolve_points_links_to_permalinks(self):
+        post = factories.PostFactory(author=self.user, topic=self.topic, content=self.quote(self.quoted))
+        posts = list(Post.objects.filter(topic=self.topic).order_by('seq'))
+        # The permalinks of the quoted posts and the quote counts
+        with self.assertNumQueries(2):
+            Quote.objects.resolve(posts)
+        self.assertIn(f'href="{self.quoted.get_absolute_url()}"', posts[1].content_html)
+        self.assertEqual([p.quote_count for p in posts], [1, 0])
+        self.assertEqual(posts[1].get_dirty_fields(), set())
+        self.assertEqual(Post.objects.get(pk=post.pk).content_html, post.content_html)
+
+
+class TestBulkCreate(TestCase):
+
+    def setUp(self) -> None:
+        self.user = factories.UserFactory()
+        self.board = factories.BoardFactory()
+        self.topic = factories.TopicFactory(board=self.board, author=self.user)
+
+    def test_bulk_create_assigns_ids_and_renders_html(self):
+        topics = Topic.objects.bulk_create([Topic(board=self.board, author=self.user, title=f'Topic {i}',
+                                                  content=f'**{i}**') for i in range(3)])
+        self.assertEqual(len({topic.id for topic in topics}), 3)
+        saved = Topic.objects.in_bulk([topic.id for topic in topics])
+        self.assertEqual(saved[topics[1].id].content_html, '<p><strong>1</strong></p>\n')
+        self.assertEqual(saved[topics[1].id].slug, 'topic-1')
+
+    def test_bulk_create_makes_one_insert(self):
+        with self.assertNumQueries(1):
+            topics = Topic.objects.bulk_create([Topic(board=self.board, author=self.user, title=f'Topic {i}')
+                                                for i in range(3)])
+        self.assertEqual(Topic.objects.filter(pk__in=[topic.pk for topic in topics]).count(), 3)
+
+    def test_create_posts_numbers_and_counts_them(self):
+        factories.PostFactory(author=self.user, topic=self.topic)
+        posts = self.topic.create_posts([Post(author=self.user, content=f'Post {i}') for i in range(3)])
+        self.assertEqual([post.seq for post in posts], [2, 3, 4])
+        self.topic.refresh_from_db()
+        self.assertEqual((self.topic.post_count, self.topic.last_post_seq), (4, 4))
+
+
+class TestVotableIds(TestCase):
+
+    def setUp(self) -> None:
+        self.user = factories.UserFactory()
+        self.board = factories.BoardFactory()
+
+    def test_ids_sort_by_creation_time(self):
+        now = time.time()
+        topics = [factories.TopicFactory(id=make_id_at(now - i / 1000), board=self.board, author=self.user,
+                                         title=f'Topic {i}') for i in range(3)]
+        self.assertEqual(list(Topic.objects.order_by('-id')), topics)
+        self.assertEqual(sorted(topic.public_id for topic in topics), [topic.public_id for topic in reversed(topics)])
+        self.assertAlmostEqual(reverse_id(topics[0].id), now, places=2)
+
+    def test_generated_ids_are_unique_per_worker(self):
+        first, second = IdGenerator(worker_bits=20, worker_id=1), IdGenerator(worker_bits=20, worker_id=2)
+        with mock.patch('koboland.helpers.time.time', return_value=time.time()):
+            ids = [first() for _ in range(10)] + [second() for _ in range(10)]
+        self.assertEqual(len(set(ids)), 20)
+        self.assertEqual(ids[:10], sorted(ids[:10]))
+        # Ten ids do not fit in the 3 sequence bits of a millisecond
+        self.assertEqual(ids[9] >> ID_LOW_BITS, (ids[0] >> ID_LOW_BITS) + 1)
+        self.assertEqual({(pk >> 3) & (2 ** 20 - 1) for pk in ids}, {1, 2})
+
+    def test_generated_ids_never_go_back(self):
+        generator = IdGenerator(worker_id=0)
+        now = time.time()
+        with mock.patch('koboland.helpers.time.time', return_value=now):
+            first = generator()
+        with mock.patch('koboland.helpers.time.time', return_value=now - 60):
+            self.assertGreater(generator(), first)
+
+    def test_worker_ids_are_held_by_one_process(self):
+        held = len(helpers._worker_locks)
+        self.addCleanup(lambda: [lock.close() for _, lock in helpers._worker_locks[held:]])
+        # Each claim takes its own connection, like another process would
+        first, second = claim_worker_id(4), claim_worker_id(4)
+        self.assertNotEqual(first, second)
+        with self.assertRaises(ImproperlyConfigured):
+            claim_worker_id(4, first)
+        with self.assertRaises(ValueError):
+            IdGenerator()
+
+    def test_forked_processes_do_not_reuse_the_worker_id(self):
+        generator = IdGenerator(worker_id=3)
+        generator()
+        with mock.patch('koboland.helpers.os.getpid', return_value=-1), self.assertRaises(RuntimeError):
+            generator()
+        generator = IdGenerator(worker_bits=4, claim_worker=mock.Mock(side_effect=[1, 2]))
+        first = generator()
+        with mock.patch('koboland.helpers.os.getpid', return_value=-1):
+            second = generator()
+        self.assertEqual(((first >> (ID_LOW_BITS - 4)) & 15, (second >> (ID_LOW_BITS - 4)) & 15), (1, 2))
+
+    def test_forked_processes_claim_their_own_worker_id(self):
+        held = len(helpers._worker_locks)
+        self.addCleanup(lambda: [lock.close() for _, lock in helpers._worker_locks[held:]])
+        parent = claim_worker_id(4)
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(read)
+                os.write(write, str(claim_worker_id(4)).encode())
+                # Like the child exiting
+                for _, lock in helpers._worker_locks:
+                    lock.close()
+            finally:
+                os._exit(0)
+        os.close(write)
+        with os.fdopen(read) as child:
+            child = int(child.read())
+        os.waitpid(pid, 0)
+        self.assertNotEqual(child, parent)
+        # The parent still holds its worker id
+        with self.assertRaises(ImproperlyConfigured):
+            claim_worker_id(4, parent)
+
+    def test_created_between(self):
+        now = timezone.now()
+        topics = [factories.TopicFactory(id=make_id_at((now - timedelta(days=i)).timestamp()), board=self.board,
+                                         author=self.user, title=f'Topic {i}') for i in range(3)]
+        created = Topic.objects.created_between(now - timedelta(days=1, hours=1), now - timedelta(hours=1))
+        self.assertEqual(list(created), [topics[1]])
+        self.assertEqual(Topic.objects.created_between(end=now - timedelta(days=1, hours=1)).get(), topics[2])
+
+    def test_ids_carry_the_shard_of_their_board(self):
+        topic = factories.TopicFactory(id=make_id_at(time.time()), board=self.board, author=self.user)
+        post = factories.PostFactory(topic=topic, author=self.user)
+        self.assertEqual({shard_of(topic.pk), shard_of(post.pk), post.get_shard()}, {self.board.get_shard()})
+        generator = IdGenerator(worker_id=0, shard_bits=6)
+        self.assertEqual(generator.shard_of(generator(shard=5)), 5)
+
+    @override_settings(SHARD_DATABASES=['default', 'other'])
+    def test_shards_are_routed_to_their_database(self):
+        router = ShardRouter()
+        games, news = factories.BoardFactory(name='games'), factories.BoardFactory(name='news')
+        self.assertEqual((games.get_shard(), news.get_shard()), (49, 16))
+        for board, database in ((news, 'default'), (games, 'other')):
+            topic = Topic(board=board, title='Sharded')
+            topic.set_shard()
+            self.assertEqual(router.db_for_write(Topic, instance=topic), database)
+            self.assertEqual(router.db_for_read(Post, instance=topic), database)
+            self.assertEqual(router.db_for_read(Topic, instance=board), database)
+            self.assertEqual(Topic.objects.public(topic.public_id).db, database)
+        self.assertIsNone(router.db_for_write(Board, instance=games))
+        self.assertEqual(Topic.objects.using('default').public(topic.public_id).db, 'default')
+
+    def test_public_ids(self):
+        topic = factories.TopicFactory(board=self.board, author=self.user)
+        self.assertEqual(len(topic.public_id), Topic.PUBLIC_ID_LENGTH)
+        self.assertEqual(from_base62(topic.public_id), topic.pk)
+        self.assertEqual(Topic.objects.public(topic.public_id).get(), topic)
+        for public_id in ('missing', 'zzzzzzzzzzz', '!!!!!!!!!!!', None):
+            self.assertIsNone(Topic.pk_from_public_id(public_id))
+            self.assertFalse(Topic.objects.public(public_id).exists())
+
+
+@override_settings(SHARD_DATABASES=['default', 'shard1'])
+class TestShardDatabases(TestCase):
+    databases = {'default', 'shard1'}
+
+    def setUp(self) -> None:
+        self.user = factories.UserFactory()
+        # Shard 49, on the second database
+        self.board = factories.BoardFactory(name='games')
+        # Replicated to every shard database
+        for row in (self.user, self.board):
+            row.save(using='shard1', force_insert=True)
+
+    def test_topics_are_created_voted_on_and_read_on_their_database(self):
+        topic = Topic.objects.create(board=self.board, author=self.user, title='Sharded', content='Sharded topic')
+        post = factories.PostFactory(topic=topic, author=self.user, content='Sharded reply')
+        self.assertEqual((topic._state.db, post._state.db), ('shard1', 'shard1'))
+        self.assertFalse(Topic.objects.using('default').filter(pk=topic.pk).exists())
+        self.assertFalse(Post.objects.using('default').filter(pk=post.pk).exists())
+
+        counters = Vote.objects.cast(self.user, 'topic', topic.pk, vote_type=Vote.LIKE)
+        self.assertEqual(counters['likes'], 1)
+        results, counters = Vote.objects.apply_batch(self.user, [
+            {'votable_type': 'post', 'votable_id': post.pk, 'vote_type': Vote.DIS_LIKE, 'is_shared': True}])
+        self.assertEqual(counters['post'][post.pk], {'likes': 0, 'dislikes': 1, 'shares': 1})
+        self.assertEqual(Vote.objects.using('shard1').count(), 2)
+        self.assertFalse(Vote.objects.using('default').exists())
+        self.assertEqual(Vote.objects.get_object(self.user, 'topic', topic.pk).vote_type, Vote.LIKE)
+
+        self.assertEqual(Topic.objects.public(topic.public_id).get().likes, 1)
+        self.assertEqual(Post.objects.get(pk=post.pk).dislikes, 1)
+        self.assertEqual(Topic.objects.get_counters([topic.pk])[topic.pk]['likes'], 1)
+        response = self.client.get(topic.get_absolute_url())
+        self.assertContains(response, 'Sharded reply')
+        self.assertContains(self.client.get(self.board.get_absolute_url()), 'Sharded')
+        # Listings across boards read every database
+        news = Topic.objects.create(board=factories.BoardFactory(name='news'), author=self.user, title='Unsharded')
+        self.assertEqual(news._state.db, 'default')
+        for params in ({}, {'page': 1}):
+            response = self.client.get(reverse('home'), params)
+            self.assertEqual([row.pk for row in response.context['topics']], [news.pk, topic.pk])
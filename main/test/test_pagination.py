@@ -0,0 +1,61 @@
+from datetime import timedelta
+
+from django.test import TestCase
+from rest_framework.exceptions import NotFound
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from main import factories
+from main.models import Topic
+from main.pagination import InvalidCursor, KeysetPagination, KeysetPaginator
+
+
+class TestKeysetPaginator(TestCase):
+
+    def setUp(self) -> None:
+        user = factories.UserFactory()
+        board = factories.BoardFactory()
+        self.topics = [factories.TopicFactory(board=board, author=user, title=f'Topic {i}') for i in range(5)]
+        # Two topics share their date_created, so that `id` has to break the tie
+        created = self.topics[0].date_created
+        for i, topic in enumerate(self.topics):
+            Topic.objects.filter(id=topic.id).update(date_created=created - timedelta(minutes=min(i, 3)))
+        self.expected = [topic.id for topic in sorted(
+            Topic.objects.all(), key=lambda topic: (topic.date_created, topic.id), reverse=True)]
+        self.paginator = KeysetPaginator(Topic.objects.all(), ['-date_created', '-id'], 2)
+
+    def test_next_cursors_walk_every_row_once(self):
+        page = self.paginator.page()
+        self.assertFalse(page.has_previous())
+        ids = [topic.id for topic in page]
+        while page.has_next():
+            page = self.paginator.page(page.next_cursor)
+            ids += [topic.id for topic in page]
+        self.assertEqual(ids, self.expected)
+        self.assertIsNone(page.next_cursor)
+
+    def test_previous_cursor_returns_previous_page(self):
+        second = self.paginator.page(self.paginator.page().next_cursor)
+        first = self.paginator.page(second.previous_cursor)
+        self.assertEqual([topic.id for topic in first], self.expected[:2])
+        self.assertFalse(first.has_previous())
+        self.assertTrue(first.has_next())
+
+    def test_invalid_cursor_raises(self):
+        for cursor in ('garbage', 'e30', self.paginator.encode_cursor(self.topics[0])[:-4]):
+            with self.assertRaises(InvalidCursor):
+                self.paginator.page(cursor)
+
+    def test_drf_pagination(self):
+        pagination = KeysetPagination()
+        pagination.page_size = 3
+        request = Request(APIRequestFactory().get('/api/topics/'))
+        results = pagination.paginate_queryset(Topic.objects.all(), request)
+        # Newest first, which is the order of the ids
+        self.assertEqual([topic.id for topic in results], sorted(self.expected, reverse=True)[:3])
+        response = pagination.get_paginated_response([topic.id for topic in results])
+        self.assertIsNone(response.data['previous'])
+        self.assertIn('cursor=', response.data['next'])
+
+        with self.assertRaises(NotFound):
+            pagination.paginate_queryset(Topic.objects.all(), Request(APIRequestFactory().get('/', {'cursor': 'x'})))
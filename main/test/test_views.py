@@ -1,10 +1,18 @@
+import time
+from datetime import timedelta
 from unittest.mock import patch
 
 from django.contrib import auth
-from django.test import TestCase
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from rest_framework import status
-from main import forms, models, factories
+from koboland.helpers import close_side_connections
+from main import forms, models, factories, page_cache, views
+from main.checks import check_page_cache
+from main.counters import flush_counter_buffer, fold_post_counter_shards
 
 
 class TestAuthentication(TestCase):
@@ -113,7 +121,7 @@ class TestUpdatePostPage(TestCase):
 
     def test_page_load_correctly(self):
         self.client.force_login(self.usr)
-        resp = self.client.get(reverse('post-update-view', kwargs={'post_id': self.post.id}))
+        resp = self.client.get(reverse('post-update-view', kwargs={'post_id': self.post.public_id}))
         field = resp.context['form'].fields.get('files_to_delete')
         self.assertIsNotNone(field)
         self.assertTrue(field.widget.is_hidden)
@@ -129,7 +137,7 @@ class TestUpdateTopicPage(TestCase):
 
     def test_page_load_correctly(self):
         self.client.force_login(self.usr)
-        resp = self.client.get(reverse('topic-update-view', kwargs={'topic_id': self.topic.id}))
+        resp = self.client.get(reverse('topic-update-view', kwargs={'topic_id': self.topic.public_id}))
         field = resp.context['form'].fields.get('files_to_delete')
         self.assertIsNotNone(field)
         self.assertTrue(field.widget.is_hidden)
@@ -139,6 +147,325 @@ class TestUpdateTopicPage(TestCase):
     def test_page_load_incorrectly_for_wrong_user(self):
         usr2 = factories.UserFactory(username='user2', email='user2@@mail.com')
         self.client.force_login(usr2)
-        resp = self.client.get(reverse('topic-update-view', kwargs={'topic_id': self.topic.id}))
+        resp = self.client.get(reverse('topic-update-view', kwargs={'topic_id': self.topic.public_id}))
         self.assertNotEqual(resp.status_code, status.HTTP_200_OK)
         self.assertEquals(resp.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class TestTopicSorting(TestCase):
+    def setUp(self) -> None:
+        self.usr = factories.UserFactory()
+        self.board = factories.BoardFactory()
+        self.old_topic = factories.TopicFactory(board=self.board, author=self.usr, title='Old Topic')
+        self.new_topic = factories.TopicFactory(board=self.board, author=self.usr, title='New Topic')
+        models.Topic.objects.filter(id=self.old_topic.id).update(
+            date_created=self.new_topic.date_created - timedelta(days=1))
+        models.Vote.objects.cast(self.usr, 'topic', self.old_topic.id, vote_type=models.Vote.LIKE)
+
+    def assertOrder(self, url, sort, topics):
+        resp = self.client.get(url, {'sort': sort})
+        self.assertEquals(resp.context['sort'], sort)
+        self.assertEquals([topic.id for topic in resp.context['topics']], [topic.id for topic in topics])
+
+    def test_board_page_sorts_topics(self):
+        url = self.board.get_absolute_url()
+        self.assertOrder(url, 'new', [self.new_topic, self.old_topic])
+        self.assertOrder(url, 'top', [self.old_topic, self.new_topic])
+
+    def test_home_page_sorts_topics(self):
+        url = reverse('home')
+        self.assertOrder(url, 'new', [self.new_topic, self.old_topic])
+        self.assertOrder(url, 'top', [self.old_topic, self.new_topic])
+
+    def test_unknown_sort_falls_back_to_hot(self):
+        resp = self.client.get(reverse('home'), {'sort': 'nope'})
+        self.assertEquals(resp.context['sort'], 'hot')
+        self.assertContains(resp, 'href="?sort=new"')
+
+    def test_pages_follow_cursors_without_page_numbers(self):
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.client.get(reverse('home'), {'sort': 'new'})
+        self.assertFalse([query for query in queries if 'COUNT(' in query['sql']])
+        self.assertTrue(resp.context['page_obj'].is_keyset)
+        self.assertNotContains(resp, 'page=')
+
+        with patch.object(views.HomeListView, 'paginate_by', 1):
+            resp = self.client.get(reverse('home'), {'sort': 'new'})
+            self.assertEquals([topic.id for topic in resp.context['topics']], [self.new_topic.id])
+            resp = self.client.get(reverse('home'), {'sort': 'new', 'cursor': resp.context['page_obj'].next_cursor})
+            self.assertEquals([topic.id for topic in resp.context['topics']], [self.old_topic.id])
+
+    def test_invalid_cursor_is_not_found(self):
+        resp = self.client.get(reverse('home'), {'cursor': 'garbage'})
+        self.assertEquals(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class TestPostPages(TestCase):
+    def setUp(self) -> None:
+        self.usr = factories.UserFactory()
+        self.topic = factories.TopicFactory(board=factories.BoardFactory(), author=self.usr)
+        self.posts = [factories.PostFactory(author=self.usr, topic=self.topic) for _ in range(3)]
+
+    def test_page_is_found_by_post_seq(self):
+        with patch.object(views.PostListView, 'paginate_by', 2):
+            with CaptureQueriesContext(connection) as queries:
+                resp = self.client.get(self.topic.get_absolute_url(), {'page': 2})
+            self.assertEquals([post.id for post in resp.context['posts']], [self.posts[2].id])
+            self.assertEquals(resp.context['paginator'].num_pages, 2)
+        self.assertFalse([query for query in queries if 'COUNT(*)' in query['sql'] or 'OFFSET' in query['sql']])
+
+    def test_quotes_link_to_permalinks_and_are_counted(self):
+        quote = f'<<<[[{self.usr.username}|{self.posts[0].public_id}]]{self.posts[0].content}<<<\n\nSame here'
+        factories.PostFactory(author=self.usr, topic=self.topic, content=quote)
+        resp = self.client.get(self.topic.get_absolute_url())
+        self.assertContains(resp, f'href="{self.posts[0].get_absolute_url()}"')
+        self.assertContains(resp, '1 reply quotes this post')
+
+    def test_viewer_votes_are_loaded_in_one_query(self):
+        other = factories.UserFactory(username='other', email='other@mail.com')
+        models.Vote.objects.cast(self.usr, 'post', self.posts[1].id, vote_type=models.Vote.LIKE)
+        models.Vote.objects.cast(self.usr, 'topic', self.topic.id, is_shared=True)
+        models.Vote.objects.cast(other, 'post', self.posts[2].id, vote_type=models.Vote.DIS_LIKE)
+        self.client.force_login(self.usr)
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.client.get(self.topic.get_absolute_url())
+        topic = resp.context['topic']
+        self.assertEquals((topic.vote_type, topic.is_shared), (models.Vote.NO_VOTE, True))
+        self.assertEquals([(post.vote_type, post.is_shared) for post in resp.context['posts']],
+                          [(None, False), (models.Vote.LIKE, False), (None, False)])
+        self.assertEquals(len([query for query in queries if 'FROM "main_vote"' in query['sql']]), 1)
+
+    def test_page_does_not_change_with_the_clock(self):
+        url = self.topic.get_absolute_url()
+        content = self.client.get(url).content
+        with patch('django.utils.timezone.now', return_value=self.topic.date_created + timedelta(hours=5)):
+            self.assertEquals(self.client.get(url).content, content)
+        self.assertIn(f'datetime="{self.posts[0].date_created.isoformat()}"', content.decode())
+
+    def test_former_topic_ids_redirect(self):
+        models.Topic.objects.filter(pk=self.topic.pk).update(legacy_id='Abc12')
+        url = reverse('topic', kwargs={'board': self.topic.board.name, 'topic_id': 'Abc12',
+                                       'topic_slug': self.topic.slug})
+        resp = self.client.get(url, {'page': 1})
+        self.assertRedirects(resp, self.topic.get_absolute_url() + '?page=1', status_code=301)
+        self.assertEquals(self.client.get(url.replace('Abc12', 'Xyz34')).status_code, status.HTTP_404_NOT_FOUND)
+
+
+class TestLeaderboardPage(TestCase):
+    def setUp(self) -> None:
+        self.usr = factories.UserFactory()
+        self.board = factories.BoardFactory()
+        self.topic = factories.TopicFactory(board=self.board, author=self.usr, title='Top Topic')
+        self.post = factories.PostFactory(author=self.usr, topic=self.topic)
+        models.Vote.objects.cast(self.usr, 'topic', self.topic.id, vote_type=models.Vote.LIKE)
+        models.Vote.objects.cast(self.usr, 'post', self.post.id, vote_type=models.Vote.LIKE)
+
+    def test_site_leaderboard_lists_top_topics(self):
+        resp = self.client.get(reverse('leaderboard'))
+        self.assertEquals((resp.context['votable_type'], resp.context['period']), ('topic', 'day'))
+        self.assertEquals([topic.id for topic in resp.context['votables']], [self.topic.id])
+        self.assertContains(resp, 'Top Topic')
+
+    def test_board_leaderboard_lists_top_posts(self):
+        resp = self.client.get(reverse('board-leaderboard', kwargs={'board': self.board.name}),
+                               {'type': 'post', 'period': 'month'})
+        self.assertEquals(resp.context['board'], self.board)
+        self.assertEquals([(post.id, post.period_score) for post in resp.context['votables']], [(self.post.id, 1)])
+
+
+@override_settings(PAGE_CACHE_TIMEOUT=60, PAGE_CACHE_COUNTER_STALENESS=10)
+class TestPageCache(TransactionTestCase):
+    # Pages are only invalidated once changes are committed
+
+    def setUp(self) -> None:
+        cache.clear()
+        self.usr = factories.UserFactory()
+        self.board = factories.BoardFactory()
+        self.topic = factories.TopicFactory(board=self.board, author=self.usr, title='Cached Topic')
+        self.post = factories.PostFactory(author=self.usr, topic=self.topic, content='First post')
+
+    def get(self, url):
+        resp = self.client.get(url)
+        return resp.get('X-Page-Cache'), resp.content.decode()
+
+    def test_topic_page_is_cached_until_a_post_is_added(self):
+        url = self.topic.get_absolute_url()
+        self.assertEquals(self.get(url)[0], 'miss')
+        # Only the version of the page is read, see main.conditional
+        with self.assertNumQueries(1):
+            state, content = self.get(url)
+        self.assertEquals(state, 'hit')
+        self.assertIn('First post', content)
+
+        factories.PostFactory(author=self.usr, topic=self.topic, content='Second post')
+        state, content = self.get(url)
+        self.assertEquals(state, 'miss')
+        self.assertIn('Second post', content)
+        self.assertEquals(page_cache.get_stats(), {'hits': 1, 'misses': 2})
+
+    def test_listings_are_refreshed_by_new_and_edited_topics(self):
+        urls = [reverse('home'), self.board.get_absolute_url()]
+        for url in urls:
+            self.get(url)
+        factories.TopicFactory(board=self.board, author=self.usr, title='Another Topic')
+        for url in urls:
+            state, content = self.get(url)
+            self.assertEquals(state, 'miss')
+            self.assertIn('Another Topic', content)
+        self.topic.title = 'Renamed Topic'
+        self.topic.save()
+        self.assertIn('Renamed Topic', self.get(urls[0])[1])
+
+    def test_counters_may_be_stale_for_a_while(self):
+        url = self.topic.get_absolute_url()
+        self.get(url)
+        models.Vote.objects.cast(self.usr, 'post', self.post.id, vote_type=models.Vote.LIKE)
+        self.assertEquals(self.get(url)[0], 'hit')
+        with patch('main.page_cache.time.time', return_value=time.time() + 11):
+            self.assertEquals(self.get(url)[0], 'miss')
+
+    def test_logged_in_readers_and_pending_messages_skip_the_cache(self):
+        url = self.board.get_absolute_url()
+        self.client.force_login(self.usr)
+        self.assertIsNone(self.get(url)[0])
+        self.client.get(reverse('logout'))
+        state, content = self.get(url)
+        self.assertIsNone(state)
+        self.assertIn('logged out successfully', content)
+        self.assertEquals(self.get(url)[0], 'miss')
+
+    def test_logged_in_readers_share_topic_pages_with_their_own_nav(self):
+        url = self.topic.get_absolute_url()
+        reader = factories.UserFactory(username='reader', email='reader@email.com')
+        self.client.force_login(self.usr)
+        self.assertEquals(self.get(url)[0], 'miss')
+        self.client.force_login(reader)
+        state, content = self.get(url)
+        self.assertEquals(state, 'hit')
+        self.assertIn('reader', content)
+        self.assertIn('csrfmiddlewaretoken', content)
+        self.assertNotIn('page-cache-hole', content)
+        # Anonymous readers get their own page, without the state of the viewer fetched by members
+        self.client.logout()
+        state, content = self.get(url)
+        self.assertEquals(state, 'miss')
+        self.assertNotIn('data-controller="viewer-state"', content)
+
+    def test_quotes_from_other_topics_refresh_the_quoted_posts(self):
+        url = self.topic.get_absolute_url()
+        self.get(url)
+        other = factories.TopicFactory(board=self.board, author=self.usr, title='Other Topic', slug='other-topic')
+        factories.PostFactory(author=self.usr, topic=other,
+                              content=f'<<<[[{self.usr.username}|{self.post.public_id}]]First post<<<\n\nAgreed')
+        state, content = self.get(url)
+        self.assertEquals(state, 'miss')
+        self.assertIn('1 reply quotes this post', content)
+
+    def test_needs_a_cache_shared_by_the_processes(self):
+        self.assertEquals([error.id for error in check_page_cache(None)], ['main.E002'])
+        shared = {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': '/tmp/page-cache'}
+        with override_settings(CACHES={'default': shared}):
+            self.assertEquals(check_page_cache(None), [])
+
+
+class TestConditionalPages(TransactionTestCase):
+    # Versions are only bumped once changes are committed
+
+    def setUp(self) -> None:
+        self.usr = factories.UserFactory()
+        self.board = factories.BoardFactory()
+        self.topic = factories.TopicFactory(board=self.board, author=self.usr)
+        self.post = factories.PostFactory(author=self.usr, topic=self.topic)
+
+    def assertNotModified(self, url, etag):
+        with self.assertNumQueries(1):
+            resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(resp.status_code, 304)
+        self.assertEquals(resp['ETag'], etag)
+
+    def assertModified(self, url, etag):
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(resp.status_code, 200)
+        self.assertNotEquals(resp['ETag'], etag)
+        return resp['ETag']
+
+    def later(self):
+        """ Moves the clock past the staleness period of the counters. """
+        return patch('main.conditional.time.time', return_value=time.time() + 11)
+
+    def test_topic_page_changes_with_its_posts(self):
+        url = self.topic.get_absolute_url()
+        etag = self.client.get(url)['ETag']
+        self.assertNotModified(url, etag)
+        post = factories.PostFactory(author=self.usr, topic=self.topic)
+        etag = self.assertModified(url, etag)
+        post.content = 'Edited'
+        post.save()
+        etag = self.assertModified(url, etag)
+        post.delete()
+        self.assertModified(url, etag)
+
+    def test_quotes_from_other_topics_change_the_topic_page(self):
+        url = self.topic.get_absolute_url()
+        other = factories.TopicFactory(board=self.board, author=self.usr, title='Other Topic', slug='other-topic')
+        etag = self.client.get(url)['ETag']
+        reply = factories.PostFactory(author=self.usr, topic=other,
+                                      content=f'<<<[[{self.usr.username}|{self.post.public_id}]]quoted<<<\n\n')
+        etag = self.assertModified(url, etag)
+        reply.content = 'Never mind'
+        reply.save()
+        etag = self.assertModified(url, etag)
+        reply.save()
+        self.assertNotModified(url, etag)
+
+    @override_settings(TOPIC_COUNTER_SHARDS=4)
+    def test_replies_counted_in_shards_change_the_topic_page(self):
+        self.addCleanup(close_side_connections)
+        url = self.topic.get_absolute_url()
+        etag = self.client.get(url)['ETag']
+        for _ in range(2):
+            factories.PostFactory(author=self.usr, topic=self.topic)
+            etag = self.assertModified(url, etag)
+        fold_post_counter_shards()
+        self.assertNotModified(url, etag)
+
+    @override_settings(PAGE_CACHE_COUNTER_STALENESS=10)
+    def test_votes_change_the_pages_once_their_counters_are_stale(self):
+        urls = [self.topic.get_absolute_url(), self.board.get_absolute_url()]
+        etags = [self.client.get(url)['ETag'] for url in urls]
+        with CaptureQueriesContext(connection) as queries:
+            models.Vote.objects.cast(self.usr, 'topic', self.topic.id, vote_type=models.Vote.LIKE)
+            models.Vote.objects.cast(self.usr, 'post', self.post.id, vote_type=models.Vote.LIKE)
+        self.assertFalse([query for query in queries if 'version' in query['sql']])
+        for url, etag in zip(urls, etags):
+            self.assertNotModified(url, etag)
+            with self.later():
+                self.assertModified(url, etag)
+
+    @override_settings(VOTE_COUNTER_BUFFER='local', VOTE_COUNTER_FLUSH_INTERVAL=3600)
+    def test_flushed_votes_change_the_topic_page(self):
+        url = self.topic.get_absolute_url()
+        etag = self.client.get(url)['ETag']
+        models.Vote.objects.cast(self.usr, 'post', self.post.id, vote_type=models.Vote.LIKE)
+        # Topic pages do not expire with a counter buffer
+        with self.later():
+            self.assertNotModified(url, etag)
+            flush_counter_buffer()
+            self.assertModified(url, etag)
+
+    def test_board_page_changes_with_its_topics(self):
+        url = self.board.get_absolute_url()
+        etag = self.client.get(url)['ETag']
+        topic = factories.TopicFactory(board=self.board, author=self.usr)
+        etag = self.assertModified(url, etag)
+        topic.title = 'Renamed'
+        topic.save()
+        etag = self.assertModified(url, etag)
+        # Post counts are counters of the board page
+        factories.PostFactory(author=self.usr, topic=self.topic)
+        self.assertNotModified(url, etag)
+
+    def test_pages_of_logged_in_readers_are_not_versioned(self):
+        self.client.force_login(self.usr)
+        self.assertFalse(self.client.get(self.board.get_absolute_url()).has_header('ETag'))
+        self.assertFalse(self.client.get(self.topic.get_absolute_url()).has_header('ETag'))
@@ -3,11 +3,11 @@ from django.conf.urls.static import static
 from django.contrib.auth import views as auth_views
 from django.urls import path, re_path
 
-from .api import (PostCreateAPI, TopicCreateAPI, VotableVoteAPI, FollowTopicAPI, FollowBoardAPI,
-    FollowUserAPI, PostUpdateAPI, TopicUpdateAPI)
+from .api import (PostCreateAPI, TopicCreateAPI, VotableVoteAPI, VotableVoteBatchAPI, FollowTopicAPI,
+    FollowBoardAPI, FollowUserAPI, PostUpdateAPI, TopicUpdateAPI, ViewerStateAPI)
 from .forms import AuthenticationForm
 from .views import (SignupView, PostListView, TopicListView, HomeListView, PostUpdateView,TopicUpdateView,
-                    TopicCreateView, logout_view, PostCreateView, UserView)
+                    TopicCreateView, logout_view, PostCreateView, UserView, LeaderboardView)
 
 urlpatterns = [
     path('', HomeListView.as_view(), name='home'),
@@ -15,10 +15,14 @@ urlpatterns = [
     path('login/', auth_views.LoginView.as_view(template_name='main/login.html', form_class=AuthenticationForm),
          name='login'),
     path('logout/', logout_view, name='logout'),
+    path('top/', LeaderboardView.as_view(), name='leaderboard'),
+    re_path(r'~(?P<board>[A-Za-z0-9-_]+)/top/$', LeaderboardView.as_view(), name='board-leaderboard'),
     re_path(r'~(?P<board>[A-Za-z0-9-_]+)/$', TopicListView.as_view(), name='board'),
     re_path(r'~(?P<board>[A-Za-z0-9-_]+)/(?P<topic_id>[A-Za-z0-9-_]+)/(?P<topic_slug>[A-Za-z0-9-_]+)/$', PostListView.as_view(),
             name='topic'),
     path('api/vote/', VotableVoteAPI.as_view(), name='votable_vote'),
+    path('api/vote/batch/', VotableVoteBatchAPI.as_view(), name='votable_vote_batch'),
+    path('api/viewer-state/', ViewerStateAPI.as_view(), name='viewer_state'),
     path('api/post/add/', PostCreateAPI.as_view(), name='post_create'),
     path('api/topic/add/', TopicCreateAPI.as_view(), name='topic_create'),
     path('api/post/edit/', PostUpdateAPI.as_view(), name='post_edit'),
@@ -1,8 +1,10 @@
-from datetime import datetime
+from datetime import date, datetime, timedelta, timezone
 from io import BytesIO
 
 from PIL import Image
 from django.core.files.base import ContentFile
+from django.db.models import ExpressionWrapper, FloatField, IntegerField, Value
+from django.db.models.functions import Abs, Greatest, Log
 from math import log
 
 
@@ -29,6 +31,8 @@ epoch = datetime(1970, 1, 1)
 
 
 def epoch_seconds(date):
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
     td = date - epoch
     return td.days * 86400 + td.seconds + (float(td.microseconds) / 1000000)
 
@@ -43,3 +47,33 @@ def hot(ups, downs, date):
     sign = 1 if s > 0 else -1 if s < 0 else 0
     seconds = epoch_seconds(date) - 1134028003
     return round(sign * order + seconds / 45000, 7)
+
+
+def hot_order_expression(score_expression):
+    """
+    SQL counterpart of the vote part of `hot`, `sign(score) * log10(max(abs(score), 1))`.
+    `score / max(abs(score), 1)` is the sign, as an integer division.
+    """
+    magnitude = Greatest(Abs(score_expression), 1, output_field=IntegerField())
+    return ExpressionWrapper((score_expression / magnitude) * Log(Value(10, output_field=IntegerField()), magnitude),
+                             output_field=FloatField())
+
+
+"""
+LEADERBOARDS
+"""
+PERIOD_DAY = 'day'
+PERIOD_WEEK = 'week'
+PERIOD_MONTH = 'month'
+PERIOD_ALL = 'all'
+ALL_TIME_START = date(1970, 1, 1)
+
+
+def period_starts(day):
+    """ Returns the first day of the leaderboard periods containing the date `day`, keyed by period. """
+    return {
+        PERIOD_DAY: day,
+        PERIOD_WEEK: day - timedelta(days=day.weekday()),
+        PERIOD_MONTH: day.replace(day=1),
+        PERIOD_ALL: ALL_TIME_START,
+    }
@@ -5,8 +5,7 @@ from django.contrib import messages
 from django.contrib.auth import authenticate, login
 from django.contrib.auth import logout
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.db.models import Exists, OuterRef, Subquery
-from django.http import HttpResponseRedirect, Http404
+from django.http import HttpResponsePermanentRedirect, HttpResponseRedirect, Http404
 from django.urls import reverse
 from django.utils.translation import gettext_lazy as _
 from django.views.generic.detail import DetailView
@@ -14,10 +13,16 @@ from django.views.generic.edit import CreateView, UpdateView
 from django.views.generic.edit import FormView
 from django.views.generic.list import ListView
 from django.core.exceptions import PermissionDenied
+from django.db.models import F, Sum
+from django.db.models.functions import Coalesce
 
 from commenting.utils import quote_votable
+from . import page_cache
+from .conditional import ConditionalPageMixin
+from .counters import merge_pending_counters, merge_pending_post_counts
 from .forms import UserCreationForm, PostCreateForm, TopicCreateForm, PostUpdateForm, TopicUpdateForm
-from .models import Topic, Board, Vote, Post, User
+from .models import Topic, Board, Vote, Post, User, LeaderboardEntry, Quote
+from .pagination import KeysetPaginationMixin, SequencePaginator
 
 logger = logging.getLogger(__name__)
 
@@ -44,75 +49,186 @@ class SignupView(FormView):
         return response
 
 
-class PostListView(ListView):
+class PublicIdObjectMixin:
+    """ Finds the votable of a detail or update view by the public id in the `pk_url_kwarg` URL kwarg. """
+
+    def get_object(self, queryset=None):
+        queryset = self.get_queryset() if queryset is None else queryset
+        try:
+            return queryset.public(self.kwargs[self.pk_url_kwarg]).get()
+        except queryset.model.DoesNotExist:
+            raise Http404(_('No %(verbose_name)s found matching the query') %
+                          {'verbose_name': queryset.model._meta.verbose_name})
+
+
+class PostListView(ConditionalPageMixin, page_cache.PageCacheMixin, KeysetPaginationMixin, ListView):
     paginate_by = 30
     template_name = 'main/post_list.html'
     context_object_name = 'posts'
-    ordering = ['date_created']
+    ordering = ['seq']
+    # The state of the user is fetched by the page, see ViewerStateAPI
+    cache_member_pages = True
+    counters_bump_version = True
+
+    def get(self, request, *args, **kwargs):
+        if Topic.pk_from_public_id(kwargs['topic_id']) is None:
+            # Links from before the k-sortable ids have the former random id of the topic
+            topic = Topic.objects.filter(legacy_id=kwargs['topic_id']).select_related('board').first()
+            if topic is None:
+                raise Http404
+            query = request.META.get('QUERY_STRING')
+            return HttpResponsePermanentRedirect(topic.get_absolute_url() + (f'?{query}' if query else ''))
+        return super().get(request, *args, **kwargs)
+
+    def get_page_version(self):
+        # With `TOPIC_COUNTER_SHARDS`, replies bump the version of a counter shard of the topic instead
+        shard_versions = Coalesce(Sum('counter_shards__version'), 0)
+        return (Topic.objects.public(self.kwargs['topic_id']).annotate(page_version=F('version') + shard_versions)
+                .values_list('page_version', flat=True).first())
 
     def get_queryset(self):
-        topics = Topic.objects.filter(id=self.kwargs['topic_id']).prefetch_related('files')
-        if self.request.user.is_authenticated:
-            # Mark topic as is_shared if user has shared topic and set vote_type for [LIKE, DISLIKE or NO_VOTE]
-            topics = topics.annotate(is_shared=Exists(
-                Vote.objects.filter(object_id=OuterRef('id'), is_shared=True, voter=self.request.user,
-                                    content_type__model='topic')),
-                vote_type=Subquery(
-                    Vote.objects.filter(object_id=OuterRef('id'), voter=self.request.user).values(
-                        'vote_type')[:1])
-            )
-        self.topic = topics.first()
-        if self.request.user.is_authenticated:
+        self.topic = Topic.objects.public(self.kwargs['topic_id']).prefetch_related('files').first()
+        if self.topic is None:
+            raise Http404
+        if self.request.user.is_authenticated and not self.page_cache_holes:
             self.topic.is_followed = self.topic.followers.filter(username=self.request.user.username).exists()
 
-        posts = self.topic.posts.all().prefetch_related('votes', 'files', 'author').order_by(*self.ordering)
-        if self.request.user.is_authenticated:
-            # Mark every post as is_shared if user has shared the post and set vote_type for [LIKE, DISLIKE or NO_VOTE]
-            posts = posts.annotate(is_shared=Exists(
-                Vote.objects.filter(object_id=OuterRef('id'), is_shared=True, voter=self.request.user,
-                                    content_type__model='post')),
-                                   vote_type=Subquery(
-                                       Vote.objects.filter(object_id=OuterRef('id'), voter=self.request.user).values(
-                                           'vote_type')[:1])
-                                   )
-        return posts
+        return self.topic.posts.all().prefetch_related('files', 'author').order_by(*self.ordering)
+
+    def get_paginator(self, queryset, per_page, orphans=0, allow_empty_first_page=True, **kwargs):
+        # Page N of a topic is found by `seq`, whatever its depth
+        return SequencePaginator(queryset, per_page, self.topic.last_post_seq, orphans=orphans,
+                                 allow_empty_first_page=allow_empty_first_page, **kwargs)
 
     def get_context_data(self, *, object_list=None, **kwargs):
         context = super().get_context_data(object_list=object_list, **kwargs)
         context['topic'] = self.topic
-        if self.request.user.is_authenticated:
+        merge_pending_counters([self.topic, *context[self.context_object_name]])
+        merge_pending_post_counts([self.topic])
+        Quote.objects.resolve([self.topic, *context[self.context_object_name]])
+        if self.request.user.is_authenticated and not self.page_cache_holes:
+            # Marks the votes and shares of the user on the topic and the posts of the page
+            Vote.objects.merge_viewer_state(self.request.user, [self.topic, *context[self.context_object_name]])
             form = PostCreateForm(initial={'topic': self.topic, 'redirect': self.topic.get_absolute_url()},
                                   author=self.request.user)
             context['form'] = form
         return context
 
+    def get_page_cache_tags(self, context):
+        return [page_cache.topic_tag(self.topic.pk), page_cache.thread_tag(self.topic.pk),
+                *(page_cache.post_tag(post.pk) for post in context[self.context_object_name])]
+
+
+class TopicSortMixin:
+    """
+    Orders topics by `?sort=hot|new|top`. Every ordering matches one of the `Topic` indexes, with
+    `id` as a tie breaker so that pages are stable.
+    """
+    sort_orderings = {
+        'hot': ['-hot_score', '-id'],
+        # Ids sort by creation time
+        'new': ['-id'],
+        'top': ['-score', '-id'],
+    }
+    default_sort = 'hot'
+
+    def get_sort(self):
+        sort = self.request.GET.get('sort')
+        return sort if sort in self.sort_orderings else self.default_sort
+
+    def get_ordering(self):
+        return self.sort_orderings[self.get_sort()]
+
+    def get_context_data(self, *, object_list=None, **kwargs):
+        context = super().get_context_data(object_list=object_list, **kwargs)
+        context['sort'] = self.get_sort()
+        context['sorts'] = list(self.sort_orderings)
+        context['page_query'] = f'sort={context["sort"]}&'
+        return context
+
 
-class TopicListView(ListView):
+class TopicListView(ConditionalPageMixin, page_cache.PageCacheMixin, KeysetPaginationMixin, TopicSortMixin, ListView):
     paginate_by = 30
     template_name = 'main/topic_list.html'
     context_object_name = 'topics'
-    ordering = ['date_created']
+
+    def get_page_version(self):
+        return Board.objects.filter(name=self.kwargs['board']).values_list('version', flat=True).first()
 
     def get_queryset(self):
         self.board = Board.objects.get(name=self.kwargs['board'])
         if self.request.user.is_authenticated:
             self.board.is_followed = self.request.user.boards.filter(name=self.board.name).exists()
-        return self.board.topics.order_by(*self.ordering)
+        return self.board.topics.order_by(*self.get_ordering())
 
     def get_context_data(self, *, object_list=None, **kwargs):
         context = super().get_context_data(object_list=object_list, **kwargs)
         context['board'] = self.board
+        merge_pending_post_counts(context[self.context_object_name])
         return context
 
+    def get_page_cache_tags(self, context):
+        return [page_cache.board_tag(self.board.name),
+                *(page_cache.topic_tag(topic.pk) for topic in context[self.context_object_name])]
 
-class HomeListView(ListView):
+
+class HomeListView(page_cache.PageCacheMixin, KeysetPaginationMixin, TopicSortMixin, ListView):
     paginate_by = 30
     template_name = 'main/home.html'
     context_object_name = 'topics'
-    ordering = ['date_created']
 
     def get_queryset(self):
-        return Topic.objects.order_by(*self.ordering)
+        return Topic.objects.order_by(*self.get_ordering())
+
+    def get_context_data(self, *, object_list=None, **kwargs):
+        context = super().get_context_data(object_list=object_list, **kwargs)
+        merge_pending_post_counts(context[self.context_object_name])
+        return context
+
+    def get_page_cache_tags(self, context):
+        return [page_cache.ALL_TOPICS_TAG,
+                *(page_cache.topic_tag(topic.pk) for topic in context[self.context_object_name])]
+
+
+class LeaderboardView(ListView):
+    """
+    Top topics or posts (`?type=topic|post`) of the day, week, month or all time (`?period=`),
+    site-wide or on a board, served from the precomputed `LeaderboardEntry` rollups.
+    """
+    paginate_by = 30
+    template_name = 'main/leaderboard.html'
+    context_object_name = 'entries'
+    votable_models = {'topic': Topic, 'post': Post}
+    periods = dict(LeaderboardEntry.PERIODS)
+
+    def get_votable_type(self):
+        votable_type = self.request.GET.get('type')
+        return votable_type if votable_type in self.votable_models else 'topic'
+
+    def get_period(self):
+        period = self.request.GET.get('period')
+        return period if period in self.periods else 'day'
+
+    def get_queryset(self):
+        self.board = None
+        if 'board' in self.kwargs:
+            self.board = Board.objects.get(name=self.kwargs['board'])
+        return LeaderboardEntry.objects.top(self.votable_models[self.get_votable_type()], self.get_period(),
+                                            board=self.board)
+
+    def get_context_data(self, *, object_list=None, **kwargs):
+        context = super().get_context_data(object_list=object_list, **kwargs)
+        votable_type, period = self.get_votable_type(), self.get_period()
+        context.update({
+            'board': self.board,
+            'votable_type': votable_type,
+            'period': period,
+            'periods': self.periods,
+            'votables': LeaderboardEntry.objects.load_votables(self.votable_models[votable_type],
+                                                               context[self.context_object_name]),
+            'page_query': f'type={votable_type}&period={period}&',
+        })
+        return context
 
 
 class TopicCreateView(LoginRequiredMixin, CreateView):
@@ -169,10 +285,10 @@ class PostCreateView(LoginRequiredMixin, CreateView):
             should_quote_topic = self.request.GET.get('quote_topic')
             try:
                 if topic_id:
-                    self.topic = Topic.objects.get(id=topic_id)
-                    kwargs['topic'] = topic_id
+                    self.topic = Topic.objects.public(topic_id).get()
+                    kwargs['topic'] = self.topic.pk
                 if post_id:
-                    post = Post.objects.get(id=post_id)
+                    post = Post.objects.public(post_id).get()
                     kwargs['post'] = quote_votable(post)
                 if should_quote_topic and should_quote_topic == '1':
                     kwargs['post'] = quote_votable(self.topic)
@@ -214,7 +330,7 @@ class UserView(DetailView):
         return user
 
 
-class PostUpdateView(LoginRequiredMixin, UpdateView):
+class PostUpdateView(LoginRequiredMixin, PublicIdObjectMixin, UpdateView):
     """ Used for GET request ONLY ... API Handles the POST request """
     model = Post
     form_class = PostUpdateForm
@@ -229,7 +345,7 @@ class PostUpdateView(LoginRequiredMixin, UpdateView):
         return obj
 
 
-class TopicUpdateView(LoginRequiredMixin, UpdateView):
+class TopicUpdateView(LoginRequiredMixin, PublicIdObjectMixin, UpdateView):
     """ Used for GET request ONLY ... API Handles the POST request """
     model = Topic
     form_class = TopicUpdateForm